@@ -36,16 +36,24 @@ from tornado.escape import json_encode
 from tornado.log import enable_pretty_logging
 
 from .web.handlers.page import (
-    BaseHandler, DeviceConnectHandler,
-    DeviceHierarchyHandler, DeviceHierarchyHandlerV2, DeviceScreenshotHandler,
+    BaseHandler, CropHandler, DeviceConnectHandler, DeviceConnectionHandler,
+    DeviceConnectProgressHandler,
+    DevicePoolHandler, DeviceExecutorHandler,
+    DeviceHierarchyHandler, DeviceHierarchyHandlerV2, DeviceHierarchyHandlerV3,
+    DeviceHierarchyLazyHandler, DeviceSnapshotHandler, DeviceHistoryHandler,
+    DeviceHistoryFrameHandler, DeviceHistoryExportHandler,
+    DeviceScreenshotHandler, DeviceScreenshotRawHandler,
     DeviceWidgetListHandler, MainHandler, VersionHandler, WidgetPreviewHandler,
     WindowSizeHandler, TextHandler, InputHandler, ClickHandler,
     SelectedHandler, EnabledHandler, ActivityHandler, TapHandler, SwipeHandler,
     LongTapHandler, SwipeExtHandler, PressHandler, PackageHandler, 
     AssertTextHandler, AssertSelectHandler, AssertEnabledHandler, ExistsHandler,
     InstallHandler, DevicesHandler, AssertExistsHandler, UnInstallHandler,
-    TellHandler, EndTellHandler)
+    TellHandler, EndTellHandler, NodesAtHandler, NodesInHandler,
+    NodesXPathHandler, DeviceBatchHandler, FanOutHandler)
+from .web import device, history
 from .web.handlers.proxy import StaticProxyHandler
+from .web.handlers.screen import ScreenMJPEGHandler, ScreenWebSocketHandler
 from .web.handlers.shell import PythonShellHandler
 from .web.utils import current_ip, tostr
 from .web.version import __version__
@@ -59,6 +67,7 @@ is_closing = False
 if os.name == "nt":
     os.environ["HOME"] = os.path.expanduser("~")
 PID_FILEPATH = os.path.expandvars("$HOME/.weditor/weditor.pid")
+DEVICES_FILEPATH = os.path.expandvars("$HOME/.weditor/devices.json")
 os.makedirs(os.path.dirname(PID_FILEPATH), exist_ok=True)
 
 
@@ -85,20 +94,21 @@ class QuitHandler(BaseHandler):
         self.write({"success": True, "description": "Successfully quited"})
 
 
-class CropHandler(BaseHandler):
-    def get(self):
-        """ used for crop image """
-        pass
-
-
 def make_app(settings={}):
     application = tornado.web.Application(
         [
             (r"/", MainHandler),
             (r"/api/v1/version", VersionHandler),
             (r"/api/v1/connect", DeviceConnectHandler),
+            # 后台连接的进度
+            (r"/api/v1/connect/([^/]+)", DeviceConnectProgressHandler),
             (r"/api/v1/crop", CropHandler),
             (r"/api/v1/devices/([^/]+)/screenshot", DeviceScreenshotHandler),
+            # 截图原始字节, 支持ETag
+            (r"/api/v1/devices/([^/]+)/screenshot/raw", DeviceScreenshotRawHandler),
+            # 共享的实时画面, 多个浏览器只占用一个minicap连接
+            (r"/api/v1/devices/([^/]+)/screen.mjpeg", ScreenMJPEGHandler),
+            (r"/ws/v1/devices/([^/]+)/screen", ScreenWebSocketHandler),
             (r"/api/v1/devices/([^/]+)/hierarchy", DeviceHierarchyHandler),
             # (r"/api/v1/devices/([^/]+)/exec", DeviceCodeDebugHandler),
             (r"/api/v1/devices/([^/]+)/widget", DeviceWidgetListHandler),
@@ -106,6 +116,16 @@ def make_app(settings={}):
             (r"/api/v1/widgets/([^/]+)", DeviceWidgetListHandler),
             # v2
             (r"/api/v2/devices/([^/]+)/hierarchy", DeviceHierarchyHandlerV2),
+            # v3
+            (r"/api/v3/devices/([^/]+)/hierarchy", DeviceHierarchyHandlerV3),
+            # 截图和控件树同一时刻一次获取
+            (r"/api/v1/devices/([^/]+)/snapshot", DeviceSnapshotHandler),
+            # 最近的截图记录
+            (r"/api/v1/devices/([^/]+)/history", DeviceHistoryHandler),
+            (r"/api/v1/devices/([^/]+)/history/export", DeviceHistoryExportHandler),
+            (r"/api/v1/devices/([^/]+)/history/(\d+)", DeviceHistoryFrameHandler),
+            # 按需加载的控件树
+            (r"/api/v1/devices/([^/]+)/hierarchy/lazy", DeviceHierarchyLazyHandler),
             # widgets
             (r"/widgets/([^/]+)", WidgetPreviewHandler),
             (r"/widgets/(.+/.+)", tornado.web.StaticFileHandler, {
@@ -160,7 +180,22 @@ def make_app(settings={}):
              # 获取连接设备
             (r"/api/v1/devices/list/info", DevicesHandler),
             (r"/api/v1/devices/([^/]+)/call", TellHandler),
-            (r"/api/v1/devices/([^/]+)/end_call", EndTellHandler)
+            (r"/api/v1/devices/([^/]+)/end_call", EndTellHandler),
+            # 坐标下的控件
+            (r"/api/v1/devices/([^/]+)/nodes/at", NodesAtHandler),
+            (r"/api/v1/devices/([^/]+)/nodes/in", NodesInHandler),
+            # 服务端xpath查询
+            (r"/api/v1/devices/([^/]+)/nodes/xpath", NodesXPathHandler),
+            # 一次请求依次执行多个操作
+            (r"/api/v1/devices/([^/]+)/batch", DeviceBatchHandler),
+            # 多台设备同时执行同样的操作
+            (r"/api/v1/fanout", FanOutHandler),
+            # 设备连接状态
+            (r"/api/v1/pool", DevicePoolHandler),
+            (r"/api/v1/devices/([^/]+)/connection", DeviceConnectionHandler),
+            # 设备任务队列状态
+            (r"/api/v1/executors", DeviceExecutorHandler),
+            (r"/api/v1/devices/([^/]+)/executor", DeviceExecutorHandler),
         ],
         **settings)
     return application
@@ -205,7 +240,42 @@ def cmd_quit(port=17310):
         logger.info("weditor was killed")
 
 
-def run_web(debug=False, port=17310, open_browser=False, force_quit=False):
+def known_devices(extra=()) -> list:
+    """
+    Devices to connect at startup: the list in ~/.weditor/devices.json and
+    the --device arguments, like ["android:10.0.0.2", "ios:http://localhost:8100"]
+    """
+    device_ids = []
+    if os.path.isfile(DEVICES_FILEPATH):
+        try:
+            with open(DEVICES_FILEPATH, "r") as f:
+                device_ids.extend(json.load(f))
+        except (ValueError, OSError) as e:
+            logger.warning("read %s error: %s", DEVICES_FILEPATH, e)
+    for device_id in extra:
+        if device_id not in device_ids:
+            device_ids.append(device_id)
+    return device_ids
+
+
+def warm_up_devices(device_ids):
+    loop = tornado.ioloop.IOLoop.current()
+
+    def on_done(task):
+        if task.state == "failed":
+            logger.warning("warm up %s failed: %s", task.device_id, task.error)
+            return
+        logger.info("warm up %s done in %.1fs", task.device_id,
+                    task.finished - task.created)
+        if device.SCREEN_STREAM and task.platform == "android":
+            loop.add_callback(device.start_screen_stream, task.device_id,
+                              persistent=True)
+
+    device.warm_up(device_ids, on_done)
+
+
+def run_web(debug=False, port=17310, open_browser=False, force_quit=False,
+            device_ids=()):
     base_url = f"http://localhost:{port}"
     version = get_running_version(base_url)
     if version:
@@ -234,6 +304,10 @@ def run_web(debug=False, port=17310, open_browser=False, force_quit=False):
         f.write(str(os.getpid()))
 
     tornado.ioloop.PeriodicCallback(try_exit, 100).start()
+    if device_ids:
+        # connects run on the device workers, the server is up meanwhile
+        tornado.ioloop.IOLoop.current().add_callback(warm_up_devices,
+                                                     device_ids)
     tornado.ioloop.IOLoop.instance().start()
     # tornado.ioloop.IOLoop.instance().add_callback(consume_queue)
 
@@ -278,6 +352,10 @@ def main():
     ap.add_argument('--debug', action='store_true', help='open debug mode')
     ap.add_argument('--shortcut', action='store_true', help='create shortcut in desktop')
     ap.add_argument("--quit", action="store_true", help="stop weditor")
+    ap.add_argument('--screen-stream', action='store_true', help='keep the minicap stream of android devices open and serve screenshots from it')
+    ap.add_argument('--history-size', type=int, default=32, help='MB of recent screenshots kept per device, 0 disables the history')
+    ap.add_argument('--device', action='append', default=[], metavar='ID', help='connect at startup, like android:10.0.0.2, also read from ~/.weditor/devices.json')
+    ap.add_argument('--snapshot-query', action='store_true', help='answer element queries from the cached hierarchy, ?live=1 still queries the device')
     args = ap.parse_args()
     # yapf: enable
 
@@ -297,8 +375,13 @@ def main():
         import asyncio
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
+    device.SNAPSHOT_QUERY = args.snapshot_query
+    device.SCREEN_STREAM = args.screen_stream
+    history.MAX_BYTES = args.history_size * 1024 * 1024
+
     open_browser = not args.quiet and not args.debug
-    run_web(args.debug, args.port, open_browser, args.force_quit)
+    run_web(args.debug, args.port, open_browser, args.force_quit,
+            known_devices(args.device))
 
 
 if __name__ == '__main__':
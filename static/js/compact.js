@@ -0,0 +1,150 @@
+// Decoder of the compact hierarchy format (web/compact.py)
+// decodeCompactHierarchy(arrayBuffer) returns the same object as
+// GET /api/v2/devices/{id}/hierarchy with the default json format.
+
+var COMPACT_KIND_BOOL = 0,
+  COMPACT_KIND_INT = 1,
+  COMPACT_KIND_STR = 2,
+  COMPACT_KIND_JSON = 3,
+  COMPACT_KIND_RECT = 4,
+  COMPACT_KIND_HEXID = 5,
+  COMPACT_KIND_CHILDREN = 6;
+
+function CompactReader(buffer) {
+  this.bytes = new Uint8Array(buffer)
+  this.pos = 0
+}
+
+CompactReader.prototype.varint = function () {
+  var n = 0, scale = 1, b;
+  do {
+    b = this.bytes[this.pos++]
+    n += (b & 0x7f) * scale
+    scale *= 128
+  } while (b >= 0x80)
+  return n
+}
+
+CompactReader.prototype.zigzag = function () {
+  var n = this.varint()
+  return n % 2 ? -(n + 1) / 2 : n / 2
+}
+
+CompactReader.prototype.take = function (size) {
+  var ret = this.bytes.subarray(this.pos, this.pos + size)
+  this.pos += size
+  return ret
+}
+
+CompactReader.prototype.bitset = function (size) {
+  var raw = this.take(Math.ceil(size / 8))
+  var bits = new Array(size)
+  for (var i = 0; i < size; i++) {
+    bits[i] = (raw[i >> 3] >> (i & 7) & 1) === 1
+  }
+  return bits
+}
+
+function decodeCompactHierarchy(buffer) {
+  var r = new CompactReader(buffer)
+  var magic = r.take(4)
+  if (magic[0] !== 0x57 || magic[1] !== 0x45 || magic[2] !== 0x48 || magic[3] !== 1) {
+    throw new Error("Not a compact hierarchy")
+  }
+  var utf8 = new TextDecoder("utf-8")
+  var data = JSON.parse(utf8.decode(r.take(r.varint())))
+  var count = r.varint()
+  var strings = new Array(r.varint())
+  for (var i = 0; i < strings.length; i++) {
+    strings[i] = utf8.decode(r.take(r.varint()))
+  }
+  var nodes = new Array(count), parents = new Array(count)
+  for (var i = 0; i < count; i++) {
+    nodes[i] = {}
+    parents[i] = i - r.varint()
+  }
+
+  var columns = r.varint()
+  for (var c = 0; c < columns; c++) {
+    var key = strings[r.varint()]
+    var kind = r.take(1)[0]
+    var presence = r.bitset(count), present = []
+    for (var i = 0; i < count; i++) {
+      if (presence[i]) present.push(i)
+    }
+    var values = kind === COMPACT_KIND_BOOL ? r.bitset(present.length) : null
+    for (var j = 0; j < present.length; j++) {
+      var node = nodes[present[j]]
+      switch (kind) {
+        case COMPACT_KIND_BOOL:
+          node[key] = values[j]
+          break
+        case COMPACT_KIND_INT:
+          node[key] = r.zigzag()
+          break
+        case COMPACT_KIND_STR:
+          node[key] = strings[r.varint()]
+          break
+        case COMPACT_KIND_JSON:
+          node[key] = JSON.parse(strings[r.varint()])
+          break
+        case COMPACT_KIND_RECT:
+          node[key] = { x: r.zigzag(), y: r.zigzag(), width: r.zigzag(), height: r.zigzag() }
+          break
+        case COMPACT_KIND_HEXID:
+          var raw = r.take(8), hex = ""
+          for (var k = 0; k < 8; k++) {
+            hex += (raw[k] < 16 ? "0" : "") + raw[k].toString(16)
+          }
+          node[key] = hex
+          break
+        case COMPACT_KIND_CHILDREN:
+          node[key] = []
+          break
+        default:
+          throw new Error("Unknown column kind " + kind)
+      }
+    }
+  }
+
+  for (var i = 1; i < count; i++) {
+    nodes[parents[i]].children.push(nodes[i])
+  }
+  data.jsonHierarchy = count ? nodes[0] : null
+  return data
+}
+
+// GET a hierarchy url in the compact format, resolves to the decoded object
+// with decodeTime (ms), byteLength and hierarchyVersion added
+function fetchCompactHierarchy(url) {
+  var dtd = $.Deferred();
+  var xhr = new XMLHttpRequest()
+  xhr.open("GET", url + (url.indexOf("?") === -1 ? "?" : "&") + "format=compact")
+  xhr.responseType = "arraybuffer"
+  xhr.onload = function () {
+    if (xhr.status !== 200) {
+      // same shape as a failed $.getJSON, for showAjaxError
+      var text = new TextDecoder("utf-8").decode(new Uint8Array(xhr.response || new ArrayBuffer(0)))
+      var error = { status: xhr.status, responseText: text }
+      try {
+        error.responseJSON = JSON.parse(text)
+      } catch (err) { }
+      return dtd.reject(error)
+    }
+    var start = performance.now()
+    try {
+      var data = decodeCompactHierarchy(xhr.response)
+    } catch (err) {
+      return dtd.reject({ status: xhr.status, responseJSON: { description: err.message } })
+    }
+    data.decodeTime = performance.now() - start
+    data.hierarchyVersion = xhr.getResponseHeader("X-Hierarchy-Version")
+    data.byteLength = xhr.response.byteLength
+    dtd.resolve(data)
+  }
+  xhr.onerror = function () {
+    dtd.reject({ status: xhr.status, responseText: "network error" })
+  }
+  xhr.send()
+  return dtd.promise()
+}
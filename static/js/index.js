@@ -1,5 +1,7 @@
 window.LOCAL_URL = '/'; // http://localhost:17310/';
 window.LOCAL_VERSION = '0.0.3'
+// above this many nodes the tree view loads branches from the server on demand
+window.LAZY_TREE_THRESHOLD = 2000
 
 
 window.vm = new Vue({
@@ -19,6 +21,8 @@ window.vm = new Vue({
     nodeHoveredList: [],
     originNodeMaps: {},
     originNodes: [],
+    lazyTree: false,
+    screenEtag: null, // frame on the canvas, base of tile deltas
     autoCopy: true,
     useXPathOnly: false,
     platform: localStorage.platform || 'Android',
@@ -32,6 +36,12 @@ window.vm = new Vue({
     screenWebSocket: null,
     screenWebSocketUrl: null,
     liveScreen: false,
+    liveHierarchy: {
+      clientId: Math.random().toString(36).slice(2),
+      version: null,
+      root: null,
+      nodes: {},
+    },
     canvas: {
       bg: null,
       fg: null,
@@ -241,7 +251,7 @@ window.vm = new Vue({
           var lastScreenshotBase64 = localStorage.screenshotBase64;
           if (lastScreenshotBase64) {
             var blob = b64toBlob(lastScreenshotBase64, 'image/jpeg');
-            this.drawBlobImageToScreen(blob);
+            this.drawBlobImageToScreen(blob, this.parseScreenSize(localStorage.screenshotSize));
             this.canvasStyle.opacity = 1.0;
           }
           if (localStorage.jsonHierarchy) {
@@ -374,6 +384,7 @@ window.vm = new Vue({
           deviceUrl: this.deviceUrl,
         },
       })
+        .then(this.waitConnected)
         .then((ret) => {
           console.log("deviceId", ret.deviceId)
           this.deviceId = ret.deviceId
@@ -388,6 +399,22 @@ window.vm = new Vue({
         })
 
     },
+    waitConnected: function (ret) {
+      // the connect runs in the background, poll its progress until done
+      if (ret.state === "done") {
+        return ret
+      }
+      if (ret.state === "failed") {
+        return $.Deferred().reject({ responseJSON: { description: ret.error } })
+      }
+      const deferred = $.Deferred()
+      setTimeout(() => {
+        $.getJSON(LOCAL_URL + "api/v1/connect/" + ret.connectId)
+          .then(this.waitConnected)
+          .then(deferred.resolve, deferred.reject)
+      }, 300)
+      return deferred.promise()
+    },
     doKeyevent: function (meta) {
       var code = 'd.press("' + meta + '")'
       if (this.platform != 'Android' && meta == 'home') {
@@ -415,9 +442,65 @@ window.vm = new Vue({
         source.children.forEach(function (s) {
           n.children.push(this.sourceToJstree(s))
         }.bind(this))
+      } else if (source.childCount) {
+        n.children = true // not loaded yet, see lazyJstreeData
       }
       return n;
     },
+    lazyJstreeData: function (version) {
+      var url = LOCAL_URL + 'api/v1/devices/' + encodeURIComponent(this.deviceId || '-') + '/hierarchy/lazy';
+      var self = this;
+
+      function markOpened(n) {
+        if (Array.isArray(n.children)) {
+          n.state = { opened: true };
+          n.children.forEach(markOpened);
+        }
+        return n
+      }
+      return function (obj, callback) {
+        var params = { version: version, depth: obj.id === '#' ? 3 : 1 };
+        if (obj.id !== '#') {
+          params.node = obj.id;
+        }
+        $.getJSON(url, params)
+          .fail((ret) => {
+            self.showAjaxError(ret);
+            callback.call(this, []);
+          })
+          .then((ret) => {
+            var n = self.sourceToJstree(ret.node);
+            callback.call(this, obj.id === '#' ? markOpened(n) : n.children);
+          })
+      }
+    },
+    revealJstreeNode: function (id) {
+      var jstree = this.$jstree.jstree(true);
+      jstree.deselect_all();
+      if (!this.lazyTree) {
+        jstree.close_all();
+        jstree.select_node("#" + id);
+        jstree._open_to("#" + id);
+        document.getElementById(id).scrollIntoView(false);
+        return
+      }
+      // open the ancestors one by one, each may need a request first
+      var path = [];
+      for (var n = this.originNodeMaps[id]; n && n._parentId; n = this.originNodeMaps[n._parentId]) {
+        path.unshift(n._parentId);
+      }
+      var openNext = (i) => {
+        if (i < path.length) {
+          return jstree.open_node(path[i], () => openNext(i + 1));
+        }
+        jstree.select_node(id);
+        var el = document.getElementById(id);
+        if (el) {
+          el.scrollIntoView(false);
+        }
+      }
+      openNext(0);
+    },
     sourceTypeIcon: function (widgetType) {
       switch (widgetType) {
         case "Scene":
@@ -468,7 +551,9 @@ window.vm = new Vue({
         }
       })
         .on('ready.jstree refresh.jstree', function () {
-          $jstree.jstree("open_all");
+          if (!self.lazyTree) {
+            $jstree.jstree("open_all");
+          }
         })
         .on("changed.jstree", function (e, data) {
           var id = data.selected[0];
@@ -774,42 +859,173 @@ window.vm = new Vue({
       } else if (this.liveScreen) {
         return this.dumpHierarchy()
       } else {
-        return this.screenRefresh().then(this.dumpHierarchy)
+        return this.snapshotRefresh()
       }
     },
+    snapshotRefresh: function () {
+      // screenshot and hierarchy of the same moment, in one request
+      var screenDiv = document.getElementById('screen');
+      var maxWidth = Math.ceil(screenDiv.clientWidth * (window.devicePixelRatio || 1));
+      this.dumping = true
+      return $.getJSON(LOCAL_URL + 'api/v1/devices/' + encodeURIComponent(this.deviceId || '-') + '/snapshot', {
+        preset: 'preview',
+        max_width: maxWidth,
+      })
+        .fail((ret) => {
+          this.showAjaxError(ret);
+        })
+        .then((ret) => {
+          console.log("snapshot timings", ret.timings)
+          var screenshot = ret.screenshot;
+          var screenSize = { width: screenshot.size[0], height: screenshot.size[1] };
+          localStorage.setItem('screenshotBase64', screenshot.data);
+          localStorage.setItem('screenshotSize', screenshot.size.join(','));
+          this.screenEtag = null;
+          return this.drawBlobImageToScreen(b64toBlob(screenshot.data, 'image/' + screenshot.type), screenSize)
+            .then(() => this.applyHierarchy(ret, ret.hierarchyVersion))
+        })
+        .always(() => {
+          this.dumping = false
+        })
+    },
     dumpHierarchy: function () { // v2
       this.dumping = true
-      return $.getJSON(LOCAL_URL + 'api/v2/devices/' + encodeURIComponent(this.deviceId || '-') + '/hierarchy')
+      return fetchCompactHierarchy(LOCAL_URL + 'api/v2/devices/' + encodeURIComponent(this.deviceId || '-') + '/hierarchy')
         .fail((ret) => {
           this.showAjaxError(ret);
         })
         .then((ret) => {
-          localStorage.setItem("xmlHierarchy", ret.xmlHierarchy);
-          localStorage.setItem('jsonHierarchy', JSON.stringify(ret.jsonHierarchy));
-          localStorage.setItem("activity", ret.activity);
-          localStorage.setItem("packageName", ret.packageName);
-          localStorage.setItem("windowSize", ret.windowSize);
-          this.activity = ret.activity; // only for android
-          this.packageName = ret.packageName;
-          this.drawAllNodeFromSource(ret.jsonHierarchy);
-          this.nodeSelected = null;
+          console.log("hierarchy", ret.byteLength, "bytes, decoded in", ret.decodeTime.toFixed(1), "ms")
+          this.applyHierarchy(ret, ret.hierarchyVersion);
         })
         .always(() => {
           this.dumping = false
         })
     },
+    applyHierarchy: function (ret, version) {
+      // node ids are derived from the tree path, so an unchanged screen
+      // gives the same json and the tree and canvas can be kept as is
+      let jsonHierarchy = JSON.stringify(ret.jsonHierarchy);
+      let unchanged = jsonHierarchy === localStorage.jsonHierarchy;
+      localStorage.setItem("xmlHierarchy", ret.xmlHierarchy);
+      localStorage.setItem('jsonHierarchy', jsonHierarchy);
+      localStorage.setItem("activity", ret.activity);
+      localStorage.setItem("packageName", ret.packageName);
+      localStorage.setItem("windowSize", ret.windowSize);
+      this.activity = ret.activity; // only for android
+      this.packageName = ret.packageName;
+      if (unchanged && this.originNodes.length) {
+        this.loading = false;
+        this.canvasStyle.opacity = 1.0;
+        return
+      }
+      this.drawAllNodeFromSource(ret.jsonHierarchy, version);
+      this.nodeSelected = null;
+    },
     screenRefresh: function () {
-      return $.getJSON(LOCAL_URL + 'api/v1/devices/' + encodeURIComponent(this.deviceId || '-') + '/screenshot')
+      // raw image bytes, the browser revalidates them with the ETag. The
+      // server shrinks the frame to the size it is shown at.
+      var screenDiv = document.getElementById('screen');
+      var maxWidth = Math.ceil(screenDiv.clientWidth * (window.devicePixelRatio || 1));
+      // only tiles changed since the frame on the canvas are sent
+      var data = { preset: 'preview', max_width: maxWidth, delta: 1 };
+      if (this.screenEtag) {
+        data.since = this.screenEtag;
+      }
+      return $.ajax({
+        url: LOCAL_URL + 'api/v1/devices/' + encodeURIComponent(this.deviceId || '-') + '/screenshot/raw',
+        data: data,
+        xhrFields: { responseType: 'blob' },
+      })
         .fail((err) => {
           this.showAjaxError(err);
         })
-        .then(function (ret) {
-          var blob = b64toBlob(ret.data, 'image/' + ret.type);
-          this.drawBlobImageToScreen(blob);
-          localStorage.setItem('screenshotBase64', ret.data);
+        .then(function (blob, status, xhr) {
+          if (xhr.status === 304) {
+            return; // screen did not change
+          }
+          this.screenEtag = xhr.getResponseHeader("Etag");
+          var screenSize = this.parseScreenSize(xhr.getResponseHeader("X-Screen-Size"));
+          var tiles = xhr.getResponseHeader("X-Tiles");
+          if (tiles) {
+            // full frame in localStorage is stale now, fetch it when needed
+            localStorage.setItem('screenshotScaled', '1');
+            return this.drawBlobImageToScreen(blob, screenSize, {
+              tiles: tiles.split(";").map(t => t.split(",").map(Number)),
+              tileSize: Number(xhr.getResponseHeader("X-Tile-Size")),
+              columns: Number(xhr.getResponseHeader("X-Atlas-Columns")),
+              frameSize: this.parseScreenSize(xhr.getResponseHeader("X-Frame-Size")),
+            });
+          }
+          var reader = new FileReader();
+          reader.onload = function () {
+            // data:image/jpeg;base64,xxxx
+            localStorage.setItem('screenshotBase64', reader.result.split(",")[1]);
+            localStorage.setItem('screenshotSize', xhr.getResponseHeader("X-Screen-Size") || '');
+          }
+          reader.readAsDataURL(blob);
+          return this.drawBlobImageToScreen(blob, screenSize);
         }.bind(this))
     },
-    drawBlobImageToScreen: function (blob) {
+    parseScreenSize: function (value) {
+      if (!value) {
+        return null;
+      }
+      var size = value.split(",").map((v) => parseInt(v, 10));
+      return { width: size[0], height: size[1] };
+    },
+    fullScreenshotBase64: function () {
+      // widget templates are cropped in screen pixels, a shrunk preview
+      // frame is replaced by a full size one
+      var dtd = $.Deferred();
+      if (!localStorage.screenshotScaled) {
+        return dtd.resolve(localStorage.screenshotBase64).promise();
+      }
+      $.ajax({
+        url: LOCAL_URL + 'api/v1/devices/' + encodeURIComponent(this.deviceId || '-') + '/screenshot/raw',
+        data: { format: 'jpeg' },
+        xhrFields: { responseType: 'blob' },
+      })
+        .fail((err) => {
+          this.showAjaxError(err);
+          dtd.reject(err);
+        })
+        .then(function (blob) {
+          var reader = new FileReader();
+          reader.onload = function () {
+            dtd.resolve(reader.result.split(",")[1]);
+          }
+          reader.readAsDataURL(blob);
+        })
+      return dtd.promise();
+    },
+    drawScreenImage: function (ctx, img, screenSize) {
+      var size = screenSize || { width: img.width, height: img.height };
+      if (screenSize) {
+        localStorage.setItem('screenshotScaled', img.width !== screenSize.width ? '1' : '');
+      }
+      this.canvas.fg.width = this.canvas.bg.width = size.width
+      this.canvas.fg.height = this.canvas.bg.height = size.height
+
+      ctx.drawImage(img, 0, 0, size.width, size.height);
+      this.resizeScreen(size);
+    },
+    patchScreenTiles: function (ctx, img, delta) {
+      // tiles are in frame pixels, the canvas in screen pixels
+      var fx = this.canvas.bg.width / delta.frameSize.width,
+        fy = this.canvas.bg.height / delta.frameSize.height;
+      delta.tiles.forEach(function (tile, i) {
+        var ax = (i % delta.columns) * delta.tileSize,
+          ay = Math.floor(i / delta.columns) * delta.tileSize;
+        ctx.drawImage(img, ax, ay, tile[2], tile[3],
+          tile[0] * fx, tile[1] * fy, tile[2] * fx, tile[3] * fy);
+      });
+    },
+    drawBlobImageToScreen: function (blob, screenSize, delta) {
+      // screenSize: full screen size when blob is a shrunk frame, the canvas
+      // keeps screen pixels so node rects still line up
+      // delta: {tiles, tileSize, columns, frameSize}, blob is an atlas of
+      // changed tiles which are drawn over the current canvas
       // Support jQuery Promise
       var dtd = $.Deferred();
       var bgcanvas = this.canvas.bg,
@@ -821,12 +1037,11 @@ window.vm = new Vue({
         img = this.imagePool.next();
 
       img.onload = function () {
-        fgcanvas.width = bgcanvas.width = img.width
-        fgcanvas.height = bgcanvas.height = img.height
-
-
-        ctx.drawImage(img, 0, 0, img.width, img.height);
-        self.resizeScreen(img);
+        if (delta) {
+          self.patchScreenTiles(ctx, img, delta);
+        } else {
+          self.drawScreenImage(ctx, img, screenSize);
+        }
 
         // Try to forcefully clean everything to get rid of memory
         // leaks. Note self despite this effort, Chrome will still
@@ -862,13 +1077,80 @@ window.vm = new Vue({
       img.src = url;
       return dtd;
     },
+    dumpHierarchyPatch: function () { // v3, only changes since last dump
+      let live = this.liveHierarchy;
+      this.dumping = true
+      return $.getJSON(LOCAL_URL + 'api/v3/devices/' + encodeURIComponent(this.deviceId || '-') + '/hierarchy', {
+        client: live.clientId,
+        version: live.version || '',
+      })
+        .fail((ret) => {
+          this.showAjaxError(ret);
+        })
+        .then((ret) => {
+          if (!ret.changed) {
+            return
+          }
+          if (ret.full) {
+            live.nodes = {}
+            live.root = ret.jsonHierarchy._id
+            let stack = [ret.jsonHierarchy];
+            while (stack.length) {
+              let node = Object.assign({}, stack.pop());
+              if (node.children) {
+                stack.push(...node.children)
+                node.children = node.children.map((n) => n._id)
+              }
+              live.nodes[node._id] = node
+            }
+          } else {
+            let patch = ret.patch;
+            live.root = ret.root
+            patch.removed.forEach((id) => {
+              delete live.nodes[id]
+            })
+            Object.assign(live.nodes, patch.added)
+            for (const [id, attrs] of Object.entries(patch.changed)) {
+              let node = live.nodes[id];
+              Object.assign(node, attrs)
+            }
+            for (const [id, keys] of Object.entries(patch.removedKeys || {})) {
+              let node = live.nodes[id];
+              keys.forEach((key) => {
+                delete node[key]
+              })
+            }
+          }
+          live.version = ret.version
+          this.activity = ret.activity;
+          this.packageName = ret.packageName;
+          localStorage.setItem("activity", ret.activity);
+          localStorage.setItem("packageName", ret.packageName);
+          localStorage.setItem("windowSize", ret.windowSize);
+
+          function build(id) {
+            let node = Object.assign({}, live.nodes[id]);
+            if (node.children) {
+              node.children = node.children.map(build)
+            }
+            return node
+          }
+          let source = build(live.root);
+          localStorage.setItem('jsonHierarchy', JSON.stringify(source));
+          this.drawAllNodeFromSource(source, live.version);
+          this.nodeSelected = null;
+        })
+        .always(() => {
+          this.dumping = false
+        })
+    },
     loadLiveHierarchy: function () {
       if (this.nodeHovered || this.nodeSelected) {
         setTimeout(this.loadLiveHierarchy, 500)
         return
       }
       if (this.liveScreen) {
-        this.dumpHierarchy()
+        this.dumpHierarchyPatch()
           .then(() => {
             this.loadLiveHierarchy()
           })
@@ -879,7 +1161,8 @@ window.vm = new Vue({
       var BLANK_IMG =
         'data:image/gif;base64,R0lGODlhAQABAAAAACH5BAEKAAEALAAAAAABAAEAAAICTAEAOw=='
       var protocol = location.protocol == "http:" ? "ws://" : "wss://"
-      var ws = new WebSocket(this.screenWebSocketUrl);
+      // frames of the device are shared with other viewers by the server
+      var ws = new WebSocket(protocol + location.host + LOCAL_URL + 'ws/v1/devices/' + encodeURIComponent(this.deviceId || '-') + '/screen');
       var canvas = document.getElementById('bgCanvas')
       var ctx = canvas.getContext('2d');
       var lastScreenSize = {
@@ -896,6 +1179,7 @@ window.vm = new Vue({
       };
       ws.onmessage = function (message) {
         console.log("New message");
+        self.screenEtag = null;
         var blob = new Blob([message.data], {
           type: 'image/jpeg'
         })
@@ -1099,7 +1383,7 @@ window.vm = new Vue({
       console.log(this.elemXPathLite)
       console.log(this.elemXPathFull)
       console.log(node.rect, node.description, node.resourceId, node.text)
-      $.ajax({
+      this.fullScreenshotBase64().then(screenshot => $.ajax({
         method: "post",
         url: "/api/v1/widgets",
         dataType: "json",
@@ -1113,11 +1397,11 @@ window.vm = new Vue({
           xpath: this.elemXPathLite,
           package: node.package,
           hierarchy: localStorage.xmlHierarchy,
-          screenshot: localStorage.screenshotBase64,
+          screenshot: screenshot,
           windowSize: localStorage.windowSize.split(",").map(v => { return parseInt(v, 10) }),
           activity: localStorage.activity,
         })
-      }).then(ret => {
+      })).then(ret => {
         const code = `d.widget.click("${ret.id}#${ret.note}")`;
         this.codeInsert(code)
         this.nodeSelected = null;
@@ -1187,12 +1471,7 @@ window.vm = new Vue({
       }
       return `d.xpath('${this.elemXPathLite}')`
     },
-    drawAllNodeFromSource: function (source) {
-      let jstreeData = this.sourceToJstree(source);
-      let jstree = this.$jstree.jstree(true);
-      jstree.settings.core.data = jstreeData;
-      jstree.refresh();
-
+    drawAllNodeFromSource: function (source, version) {
       let nodeMaps = this.originNodeMaps = {}
 
       function sourceToNodes(source) {
@@ -1208,6 +1487,16 @@ window.vm = new Vue({
         return nodes;
       }
       this.originNodes = sourceToNodes(source) //ret.nodes;
+
+      // version pins the server side dump the branches are loaded from
+      let jstree = this.$jstree.jstree(true);
+      this.lazyTree = !!version && this.originNodes.length > LAZY_TREE_THRESHOLD;
+      if (this.lazyTree) {
+        jstree.settings.core.data = this.lazyJstreeData(version);
+      } else {
+        jstree.settings.core.data = this.sourceToJstree(source);
+      }
+      jstree.refresh();
       this.drawAllNode();
       this.loading = false;
       this.canvasStyle.opacity = 1.0;
@@ -1470,11 +1759,7 @@ window.vm = new Vue({
           }
           self.generatedCode = generatedCode;
 
-          self.$jstree.jstree("deselect_all");
-          self.$jstree.jstree("close_all");
-          self.$jstree.jstree("select_node", "#" + self.nodeHovered._id);
-          self.$jstree.jstree(true)._open_to("#" + self.nodeHovered._id);
-          document.getElementById(self.nodeHovered._id).scrollIntoView(false);
+          self.revealJstreeNode(self.nodeHovered._id);
         }
         // self.touchDown(0, x / screen.bounds.w, y / screen.bounds.h, pressure);
 
@@ -0,0 +1,8 @@
+# coding: utf-8
+#
+
+import os
+import sys
+
+# the modules under test are imported as web.xxx from the repo root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
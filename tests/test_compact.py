@@ -0,0 +1,58 @@
+# coding: utf-8
+#
+
+import json
+import os
+
+import pytest
+
+from web import uidumplib
+from web.compact import MAGIC, decode_hierarchy, encode_hierarchy
+
+PAGE_XML = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "page.xml")
+
+
+@pytest.fixture(scope="module")
+def hierarchy():
+    with open(PAGE_XML, "rb") as f:
+        page_xml = f.read()
+    return {
+        "xmlHierarchy": page_xml.decode("utf-8"),
+        "jsonHierarchy": uidumplib.android_hierarchy_to_json(page_xml),
+        "activity": ".Launcher",
+        "packageName": "com.huawei.android.launcher",
+        "windowSize": [720, 1280],
+    }
+
+
+def test_round_trip(hierarchy):
+    buf = encode_hierarchy(hierarchy)
+    assert buf.startswith(MAGIC)
+    assert decode_hierarchy(buf) == hierarchy
+
+
+def test_round_trip_values():
+    data = {
+        "windowSize": [1, 2],
+        "jsonHierarchy": {
+            "_id": "0123456789abcdef",
+            "text": "中文",
+            "index": -3,
+            "enabled": False,
+            "rect": {"x": -1, "y": 0, "width": 300, "height": 2**40},
+            "extra": {"a": [1, None]},
+            "children": [{"_id": "not hex", "text": ""}, {"enabled": True}],
+        },
+    }
+    assert decode_hierarchy(encode_hierarchy(data)) == data
+
+
+def test_smaller_than_json(hierarchy):
+    data = dict(hierarchy, xmlHierarchy=None)
+    assert len(encode_hierarchy(data)) < len(json.dumps(data)) / 2
+
+
+def test_bad_magic():
+    with pytest.raises(ValueError):
+        decode_hierarchy(b"JSON{}")
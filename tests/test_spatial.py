@@ -0,0 +1,45 @@
+# coding: utf-8
+#
+
+import time
+
+from web.spatial import GridIndex
+
+
+def _node(name, x, y, width, height):
+    return {"name": name,
+            "rect": {"x": x, "y": y, "width": width, "height": height}}
+
+
+NODES = [
+    (_node("root", 0, 0, 720, 1280), 0),
+    (_node("button", 100, 200, 200, 80), 1),
+    (_node("label", 120, 220, 50, 20), 2),
+]
+
+
+def test_at():
+    index = GridIndex(NODES)
+    assert [n["name"] for n, _ in index.at(130, 230)] == \
+        ["label", "button", "root"]
+    assert [n["name"] for n, _ in index.at(10, 10)] == ["root"]
+    assert index.at(800, 10) == []
+
+
+def test_within():
+    index = GridIndex(NODES)
+    rect = {"x": 90, "y": 190, "width": 300, "height": 100}
+    assert [n["name"] for n, _ in index.within(rect, contain=True)] == \
+        ["label", "button"]
+    assert [n["name"] for n, _ in index.within(rect)] == \
+        ["label", "button", "root"]
+
+
+def test_within_oversized_rect():
+    index = GridIndex(NODES, cell_size=32)
+    rect = {"x": -1e8, "y": -1e8, "width": 2e8, "height": 2e8}
+    start = time.time()
+    assert len(index.within(rect, contain=True)) == 3
+    assert time.time() - start < 0.1
+    far = {"x": 1e8, "y": 1e8, "width": 10, "height": 10}
+    assert index.within(far) == []
@@ -0,0 +1,117 @@
+# coding: utf-8
+#
+
+import pytest
+
+from web import uidumplib
+from web.xpath import XPathError, build_android_tree, select, strict_xpath
+
+PAGE_XML = b"""<?xml version="1.0" ?>
+<hierarchy rotation="0">
+  <node index="0" class="android.widget.FrameLayout" text="" resource-id="" content-desc="" bounds="[0,0][720,1280]" clickable="false" enabled="true" selected="false">
+    <node index="0" class="android.widget.LinearLayout" text="" resource-id="com.example:id/list" content-desc="" bounds="[0,0][720,600]" clickable="false" enabled="true" selected="false">
+      <node index="0" class="android.widget.TextView" text="First" resource-id="com.example:id/title" content-desc="" bounds="[0,0][720,100]" clickable="true" enabled="true" selected="false" />
+      <node index="1" class="android.widget.TextView" text="Second" resource-id="com.example:id/title" content-desc="" bounds="[0,100][720,200]" clickable="true" enabled="false" selected="true" />
+      <node index="2" class="android.widget.Button" text="OK" resource-id="com.example:id/ok" content-desc="confirm" bounds="[0,200][360,300]" clickable="true" enabled="true" selected="false" />
+    </node>
+    <node index="1" class="android.widget.LinearLayout" text="" resource-id="com.example:id/footer" content-desc="" bounds="[0,600][720,1280]" clickable="false" enabled="true" selected="false">
+      <node index="0" class="android.widget.TextView" text="Third" resource-id="com.example:id/title" content-desc="" bounds="[0,600][720,700]" clickable="false" enabled="true" selected="false" />
+      <node index="1" class="android.widget.Button" text="Cancel" resource-id="com.example:id/cancel" content-desc="" bounds="[360,600][720,700]" clickable="true" enabled="true" selected="false" />
+    </node>
+  </node>
+</hierarchy>
+"""
+
+
+@pytest.fixture(scope="module")
+def tree():
+    nodes = []
+    uidumplib.android_hierarchy_to_json(PAGE_XML, None, nodes)
+    return build_android_tree(PAGE_XML, nodes)
+
+
+def texts(tree, xpath):
+    return [n.attrs.get("text") for n in select(tree, xpath)]
+
+
+def test_attribute_predicates(tree):
+    assert texts(tree, '//*[@resource-id="com.example:id/title"]') == [
+        "First", "Second", "Third"
+    ]
+    assert texts(tree, '//android.widget.TextView[@enabled="false"]') == [
+        "Second"
+    ]
+    assert texts(tree, '//*[@clickable="true" and @content-desc="confirm"]') == [
+        "OK"
+    ]
+    assert texts(tree, '//*[@text="OK" or @text="Cancel"]') == ["OK", "Cancel"]
+    assert texts(tree, '//*[contains(@text, "ir")]') == ["First", "Third"]
+    assert texts(tree, '//*[starts-with(@resource-id, "com.example:id/c")]') == [
+        "Cancel"
+    ]
+
+
+def test_positional_predicates(tree):
+    # positions count among the siblings of every parent
+    assert texts(tree, '//android.widget.TextView[1]') == ["First", "Third"]
+    assert texts(tree, '//android.widget.TextView[last()]') == [
+        "Second", "Third"
+    ]
+    assert texts(tree, '//android.widget.LinearLayout/*[last()]') == [
+        "OK", "Cancel"
+    ]
+    assert texts(tree, '//*[@resource-id="com.example:id/list"]/*[position() > 1]') == [
+        "Second", "OK"
+    ]
+
+
+def test_parenthesized_index(tree):
+    # (//x)[n] counts over the whole document, not per parent
+    assert texts(tree, '(//android.widget.TextView)[1]') == ["First"]
+    assert texts(tree, '(//android.widget.TextView)[3]') == ["Third"]
+    assert texts(tree, '(//android.widget.TextView)[last()]') == ["Third"]
+    assert texts(tree, '(//android.widget.TextView)[4]') == []
+
+
+def test_parent_step(tree):
+    parents = select(tree, '//*[@text="Cancel"]/..')
+    assert [n.attrs["resource-id"] for n in parents] == ["com.example:id/footer"]
+    assert texts(tree, '//*[@text="Cancel"]/../*[1]') == ["Third"]
+    assert texts(tree, '//*[@text="First"]/following-sibling::*') == [
+        "Second", "OK"
+    ]
+
+
+def test_nodes_link_to_json(tree):
+    node, = select(tree, '//*[@text="OK"]')
+    assert node.json["text"] == "OK"
+    assert node.json["resourceId"] == "com.example:id/ok"
+
+
+def test_u2_shortcuts(tree):
+    assert texts(tree, "@com.example:id/ok") == ["OK"]
+    assert texts(tree, "Cancel") == ["Cancel"]
+    assert texts(tree, "confirm") == ["OK"]
+    assert texts(tree, "%ir%") == ["First", "OK", "Third"]  # conf-ir-m
+    assert texts(tree, "Sec%") == ["Second"]
+    assert texts(tree, "%cond") == ["Second"]
+    assert texts(tree, "^C.n+") == ["Cancel"]
+
+
+def test_strict_xpath():
+    assert strict_xpath("//a") == "//a"
+    assert strict_xpath("(//a)[2]") == "(//a)[2]"
+    assert strict_xpath("@id/x") == '//*[@resource-id="id/x"]'
+    assert strict_xpath('say "hi"') == (
+        "//*[@text='say \"hi\"' or @content-desc='say \"hi\"' "
+        "or @resource-id='say \"hi\"']")
+
+
+@pytest.mark.parametrize("xpath", [
+    "//*[", "//*[@text=]", "(1 + 2)",
+    "//*[contains(@text)]", "//*[substring(@text)]",
+    '//*[re:match(@text, "(")]',
+])
+def test_errors(tree, xpath):
+    with pytest.raises(XPathError):
+        select(tree, xpath)
@@ -0,0 +1,361 @@
+# coding: utf-8
+#
+# Device actions by name, for running many of them in one request
+#
+# Every action takes the connected device and the same arguments as the
+# query of its single action handler (TapHandler: x, y ...), and returns a
+# dict which has "success". A missing element or a false assertion is a
+# failed step, an exception is a failed step with an error.
+
+import collections
+import inspect
+import math
+import time
+
+from logzero import logger
+
+# seconds a step may wait after it ran
+MAX_DELAY = 60.0
+MAX_STEPS = 200
+
+# devices running a fan-out at the same time, and seconds one may take
+FANOUT_PARALLEL = 8
+FANOUT_TIMEOUT = 60.0
+MAX_FANOUT_TIMEOUT = 600.0
+
+# arguments which are numbers, whatever action they belong to
+NUMBER_PARAMS = {
+    "x": int, "y": int, "x1": int, "y1": int, "x2": int, "y2": int,
+    "index": int, "duration": float, "scale": float, "seconds": float,
+}
+
+
+def number(name: str, value, type=float):
+    """
+    Args:
+        value: a number or a string of one, from a request body
+
+    Raises:
+        ValueError when value is no finite number
+    """
+    try:
+        ret = float(value)
+    except (TypeError, ValueError):
+        ret = None
+    if ret is None or not math.isfinite(ret):
+        raise ValueError("%s should be a number, got %r" % (name, value))
+    return type(ret)
+
+
+class Action(object):
+    def __init__(self, name: str, fn, changes_screen: bool):
+        self.name = name
+        self.fn = fn
+        self.changes_screen = changes_screen
+        self._signature = inspect.signature(fn)
+
+    def check(self, params: dict) -> dict:
+        """
+        Returns:
+            params with the numbers converted, see NUMBER_PARAMS
+
+        Raises:
+            ValueError when params do not fit the action
+        """
+        try:
+            self._signature.bind(None, **params)
+        except TypeError as e:
+            raise ValueError("%s: %s" % (self.name, e))
+        params = dict(params)
+        for name, type in NUMBER_PARAMS.items():
+            if name in params:
+                params[name] = number(name, params[name], type)
+        return params
+
+    def __call__(self, d, **params) -> dict:
+        return self.fn(d, **params)
+
+
+ACTIONS = {}
+
+
+def action(name: str, changes_screen: bool = True):
+    """ registers fn(d, **params) -> dict under name """
+    def decorator(fn):
+        ACTIONS[name] = Action(name, fn, changes_screen)
+        return fn
+
+    return decorator
+
+
+def _not_exists() -> dict:
+    return {"success": False, "msg": "element is not exists"}
+
+
+@action("tap")
+def tap(d, x=0, y=0):
+    d.click(int(x), int(y))
+    return {"success": True}
+
+
+@action("long_tap")
+def long_tap(d, x=0, y=0, duration=0.5):
+    d.long_click(int(x), int(y), float(duration))
+    return {"success": True}
+
+
+@action("swipe")
+def swipe(d, x1=0, y1=0, x2=0, y2=0, duration=0.5):
+    d.swipe(x1, y1, x2, y2, duration)
+    return {"success": True}
+
+
+@action("swipe_ext")
+def swipe_ext(d, direction="up", scale=0.8):
+    d.swipe_ext(direction, scale)
+    return {"success": True}
+
+
+@action("press")
+def press(d, key="back"):
+    d.press(key)
+    return {"success": True}
+
+
+@action("click")
+def click(d, origin, flag, index=0):
+    if d.click_element(origin, flag, index):
+        return {"success": True}
+    return _not_exists()
+
+
+@action("input")
+def input_text(d, origin, flag, index=0, input=""):
+    if d.set_element_text(origin, flag, index, input):
+        return {"success": True}
+    return _not_exists()
+
+
+@action("start_app")
+def start_app(d, package, activity=None):
+    if activity:
+        d.device.app_start(package, activity)
+    else:
+        d.device.app_start(package)
+    return {"success": True}
+
+
+@action("text", changes_screen=False)
+def text(d, origin, flag, index=0):
+    info = d.resolve(origin, flag, index)
+    if info is None:
+        return dict(_not_exists(), text="")
+    return {"success": True, "text": info['text']}
+
+
+@action("exists", changes_screen=False)
+def exists(d, origin, flag, index=0):
+    return {"success": True, "exists": d.resolve(origin, flag, index) is not None}
+
+
+@action("assert_text", changes_screen=False)
+def assert_text(d, origin, flag, target, index=0):
+    info = d.resolve(origin, flag, index)
+    if info is None:
+        return dict(_not_exists(), result=False)
+    result = info['text'] == target
+    return {"success": result, "result": result, "text": info['text']}
+
+
+@action("assert_exists", changes_screen=False)
+def assert_exists(d, origin, flag, target=True, index=0):
+    exists = d.resolve(origin, flag, index) is not None
+    result = str(exists).lower() == str(target).lower()
+    return {"success": result, "result": result, "exists": exists}
+
+
+def _assert_attribute(d, name, origin, flag, target, index):
+    info = d.resolve(origin, flag, index)
+    if info is None:
+        return dict(_not_exists(), result=False)
+    result = str(target).lower() == str(info[name]).lower()
+    return {"success": result, "result": result, name: info[name]}
+
+
+@action("assert_selected", changes_screen=False)
+def assert_selected(d, origin, flag, target=True, index=0):
+    return _assert_attribute(d, "selected", origin, flag, target, index)
+
+
+@action("assert_enabled", changes_screen=False)
+def assert_enabled(d, origin, flag, target=True, index=0):
+    return _assert_attribute(d, "enabled", origin, flag, target, index)
+
+
+@action("current_app", changes_screen=False)
+def current_app(d):
+    current = d.device.app_current()
+    return {
+        "success": True,
+        "activity": current["activity"],
+        "package": current["package"],
+    }
+
+
+@action("window_size", changes_screen=False)
+def window_size(d):
+    width, height = d.device.window_size()
+    return {"success": True, "width": width, "height": height}
+
+
+@action("sleep", changes_screen=False)
+def sleep(d, seconds=1.0):
+    time.sleep(min(MAX_DELAY, float(seconds)))
+    return {"success": True}
+
+
+def parse_steps(steps, delay: float = 0) -> list:
+    """
+    Check a batch before anything runs on the device
+
+    Args:
+        steps: [{"action": "tap", "x": 10, "y": 20, "delay": 0.5}, ...],
+            delay is seconds to wait after the step
+        delay: default delay of the steps
+
+    Returns:
+        [(Action, params, delay), ...]
+
+    Raises:
+        ValueError
+    """
+    if not isinstance(steps, list) or not steps:
+        raise ValueError("steps should be a non empty list")
+    if len(steps) > MAX_STEPS:
+        raise ValueError("at most %d steps in a batch" % MAX_STEPS)
+    parsed = []
+    for i, step in enumerate(steps):
+        if not isinstance(step, dict) or "action" not in step:
+            raise ValueError("step %d has no action" % i)
+        params = dict(step)
+        name = params.pop("action")
+        act = ACTIONS.get(name)
+        if act is None:
+            raise ValueError("step %d: unknown action %r, one of %s" %
+                             (i, name, ", ".join(sorted(ACTIONS))))
+        step_delay = params.pop("delay", delay)
+        try:
+            step_delay = number("delay", step_delay)
+            if not 0 <= step_delay <= MAX_DELAY:
+                raise ValueError("delay should be 0-%g seconds" % MAX_DELAY)
+            params = act.check(params)
+        except ValueError as e:
+            raise ValueError("step %d: %s" % (i, e))
+        parsed.append((act, params, step_delay))
+    return parsed
+
+
+def changes_screen(steps: list) -> bool:
+    """ steps: parse_steps result """
+    return any(act.changes_screen for act, _, _ in steps)
+
+
+def run_batch(d, steps: list, stop_on_failure: bool = True) -> dict:
+    """
+    Run the steps one after another, meant for the device worker so nothing
+    else reaches the device in between
+
+    Args:
+        steps: parse_steps result
+
+    Returns:
+        {"success", "completed", "duration", "steps": [...]}, a step has
+        index, action, state (done, failed or skipped), result, error,
+        start (seconds after the batch started) and duration
+    """
+    start = time.time()
+    results = []
+    failed = False
+    for i, (act, params, delay) in enumerate(steps):
+        if failed and stop_on_failure:
+            results.append({"index": i, "action": act.name, "state": "skipped"})
+            continue
+        step_start = time.time()
+        ret = {"index": i, "action": act.name, "start": step_start - start}
+        try:
+            ret["result"] = act(d, **params)
+            ok = ret["result"].get("success", True)
+        except Exception as e:
+            logger.warning("batch step %d %s failed: %s", i, act.name, e)
+            ret["error"] = str(e) or e.__class__.__name__
+            ok = False
+        ret["duration"] = time.time() - step_start
+        ret["state"] = "done" if ok else "failed"
+        results.append(ret)
+        failed = failed or not ok
+        if delay and i < len(steps) - 1 and not (failed and stop_on_failure):
+            time.sleep(delay)
+    return {
+        "success": not failed,
+        "completed": sum(1 for r in results if r["state"] == "done"),
+        "duration": time.time() - start,
+        "steps": results,
+    }
+
+
+def parse_batch(data) -> tuple:
+    """
+    Args:
+        data: decoded request body, {"steps": [...], "stopOnFailure": true,
+            "delay": 0} or only the list of steps. {"action": {...}} is a
+            batch of one step.
+
+    Returns:
+        (parse_steps result, stop_on_failure)
+
+    Raises:
+        ValueError
+    """
+    if isinstance(data, list):
+        data = {"steps": data}
+    if not isinstance(data, dict):
+        raise ValueError("body should be a list of steps or an object")
+    if "steps" not in data and isinstance(data.get("action"), dict):
+        data = dict(data, steps=[data["action"]])
+    delay = number("delay", data.get("delay", 0))
+    return (parse_steps(data.get("steps"), delay),
+            bool(data.get("stopOnFailure", True)))
+
+
+def parse_fanout(data, connected: list) -> tuple:
+    """
+    Args:
+        data: decoded request body, a batch (see parse_batch) plus
+            "devices": [deviceId, ...] or "all", "parallel" and "timeout"
+        connected: ids of the connected devices, used for "all"
+
+    Returns:
+        (device_ids, parse_batch result, parallel, timeout)
+
+    Raises:
+        ValueError
+    """
+    if not isinstance(data, dict):
+        raise ValueError("body should be an object")
+    devices = data.get("devices", "all")
+    if devices == "all":
+        devices = list(connected)
+    elif not isinstance(devices, list) or not all(
+            isinstance(d, str) for d in devices):
+        raise ValueError("devices should be a list of device ids or \"all\"")
+    # the same device twice would only queue up behind itself
+    devices = list(collections.OrderedDict.fromkeys(devices))
+    if not devices:
+        raise ValueError("no device to run on")
+    parallel = number("parallel", data.get("parallel", FANOUT_PARALLEL), int)
+    if parallel < 1:
+        raise ValueError("parallel should be at least 1")
+    timeout = number("timeout", data.get("timeout", FANOUT_TIMEOUT))
+    if not 0 < timeout <= MAX_FANOUT_TIMEOUT:
+        raise ValueError("timeout should be 0-%g seconds" % MAX_FANOUT_TIMEOUT)
+    return devices, parse_batch(data), parallel, timeout
@@ -0,0 +1,278 @@
+# coding: utf-8
+#
+# Micro benchmark of the hierarchy parsers in uidumplib
+#
+# Synthetic uiautomator xml and WDA json sources of any size are generated,
+# then parsed by every case below. Wall time, peak memory (tracemalloc) and
+# output size are written to a json file, so runs can be compared.
+#
+# Usage:
+#   python -m weditor.web.benchmark --sizes 100,1000,10000 -o bench.json
+
+import argparse
+import gc
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+from . import uidumplib
+
+_ANDROID_CLASSES = [
+    "android.widget.FrameLayout", "android.widget.LinearLayout",
+    "android.widget.RelativeLayout", "android.widget.TextView",
+    "android.widget.ImageView", "android.widget.Button",
+    "androidx.recyclerview.widget.RecyclerView", "android.view.View"
+]
+_IOS_TYPES = [
+    "XCUIElementTypeOther", "XCUIElementTypeStaticText",
+    "XCUIElementTypeButton", "XCUIElementTypeImage", "XCUIElementTypeCell",
+    "XCUIElementTypeTable"
+]
+
+
+def generate_shape(nodes: int, depth: int, fanout: int, seed: int = 0):
+    """
+    Random tree with exactly `nodes` nodes, at most `depth` levels below the
+    root and at most `fanout` children per node
+
+    Returns:
+        list of parent index per node in pre-order, -1 for the root
+    """
+    rnd = random.Random(seed)
+    children = [[]]
+    levels = [0]
+    open_nodes = [0]
+    while len(levels) < nodes:
+        if not open_nodes:
+            raise ValueError("depth %d and fanout %d hold less than %d nodes" %
+                             (depth, fanout, nodes))
+        # prefer recent nodes, which gives deep and bushy trees like real UIs
+        i = len(open_nodes) - 1 - int(rnd.random()**3 * len(open_nodes))
+        parent = open_nodes[i]
+        child = len(levels)
+        children[parent].append(child)
+        children.append([])
+        levels.append(levels[parent] + 1)
+        if len(children[parent]) >= fanout:
+            open_nodes.pop(i)
+        if levels[child] < depth:
+            open_nodes.append(child)
+
+    # renumber in pre-order so output order matches document order
+    parents = []
+    stack = [(0, -1)]
+    while stack:
+        node, parent = stack.pop()
+        index = len(parents)
+        parents.append(parent)
+        for child in reversed(children[node]):
+            stack.append((child, index))
+    return parents
+
+
+def _children_lists(parents):
+    children = [[] for _ in parents]
+    for i, parent in enumerate(parents):
+        if parent >= 0:
+            children[parent].append(i)
+    return children
+
+
+def generate_android_xml(parents: list, seed: int = 0) -> bytes:
+    """ uiautomator dump (pretty printed, like d.dump_hierarchy) of a shape """
+    rnd = random.Random(seed)
+    children = _children_lists(parents)
+    out = ['<?xml version="1.0" ?>\n<hierarchy rotation="0">\n']
+
+    def write_node(i, index, indent):
+        klass = rnd.choice(_ANDROID_CLASSES)
+        x, y = rnd.randrange(0, 1000), rnd.randrange(0, 2000)
+        text = "item %d" % i if rnd.random() < 0.3 else ""
+        clickable = "true" if rnd.random() < 0.3 else "false"
+        out.append(
+            '%s<node index="%d" text="%s" resource-id="com.example.app:id/view_%d"'
+            ' class="%s" package="com.example.app" content-desc="" checkable="false"'
+            ' checked="false" clickable="%s" enabled="true" focusable="%s"'
+            ' focused="false" scrollable="false" long-clickable="false"'
+            ' password="false" selected="false" visible-to-user="true"'
+            ' bounds="[%d,%d][%d,%d]"' %
+            (indent, index, text, i % 97, klass, clickable, clickable, x, y,
+             x + rnd.randrange(1, 400), y + rnd.randrange(1, 300)))
+
+    # iterative, 100k node trees are deeper than the recursion limit allows
+    stack = [(0, 0, 1, False)]
+    while stack:
+        i, index, level, closing = stack.pop()
+        indent = "  " * level
+        if closing:
+            out.append('%s</node>\n' % indent)
+            continue
+        write_node(i, index, indent)
+        if not children[i]:
+            out.append(' />\n')
+            continue
+        out.append('>\n')
+        stack.append((i, index, level, True))
+        for position in reversed(range(len(children[i]))):
+            stack.append((children[i][position], position, level + 1, False))
+    out.append('</hierarchy>\n')
+    return ''.join(out).encode('utf-8')
+
+
+def generate_ios_source(parents: list, seed: int = 0) -> dict:
+    """ WDA source(format='json') of a shape """
+    rnd = random.Random(seed)
+    nodes = []
+    for i, parent in enumerate(parents):
+        x, y = rnd.randrange(0, 400), rnd.randrange(0, 800)
+        label = "item %d" % i if rnd.random() < 0.3 else None
+        node = {
+            "type": rnd.choice(_IOS_TYPES),
+            "name": label,
+            "label": label,
+            "value": None,
+            "isEnabled": "1",
+            "rect": {
+                "x": x,
+                "y": y,
+                "width": rnd.randrange(1, 200),
+                "height": rnd.randrange(1, 100)
+            },
+        }
+        nodes.append(node)
+        if parent >= 0:
+            nodes[parent].setdefault("children", []).append(node)
+    return nodes[0]
+
+
+class StubWDAClient(object):
+    """
+    Stands in for wda.Client in get_ios_hierarchy. Returns a fresh copy per
+    call (it is modified in place), decoded from json like the real client.
+    """
+
+    def __init__(self, source: dict):
+        self._raw = json.dumps(source)
+
+    def source(self, format='json'):
+        return json.loads(self._raw)
+
+
+def _cases(parsers):
+    """ name -> (platform, function(source) -> json hierarchy) """
+    cases = {}
+    for parser in parsers:
+        cases["android-" + parser] = (
+            "android",
+            lambda page_xml, parser=parser: uidumplib.android_hierarchy_to_json(
+                page_xml, parser))
+    cases["android-pruned"] = (
+        "android",
+        lambda page_xml: uidumplib.android_hierarchy_to_json(
+            page_xml,
+            prune=uidumplib.HierarchyPrune(interactable_only=True,
+                                           visible_only=True)))
+    cases["ios"] = ("ios", lambda client: uidumplib.get_ios_hierarchy(client, 2))
+    return cases
+
+
+def measure(fn, source, repeat: int) -> dict:
+    times = []
+    result = None
+    for _ in range(repeat):
+        # garbage of the previous case (minidom leaves a lot) skews timings
+        gc.collect()
+        start = time.perf_counter()
+        result = fn(source)
+        times.append(time.perf_counter() - start)
+
+    # separate run, tracemalloc slows the parser down
+    tracemalloc.start()
+    fn(source)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "wallTime": {
+            "min": min(times),
+            "median": statistics.median(times),
+        },
+        "peakMemory": peak,
+        "outputSize": len(json.dumps(result)),
+    }
+
+
+def run(sizes, depth=25, fanout=12, repeat=3, parsers=("expat", "minidom"),
+        seed=0) -> dict:
+    """
+    Returns:
+        {"meta": {...}, "results": [{"case", "nodes", "inputSize", ...}]}
+    """
+    results = []
+    cases = _cases(parsers)
+    for size in sizes:
+        parents = generate_shape(size, depth, fanout, seed)
+        sources = {
+            "android": generate_android_xml(parents, seed),
+            "ios": StubWDAClient(generate_ios_source(parents, seed)),
+        }
+        input_sizes = {
+            "android": len(sources["android"]),
+            "ios": len(sources["ios"]._raw),
+        }
+        for name, (platform_name, fn) in cases.items():
+            ret = measure(fn, sources[platform_name], repeat)
+            ret.update({
+                "case": name,
+                "nodes": size,
+                "inputSize": input_sizes[platform_name],
+            })
+            results.append(ret)
+            print("%-16s %7d nodes  %8.1f ms  %8.1f MiB peak  %9d bytes" %
+                  (name, size, ret["wallTime"]["min"] * 1000,
+                   ret["peakMemory"] / 1024 / 1024, ret["outputSize"]))
+    return {
+        "meta": {
+            "python": sys.version,
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "depth": depth,
+            "fanout": fanout,
+            "repeat": repeat,
+            "seed": seed,
+        },
+        "results": results,
+    }
+
+
+def main():
+    # yapf: disable
+    ap = argparse.ArgumentParser(
+        description="benchmark of the hierarchy parsers",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    ap.add_argument("--sizes", default="100,1000,10000,100000", help="comma separated node counts")
+    ap.add_argument("--depth", type=int, default=25, help="max levels below the root")
+    ap.add_argument("--fanout", type=int, default=12, help="max children of a node")
+    ap.add_argument("--repeat", type=int, default=3, help="timed runs per case, the best is reported")
+    ap.add_argument("--parsers", default="expat,minidom", help="android parsers to compare")
+    ap.add_argument("--seed", type=int, default=0, help="random seed of the generators")
+    ap.add_argument("-o", "--output", default="benchmark.json", help="result file")
+    args = ap.parse_args()
+    # yapf: enable
+
+    ret = run([int(n) for n in args.sizes.split(",")],
+              depth=args.depth,
+              fanout=args.fanout,
+              repeat=args.repeat,
+              parsers=args.parsers.split(","),
+              seed=args.seed)
+    with open(args.output, "w") as f:
+        json.dump(ret, f, indent=2)
+    print("results written to", args.output)
+
+
+if __name__ == "__main__":
+    main()
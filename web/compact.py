@@ -0,0 +1,243 @@
+# coding: utf-8
+#
+# Compact binary encoding of a dump_hierarchy2 result
+#
+# The tree is stored column by column instead of node by node: every string
+# value goes to a string table once, rects are four integer columns, and
+# booleans are packed into bitsets. static/js/compact.js decodes it back to
+# the same object the json api returns.
+#
+# Layout, integers are LEB128 varints unless noted:
+#   magic      b"WEH" + format version byte
+#   meta       varint length + utf-8 json, every key except jsonHierarchy
+#   count      number of nodes N, in document (pre-order) order
+#   strings    varint count, then (varint byte length, utf-8 bytes) each
+#   parents    N varints, i - parent index (0 for the root)
+#   columns    varint count, then for every column:
+#                varint key (string index), u8 kind,
+#                presence bitset of N bits, values of the present nodes
+#
+# Bitsets are LSB first, padded to whole bytes.
+
+import json
+
+MAGIC = b"WEH\x01"
+CONTENT_TYPE = "application/x-weditor-hierarchy"
+
+KIND_BOOL = 0  # bitset
+KIND_INT = 1  # zigzag varint
+KIND_STR = 2  # string index
+KIND_JSON = 3  # string index of the json text, for anything else
+KIND_RECT = 4  # x, y, width, height as zigzag varints
+KIND_HEXID = 5  # 16 hex digits as 8 raw bytes
+KIND_CHILDREN = 6  # presence only, node has a "children" list
+
+
+def _varint(out: bytearray, n: int):
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _zigzag(n: int) -> int:
+    return n * 2 if n >= 0 else -n * 2 - 1
+
+
+def _bitset(bits) -> bytes:
+    out = bytearray((len(bits) + 7) // 8)
+    for i, bit in enumerate(bits):
+        if bit:
+            out[i >> 3] |= 1 << (i & 7)
+    return bytes(out)
+
+
+def _is_hexid(v) -> bool:
+    if not isinstance(v, str) or len(v) != 16:
+        return False
+    try:
+        bytes.fromhex(v)
+    except ValueError:
+        return False
+    return True
+
+
+def _value_kind(key, v):
+    if key == 'rect' and isinstance(v, dict) and set(v) == {
+            'x', 'y', 'width', 'height'} and all(
+                type(n) is int for n in v.values()):
+        return KIND_RECT
+    if key == '_id' and _is_hexid(v):
+        return KIND_HEXID
+    if type(v) is bool:
+        return KIND_BOOL
+    if type(v) is int:
+        return KIND_INT
+    if type(v) is str:
+        return KIND_STR
+    return KIND_JSON
+
+
+def _flatten(root):
+    nodes = []
+    parents = []
+    stack = [(root, -1)]
+    while stack:
+        node, parent = stack.pop()
+        index = len(nodes)
+        nodes.append(node)
+        parents.append(parent)
+        for child in reversed(node.get('children') or []):
+            stack.append((child, index))
+    return nodes, parents
+
+
+def encode_hierarchy(data: dict) -> bytes:
+    """
+    Args:
+        data: dump_hierarchy2 result
+
+    Returns:
+        bytes, see the layout at the top of this module
+    """
+    nodes, parents = _flatten(data["jsonHierarchy"])
+    count = len(nodes)
+
+    strings = {}
+
+    def intern(s):
+        index = strings.get(s)
+        if index is None:
+            index = strings[s] = len(strings)
+        return index
+
+    # one column per (key, kind); a key whose values change type gets one
+    # column per type, which the decoder merges back
+    columns = {}
+    for i, node in enumerate(nodes):
+        for key, v in node.items():
+            if key == 'children':
+                kind = KIND_CHILDREN
+            else:
+                kind = _value_kind(key, v)
+            column = columns.get((key, kind))
+            if column is None:
+                column = columns[(key, kind)] = ([False] * count, [])
+            column[0][i] = True
+            column[1].append(v)
+
+    body = bytearray()
+    _varint(body, len(columns))
+    for (key, kind), (present, values) in columns.items():
+        _varint(body, intern(key))
+        body.append(kind)
+        body += _bitset(present)
+        if kind == KIND_BOOL:
+            body += _bitset(values)
+        elif kind == KIND_INT:
+            for v in values:
+                _varint(body, _zigzag(v))
+        elif kind == KIND_STR:
+            for v in values:
+                _varint(body, intern(v))
+        elif kind == KIND_JSON:
+            for v in values:
+                _varint(body, intern(json.dumps(v)))
+        elif kind == KIND_RECT:
+            for v in values:
+                for n in (v['x'], v['y'], v['width'], v['height']):
+                    _varint(body, _zigzag(n))
+        elif kind == KIND_HEXID:
+            for v in values:
+                body += bytes.fromhex(v)
+
+    out = bytearray(MAGIC)
+    meta = json.dumps({
+        k: v
+        for k, v in data.items() if k != "jsonHierarchy"
+    }).encode('utf-8')
+    _varint(out, len(meta))
+    out += meta
+    _varint(out, count)
+    _varint(out, len(strings))
+    for s in strings:  # dict keeps insertion order, which is the index
+        raw = s.encode('utf-8')
+        _varint(out, len(raw))
+        out += raw
+    for i, parent in enumerate(parents):
+        _varint(out, 0 if parent < 0 else i - parent)
+    out += body
+    return bytes(out)
+
+
+class _Reader(object):
+    def __init__(self, buf: bytes):
+        self.buf = buf
+        self.pos = 0
+
+    def varint(self) -> int:
+        n = shift = 0
+        while True:
+            b = self.buf[self.pos]
+            self.pos += 1
+            n |= (b & 0x7f) << shift
+            if b < 0x80:
+                return n
+            shift += 7
+
+    def zigzag(self) -> int:
+        n = self.varint()
+        return n >> 1 if not n & 1 else -(n >> 1) - 1
+
+    def take(self, size: int) -> bytes:
+        ret = self.buf[self.pos:self.pos + size]
+        self.pos += size
+        return ret
+
+    def bitset(self, size: int) -> list:
+        raw = self.take((size + 7) // 8)
+        return [bool(raw[i >> 3] >> (i & 7) & 1) for i in range(size)]
+
+
+def decode_hierarchy(buf: bytes) -> dict:
+    """ inverse of encode_hierarchy, mirrors static/js/compact.js """
+    if buf[:4] != MAGIC:
+        raise ValueError("Not a compact hierarchy")
+    r = _Reader(buf)
+    r.pos = 4
+    data = json.loads(r.take(r.varint()).decode('utf-8'))
+    count = r.varint()
+    strings = [r.take(r.varint()).decode('utf-8') for _ in range(r.varint())]
+    nodes = [{} for _ in range(count)]
+    parents = [i - r.varint() for i in range(count)]
+
+    for _ in range(r.varint()):
+        key = strings[r.varint()]
+        kind = r.take(1)[0]
+        present = [i for i, bit in enumerate(r.bitset(count)) if bit]
+        if kind == KIND_BOOL:
+            values = r.bitset(len(present))
+        elif kind == KIND_INT:
+            values = [r.zigzag() for _ in present]
+        elif kind == KIND_STR:
+            values = [strings[r.varint()] for _ in present]
+        elif kind == KIND_JSON:
+            values = [json.loads(strings[r.varint()]) for _ in present]
+        elif kind == KIND_RECT:
+            values = [
+                dict(x=r.zigzag(), y=r.zigzag(), width=r.zigzag(),
+                     height=r.zigzag()) for _ in present
+            ]
+        elif kind == KIND_HEXID:
+            values = [r.take(8).hex() for _ in present]
+        elif kind == KIND_CHILDREN:
+            values = [[] for _ in present]
+        else:
+            raise ValueError("Unknown column kind", kind)
+        for i, v in zip(present, values):
+            nodes[i][key] = v
+
+    for i in range(1, count):
+        nodes[parents[i]]['children'].append(nodes[i])
+    data["jsonHierarchy"] = nodes[0] if nodes else None
+    return data
@@ -2,13 +2,83 @@
 #
 
 import abc
+import collections
+import functools
+import io
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
 import uiautomator2 as u2
 import wda
 from logzero import logger
 from PIL import Image
+from uiautomator2.exceptions import UiObjectNotFoundError
 
-from . import uidumplib
+from . import imageutils, tiles, uidumplib
+from .devicepool import ConnectTask, DevicePool, DeviceUnavailableError
+from .history import FrameHistory
+from .screenstream import ScreenStream
+from .snapshot import HierarchySnapshot, SnapshotCache
+
+# seconds a hierarchy dump is shared between callers
+SNAPSHOT_MAX_AGE = 0.5
+
+# answer element queries (text, exists, ...) from the cached hierarchy by
+# default, instead of asking the device
+SNAPSHOT_QUERY = False
+
+# keep the minicap stream of android devices open after connect, screenshots
+# are then served from its latest frame
+SCREEN_STREAM = False
+
+# device calls of capture_snapshot which run side by side on one device, and
+# seconds to wait for all of them
+CAPTURE_PARTS = 4
+CAPTURE_TIMEOUT = 30.0
+
+
+_rpc_local = threading.local()
+
+
+def _rpc(fn=None, calls: int = 1):
+    """
+    Marks a device method which makes `calls` round-trips to the device, so
+    jobs run through count_rpc can report how many they made
+    """
+    if fn is None:
+        return lambda fn: _rpc(fn, calls)
+
+    @functools.wraps(fn)
+    def inner(*args, **kwargs):
+        _add_rpc(fn.__name__, calls)
+        return fn(*args, **kwargs)
+
+    return inner
+
+
+def _add_rpc(name: str, calls: int = 1):
+    """ count round-trips made inside a method, when _rpc can not tell """
+    counter = getattr(_rpc_local, "counter", None)
+    if counter is not None:
+        counter[name] = counter.get(name, 0) + calls
+
+
+def count_rpc(fn, counter: dict):
+    """
+    Returns:
+        fn wrapped to add the _rpc calls it makes to counter, name -> calls
+    """
+    @functools.wraps(fn)
+    def job(*args, **kwargs):
+        _rpc_local.counter = counter
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _rpc_local.counter = None
+
+    return job
 
 
 class DeviceMeta(metaclass=abc.ABCMeta):
@@ -16,9 +86,20 @@ class DeviceMeta(metaclass=abc.ABCMeta):
     def screenshot(self) -> Image.Image:
         pass
 
+    def screenshot_raw(self) -> bytes:
+        pass
+
     def dump_hierarchy(self) -> str:
         pass
 
+    def capture_parts(self) -> dict:
+        """ name -> callable, the independent device calls of a snapshot """
+        pass
+
+    def hierarchy_from_parts(self, parts: dict, nodes=None) -> dict:
+        """ dump_hierarchy2 result made of capture_parts results """
+        pass
+
     @abc.abstractproperty
     def device(self):
         pass
@@ -30,29 +111,75 @@ class _AndroidDevice(DeviceMeta):
         # 登陆界面无法截图，就先返回空图片
         d.settings["fallback_to_blank_screenshot"] = True
         self._d = d
+        self._identity = None
 
+    @_rpc
     def screenshot(self):
         return self._d.screenshot()
 
+    @_rpc
+    def screenshot_raw(self) -> bytes:
+        """ encoded image as sent by the device (jpeg), without decoding """
+        return self._d.screenshot(format='raw')
+
+    @_rpc
     def dump_hierarchy(self):
         return uidumplib.get_android_hierarchy(self._d)
 
-    def dump_hierarchy2(self):
+    @_rpc(calls=3)
+    def dump_hierarchy2(self, parser=None, nodes=None, prune=None):
         current = self._d.app_current()
         page_xml = self._d.dump_hierarchy(pretty=True)
+        window_size = self._d.window_size()
+        if prune is not None and prune.screen is None:
+            prune.screen = window_size
         page_json = uidumplib.android_hierarchy_to_json(
-            page_xml.encode('utf-8'))
+            page_xml.encode('utf-8'), parser, nodes, prune)
         return {
             "xmlHierarchy": page_xml,
             "jsonHierarchy": page_json,
             "activity": current['activity'],
             "packageName": current['package'],
-            "windowSize": self._d.window_size(),
+            "windowSize": window_size,
+        }
+
+    def capture_parts(self) -> dict:
+        return {
+            "screenshot": self.screenshot_raw,
+            "hierarchy": lambda: self._d.dump_hierarchy(pretty=True),
+            "app": self._d.app_current,
+            "windowSize": self._d.window_size,
+        }
+
+    def hierarchy_from_parts(self, parts: dict, nodes=None) -> dict:
+        page_xml = parts["hierarchy"]
+        return {
+            "xmlHierarchy": page_xml,
+            "jsonHierarchy": uidumplib.android_hierarchy_to_json(
+                page_xml.encode('utf-8'), nodes=nodes),
+            "activity": parts["app"]['activity'],
+            "packageName": parts["app"]['package'],
+            "windowSize": parts["windowSize"],
         }
     
+    @_rpc
     def device_info(self):
-        return self._d.device_info
-        
+        """ read from the device every time, battery and display change """
+        info = self._d.device_info
+        self._identity = {
+            "serial": info["serial"],
+            "model": info["model"],
+            "sdk": info["sdk"],
+        }
+        return info
+
+    @property
+    def identity(self) -> dict:
+        """ serial, model and sdk, fetched once per connection """
+        if self._identity is None:
+            self.device_info()
+        return self._identity
+
     def weight(self, classify, value,index):
         if classify == 'text':
             element = self._d(text=value, instance = index)
@@ -66,25 +193,87 @@ class _AndroidDevice(DeviceMeta):
             element = self._d(className=value, instance = index)
         return element
 
+    @_rpc
+    def resolve(self, classify, value, index):
+        """
+        Find an element and read its info in one round-trip
+
+        Returns:
+            element info dict, None when it does not exist
+        """
+        if classify == 'xpath':
+            # one dump, the info of a match is read from it
+            elements = self._d.xpath(value).all()
+            return elements[0].info if elements else None
+        try:
+            return self.weight(classify, value, index).info
+        except UiObjectNotFoundError:
+            return None
+
+    def click_element(self, classify, value, index) -> bool:
+        """
+        Returns:
+            False when the element does not exist
+        """
+        info = self.resolve(classify, value, index)
+        if info is None:
+            return False
+        bounds = info['bounds']
+        self.click((bounds['left'] + bounds['right']) // 2,
+                   (bounds['top'] + bounds['bottom']) // 2)
+        return True
+
+    def set_element_text(self, classify, value, index, text) -> bool:
+        """
+        Returns:
+            False when the element does not exist
+        """
+        name = "set_element_text"
+        element = self.weight(classify, value, index)
+        if classify == 'xpath':
+            _add_rpc(name)  # a dump
+            if not element.exists:
+                return False
+            _add_rpc(name, 3)  # another dump, a click and the keys
+            element.set_text(text)
+            return True
+        try:
+            # timeout 0 checks existence without waiting for the element
+            _add_rpc(name, 2)
+            element.set_text(text, timeout=0)
+            return True
+        except UiObjectNotFoundError:
+            return False
+
     def serial(self):
-        return self._d.device_info["serial"]
+        return self.identity["serial"]
 
+    @_rpc
+    def ping(self):
+        """ liveness probe """
+        self._d.info
+
+    @_rpc
     def swipe(self, x1, y1, x2, y2, duration):
         return self._d.swipe(int(x1), int(y1), int(x2), int(y2), float(duration))
         
-
+    @_rpc
     def press(self, key):
         self._d.press(key)
     
+    @_rpc
     def long_click(self, x, y, duration):
         self._d.long_click(int(x), int(y), float(duration))
 
+    @_rpc
     def click(self, x, y):
         self._d.click(int(x), int(y))
 
+    @_rpc
     def swipe_ext(self, direction, scaleNum):
          self._d.swipe_ext(direction, scale = float(scaleNum))
 
+    @_rpc
     def shell(self, command):
         output, exit_code = self._d.shell(command, timeout=60)
         return {
@@ -117,15 +306,53 @@ class _AppleDevice(DeviceMeta):
             import tidevice
             return tidevice.Device().screenshot()
 
+    def screenshot_raw(self) -> bytes:
+        """ encoded image as sent by WDA (png), without decoding """
+        try:
+            return self._client.screenshot(format='raw')
+        except:
+            buffer = io.BytesIO()
+            self.screenshot().save(buffer, format='PNG')
+            return buffer.getvalue()
+
     def dump_hierarchy(self):
         return uidumplib.get_ios_hierarchy(self._client, self.__scale)
 
-    def dump_hierarchy2(self):
+    def ping(self):
+        """ liveness probe """
+        self._client.status()
+
+    def dump_hierarchy2(self, parser=None, nodes=None, prune=None):
+        window_size = self._client.window_size()
+        if prune is not None and prune.screen is None:
+            # rects are scaled to pixels, window_size is in points
+            prune.screen = (window_size[0] * self.__scale,
+                            window_size[1] * self.__scale)
+        return {
+            "jsonHierarchy":
+            uidumplib.get_ios_hierarchy(self._client, self.__scale, nodes,
+                                        prune),
+            "windowSize":
+            window_size,
+        }
+
+    def capture_parts(self) -> dict:
+        return {
+            "screenshot": self.screenshot_raw,
+            "hierarchy": lambda: self._client.source(format='json'),
+            "app": self._client.app_current,
+            "windowSize": self._client.window_size,
+        }
+
+    def hierarchy_from_parts(self, parts: dict, nodes=None) -> dict:
         return {
             "jsonHierarchy":
-            uidumplib.get_ios_hierarchy(self._client, self.__scale),
+            uidumplib.ios_source_to_json(parts["hierarchy"], self.__scale,
+                                         nodes),
+            "packageName":
+            parts["app"].get("bundleId"),
             "windowSize":
-            self._client.window_size(),
+            parts["windowSize"],
         }
 
     @property
@@ -133,55 +360,544 @@ class _AppleDevice(DeviceMeta):
         return self._client
 
 
-cached_devices = {}
+class DeviceExecutor(object):
+    """
+    A single worker thread owned by one device.
+
+    Jobs of the same device run one after another in submit order, while
+    every device has its own thread so a slow device never blocks others.
+    """
 
+    def __init__(self, device_id: str):
+        self._device_id = device_id
+        self._pool = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="device-" + device_id)
+        # device calls a job runs side by side, see submit_part
+        self._parts = ThreadPoolExecutor(
+            max_workers=CAPTURE_PARTS, thread_name_prefix="parts-" + device_id)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._running = False
+        self._jobs = 0
+        self._wait_last = 0.0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        submit_time = time.time()
+        with self._lock:
+            self._pending += 1
+
+        def job():
+            wait = time.time() - submit_time
+            with self._lock:
+                self._running = True
+                self._jobs += 1
+                self._wait_last = wait
+                self._wait_total += wait
+                self._wait_max = max(self._wait_max, wait)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._running = False
+                    self._pending -= 1
+
+        def on_done(f):
+            # a job cancelled while queued never runs to count itself done
+            if f.cancelled():
+                with self._lock:
+                    self._pending -= 1
+
+        future = self._pool.submit(job)
+        future.add_done_callback(on_done)
+        return future
+
+    def submit_part(self, fn, *args, **kwargs) -> Future:
+        """
+        run fn(*args, **kwargs) next to the job running on the worker, which
+        waits for it. A device hanging on such calls holds only its own
+        threads.
+        """
+        return self._parts.submit(fn, *args, **kwargs)
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            queue depth and wait time (seconds) of this device
+        """
+        with self._lock:
+            return {
+                "deviceId": self._device_id,
+                "queueDepth": self._pending - int(self._running),
+                "running": self._running,
+                "jobs": self._jobs,
+                "lastWait": self._wait_last,
+                "avgWait": self._wait_total / self._jobs if self._jobs else 0.0,
+                "maxWait": self._wait_max,
+            }
 
-def connect_device(platform, device_url):
+    def shutdown(self, wait=False):
+        self._pool.shutdown(wait=wait)
+        self._parts.shutdown(wait=wait)
+
+
+device_executors = {}
+hierarchy_caches = {}
+screen_streams = {}
+frame_histories = {}
+# connect id -> devicepool.ConnectTask, the most recent ones
+connect_tasks = collections.OrderedDict()
+MAX_CONNECT_TASKS = 64
+# device_id -> (name, time it finished) of the recent actions, frames are
+# tagged with the last one before them
+last_actions = {}
+_executors_lock = threading.Lock()
+
+
+def make_device_id(platform, device_url):
+    if not len(device_url) == 0:
+        return platform + ":" + device_url
+    return platform
+
+
+def get_executor(device_id) -> DeviceExecutor:
+    with _executors_lock:
+        executor = device_executors.get(device_id)
+        if executor is None:
+            executor = device_executors[device_id] = DeviceExecutor(device_id)
+        return executor
+
+
+def submit(device_id, fn, *args, **kwargs) -> Future:
+    """ run fn(*args, **kwargs) on the worker thread of device_id """
+    return get_executor(device_id).submit(fn, *args, **kwargs)
+
+
+def submit_device(device_id, fn, *args, **kwargs) -> Future:
+    """ run fn(d, *args, **kwargs) on the worker, d is the connected device """
+    def job():
+        return fn(get_device(device_id), *args, **kwargs)
+
+    return submit(device_id, job)
+
+
+def submit_action(device_id, fn, *args, **kwargs) -> Future:
+    """ like submit_device, for jobs that change the screen """
+    cache = get_hierarchy_cache(device_id)
+    cache.invalidate()
+    name = getattr(fn, "__name__", None)
+    future = submit_device(device_id, fn, *args, **kwargs)
+
+    def on_done(f):
+        if f.cancelled():
+            return  # dropped from the queue, it never ran
+        with _executors_lock:
+            actions = last_actions.get(device_id)
+            if actions is None:
+                actions = last_actions[device_id] = collections.deque(
+                    maxlen=16)
+            actions.append((name, time.time()))
+        cache.invalidate()
+
+    future.add_done_callback(on_done)
+    return future
+
+
+def get_hierarchy_cache(device_id) -> SnapshotCache:
+    with _executors_lock:
+        cache = hierarchy_caches.get(device_id)
+        if cache is None:
+            cache = hierarchy_caches[device_id] = SnapshotCache()
+        return cache
+
+
+def find_frame_history(device_id) -> FrameHistory:
     """
     Returns:
-        deviceId (string)
+        FrameHistory of a device which has one or is connected, else None
     """
-    if not len(device_url) == 0:
-        device_id = platform + ":" + device_url
-    else:
-        device_id = platform
-    # device_id = platform + ":" + device_url
+    with _executors_lock:
+        history = frame_histories.get(device_id)
+    if history is None and device_id in cached_devices:
+        history = get_frame_history(device_id)
+    return history
+
+
+def get_frame_history(device_id) -> FrameHistory:
+    with _executors_lock:
+        history = frame_histories.get(device_id)
+        if history is None:
+            history = frame_histories[device_id] = FrameHistory()
+        return history
+
+
+def last_action(device_id, before: float = None) -> tuple:
+    """
+    Returns:
+        (name, time it finished) of the last action which finished before
+        the given time, (None, None) when there is none
+    """
+    with _executors_lock:
+        actions = list(last_actions.get(device_id, ()))
+    for name, finished in reversed(actions):
+        if before is None or finished <= before:
+            return name, finished
+    return None, None
+
+
+def record_frame(device_id, data: bytes, source: str = None,
+                 timestamp: float = None) -> Future:
+    """
+    Add a screenshot to the history of the device, on the image pool so
+    the caller does not wait for a conversion
+
+    Returns:
+        Future of history.HistoryFrame or None
+    """
+    timestamp = timestamp or time.time()
+    action, action_time = last_action(device_id, timestamp)
+    return imageutils.submit(get_frame_history(device_id).add, data, timestamp,
+                             source, action, action_time)
+
+
+def dump_hierarchy_cached(device_id, max_age=None) -> Future:
+    """
+    Returns:
+        Future of snapshot.HierarchySnapshot, concurrent callers share one dump
+    """
+    if max_age is None:
+        max_age = SNAPSHOT_MAX_AGE
+
+    return get_hierarchy_cache(device_id).get(
+        lambda: submit_device(device_id, _dump_snapshot), max_age)
+
+
+def _dump_snapshot(d) -> HierarchySnapshot:
+    start_time = time.time()
+    nodes = []
+    return HierarchySnapshot(d.dump_hierarchy2(nodes=nodes), nodes, start_time)
+
+
+def capture_snapshot(device_id) -> Future:
+    """
+    Screenshot, hierarchy, current app and window size of one moment. It is
+    a single job on the device worker so no action lands in between, and
+    the device calls inside it run concurrently. The hierarchy is added to
+    the hierarchy cache.
+
+    Returns:
+        Future of dict {"screenshot": bytes, "frameSource": "stream" or
+        "device", "snapshot": HierarchySnapshot, "timings": {part: seconds}}
+    """
+    cache = get_hierarchy_cache(device_id)
+    requested = time.time()
+
+    def timed(fn):
+        start = time.time()
+        return fn(), time.time() - start
+
+    def capture(d):
+        start_time = time.time()
+        generation = cache.generation
+        parts = d.capture_parts()
+        frame_source = "device"
+        timings = {}
+        results = {}
+        frame = latest_frame(device_id)
+        # a stream frame from before the last action shows another screen
+        # than the hierarchy dumped now
+        if frame is not None and frame.timestamp > max(
+                requested, last_action(device_id)[1] or 0):
+            frame_source = "stream"
+            results["screenshot"] = frame.data
+            timings["screenshot"] = 0.0
+            del parts["screenshot"]
+        executor = get_executor(device_id)
+        futures = {
+            name: executor.submit_part(timed, fn)
+            for name, fn in parts.items()
+        }
+        deadline = start_time + CAPTURE_TIMEOUT
+        for name, future in futures.items():
+            try:
+                results[name], timings[name] = future.result(
+                    max(0, deadline - time.time()))
+            except FutureTimeoutError:
+                for f in futures.values():
+                    f.cancel()
+                raise EnvironmentError("%s of %s took more than %gs" %
+                                       (name, device_id, CAPTURE_TIMEOUT))
+
+        nodes = []
+        data, timings["parse"] = timed(
+            lambda: d.hierarchy_from_parts(results, nodes))
+        snapshot = HierarchySnapshot(data, nodes, start_time)
+        cache.add(snapshot, generation)
+        timings["total"] = time.time() - start_time
+        return {
+            "screenshot": results["screenshot"],
+            "frameSource": frame_source,
+            "snapshot": snapshot,
+            "timings": timings,
+        }
+
+    return submit_device(device_id, capture)
+
+
+def find_snapshot(device_id, version):
+    """
+    Returns:
+        recent snapshot.HierarchySnapshot of the device with this version,
+        None when it is not kept any more
+    """
+    return get_hierarchy_cache(device_id).find(version)
+
+
+def screen_stream_url(device_id):
+    """
+    Returns:
+        ws://.../minicap of a connected android device, None otherwise
+    """
+    d = cached_devices.get(device_id)
+    if not isinstance(d, _AndroidDevice):
+        return None
+    return d.device.address.replace("http://", "ws://") + "/minicap"
+
+
+def start_screen_stream(device_id, persistent=False) -> ScreenStream:
+    """
+    Start consuming the minicap stream of the device, must be called on the
+    IOLoop. Does nothing when it is already running.
+
+    Args:
+        persistent: keep it running when no viewer is left, for --screen-stream
+            and connects which ask for it. Otherwise the last viewer leaving
+            stops it, see leave_screen_stream.
+
+    Returns:
+        ScreenStream or None when the device has no stream
+    """
+    stream = screen_streams.get(device_id)
+    url = screen_stream_url(device_id)
+    if stream is not None:
+        if stream.url == url:
+            stream.persistent = stream.persistent or persistent
+            return stream
+        stream.stop()  # reconnected to another address
+    if url is None:
+        return None
+    stream = screen_streams[device_id] = ScreenStream(url)
+    stream.persistent = persistent
+    stream.start()
+    return stream
+
+
+def leave_screen_stream(device_id, stream: ScreenStream, viewer):
+    """ unsubscribe viewer, and stop the stream when it became idle """
+    stream.unsubscribe(viewer)
+    if stream.idle and screen_streams.get(device_id) is stream:
+        logger.info("screen stream of %s has no viewer left", device_id)
+        stop_screen_stream(device_id)
+
+
+def stop_screen_stream(device_id):
+    stream = screen_streams.pop(device_id, None)
+    if stream is not None:
+        stream.stop()
+
+
+def latest_frame(device_id):
+    """
+    Returns:
+        screenstream.Frame of the current screen, None when the stream is down
+    """
+    stream = screen_streams.get(device_id)
+    return stream.latest() if stream else None
+
+
+def device_stats(device_id) -> dict:
+    """ worker queue and hierarchy cache counters of one device """
+    with _executors_lock:
+        executor = device_executors.get(device_id)
+        cache = hierarchy_caches.get(device_id)
+    if executor is None:
+        return None
+    ret = executor.stats()
+    ret["hierarchyCache"] = cache.stats() if cache else None
+    stream = screen_streams.get(device_id)
+    ret["screenStream"] = stream.stats() if stream else None
+    history = frame_histories.get(device_id)
+    ret["history"] = history.stats() if history else None
+    ret["connection"] = connection_state(device_id)
+    return ret
+
+
+def executor_stats():
+    with _executors_lock:
+        device_ids = list(device_executors)
+    return [device_stats(device_id) for device_id in device_ids]
+
+
+def _create_device(platform, device_url):
     if platform == 'android':
-        d = _AndroidDevice(device_url)
+        return _AndroidDevice(device_url)
     elif platform == 'ios':
-        d = _AppleDevice(device_url)
-    else:
-        raise ValueError("Unknown platform", platform)
+        return _AppleDevice(device_url)
+    raise ValueError("Unknown platform", platform)
+
+
+def _device_evicted(device_id):
+    stop_screen_stream(device_id)
+    tiles.drop_frames(device_id)
+    with _executors_lock:
+        hierarchy_caches.pop(device_id, None)
+        executor = device_executors.pop(device_id, None)
+    if executor is not None:
+        # queued jobs still run, then the worker thread exits
+        executor.shutdown(wait=False)
+
+
+def _screen_watched(device_id) -> bool:
+    stream = screen_streams.get(device_id)
+    return stream is not None and not stream.idle
+
+
+# connected devices, see devicepool.DevicePool
+cached_devices = DevicePool(_create_device, lambda d: d.ping(),
+                            _device_evicted, _screen_watched)
+
+
+def connect_device(platform, device_url):
+    """
+    Connect, or join a connect in progress. A healthy connection is reused.
 
-    cached_devices[device_id] = d
+    Returns:
+        deviceId (string)
+    """
+    device_id = make_device_id(platform, device_url)
+    cached_devices.connect(device_id, platform, device_url)
     return device_id
 
 
 def get_device(id):
-    d = cached_devices.get(id)
-    if d is None:
-        # platform, uri = id.split(":", maxsplit=1)
-        if id.find(":")!=-1:
-            platform, uri = id.split(":", maxsplit=1)
+    """
+    Raises:
+        DeviceUnavailableError when the device is down
+    """
+    platform, uri = _parse_device_id(id)
+    return cached_devices.get_device(id, platform, uri)
+
+
+def _parse_device_id(device_id):
+    """ "android:10.0.0.2" -> ("android", "10.0.0.2"), "ios" -> ("ios", "") """
+    if device_id.find(":") != -1:
+        platform, uri = device_id.split(":", maxsplit=1)
+        return platform, uri
+    return device_id, ""
+
+
+def start_connect(platform, device_url, prime=True,
+                  on_done=None) -> ConnectTask:
+    """
+    Connect in the background on the device worker. A new connection is
+    primed after that: device info, window size and a first hierarchy
+    snapshot are loaded so the first requests find them cached.
+
+    Args:
+        on_done: called with the task once it finished, on the worker thread
+
+    Returns:
+        devicepool.ConnectTask, also found by get_connect_task
+    """
+    device_id = make_device_id(platform, device_url)
+    task = ConnectTask(device_id, platform)
+    with _executors_lock:
+        connect_tasks[task.id] = task
+        while len(connect_tasks) > MAX_CONNECT_TASKS:
+            connect_tasks.popitem(last=False)
+    reused = cached_devices.is_connected(device_id)
+
+    def job():
+        try:
+            task.state = "connecting"
+            d = cached_devices.connect(device_id, platform, device_url)
+            if prime and not reused:
+                task.state = "priming"
+                _prime(task, device_id, d)
+        except Exception as e:
+            task.finish(e)
         else:
-            platform = id
-            uri = ""
-        connect_device(platform, uri)
-    return cached_devices[id]
+            task.finish()
+        if on_done is not None:
+            on_done(task)
+
+    submit(device_id, job)
+    return task
+
+
+def _prime(task: ConnectTask, device_id, d):
+    if isinstance(d, _AndroidDevice):
+        task.step("deviceInfo", lambda: d.identity)
+    task.step("windowSize", lambda: d.device.window_size())
+
+    def snapshot():
+        cache = get_hierarchy_cache(device_id)
+        generation = cache.generation
+        cache.add(_dump_snapshot(d), generation)
+
+    task.step("snapshot", snapshot)
+
+
+def get_connect_task(task_id) -> ConnectTask:
+    with _executors_lock:
+        return connect_tasks.get(task_id)
+
+
+def warm_up(device_ids, on_done=None) -> list:
+    """
+    Connect and prime devices at startup, all at the same time since every
+    device has its own worker
+
+    Args:
+        device_ids: like "android:10.0.0.2" or "ios:http://localhost:8100"
+
+    Returns:
+        list of ConnectTask
+    """
+    tasks = []
+    for device_id in device_ids:
+        platform, uri = _parse_device_id(device_id)
+        logger.info("warm up %s", device_id)
+        task = start_connect(platform, uri, on_done=on_done)
+        # asked for at startup, so kept until it is disconnected on purpose
+        cached_devices.pin(task.device_id)
+        tasks.append(task)
+    return tasks
+
+
+def connection_state(device_id) -> dict:
+    """ state of the connection to the device, None when it is unknown """
+    return cached_devices.state(device_id)
+
+
+def disconnect_device(device_id) -> bool:
+    return cached_devices.disconnect(device_id)
+
+def describe_device(d, id):
+    info = d.device_info()
+    return {
+        "devicesName": id,
+        "devicesInfo": {
+            "udid": info["udid"],
+            "serial": info["serial"],
+            "model": info["model"],
+            "hwaddr": info["hwaddr"],
+            "port": info["port"],
+            "sdk": info["sdk"]
+        }
+    }
+
 
 def get_devices():
-    devices = []
-    for id in cached_devices:
-        info = cached_devices[id].device_info()
-        devices.append({
-            "devicesName": id,
-            "devicesInfo": {
-                "udid": info["udid"],
-                "serial": info["serial"],
-                "model": info["model"],
-                "hwaddr": info["hwaddr"],
-                "port": info["port"],
-                "sdk": info["sdk"]
-            }
-        })
-    return devices
\ No newline at end of file
+    return [describe_device(d, id) for id, d in list(cached_devices.items())]
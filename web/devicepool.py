@@ -0,0 +1,453 @@
+# coding: utf-8
+#
+# Connections to devices, with health checks and eviction
+#
+# A connection goes through these states:
+#   connecting -> connected -> unhealthy -> reconnecting -> connected
+#                                                        -> failed (backoff)
+# Requests never wait on a device which is known to be down: get raises
+# DeviceUnavailableError at once until a reconnect succeeds.
+
+import collections
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from logzero import logger
+
+# seconds between liveness probes of a device, and before a probe which is
+# running counts as failed. A probe waiting for a worker is not timed.
+PROBE_INTERVAL = 30.0
+PROBE_TIMEOUT = 10.0
+# seconds between rounds of the monitor
+MONITOR_INTERVAL = 1.0
+# consecutive failed probes before a device is reconnected
+PROBE_FAILURES = 2
+
+# seconds a request waits for a connect already in progress
+CONNECT_TIMEOUT = 60.0
+
+# reconnect delays double from the first to the last
+BACKOFF_MIN = 1.0
+BACKOFF_MAX = 60.0
+
+# devices unused for this many seconds are disconnected, 0 keeps them
+IDLE_TIMEOUT = 30 * 60.0
+# most connected devices, the least recently used one goes first
+MAX_DEVICES = 32
+
+
+class DeviceUnavailableError(RuntimeError):
+    """ the device is down or still connecting """
+
+
+class DeviceConnection(object):
+    def __init__(self, device_id: str, platform: str, url: str):
+        self.device_id = device_id
+        self.platform = platform
+        self.url = url
+        self.device = None
+        self.state = "connecting"
+        self.error = None
+        self.connected_at = None
+        self.last_used = time.time()
+        self.last_probe = None
+        self.probe_time = None
+        self.probe_failures = 0
+        self.probe_future = None  # Future of the probe in flight
+        self.probe_started = None  # when a worker picked it up
+        self.probe_timeouts = 0  # failures counted for the probe in flight
+        self.attempts = 0
+        self.next_retry = None
+        self.connecting = None  # Future of the connect in progress
+
+    def to_json(self) -> dict:
+        return {
+            "deviceId": self.device_id,
+            "platform": self.platform,
+            "url": self.url,
+            "state": self.state,
+            "error": self.error,
+            "connectedAt": self.connected_at,
+            "lastUsed": self.last_used,
+            "lastProbe": self.last_probe,
+            "probeTime": self.probe_time,
+            "probeFailures": self.probe_failures,
+            "attempts": self.attempts,
+            "nextRetry": self.next_retry,
+        }
+
+
+class ConnectTask(object):
+    """
+    Progress of a connect running in the background: the connect itself,
+    then priming steps which warm up caches. A failed priming step is
+    recorded, the device stays usable.
+
+    state: pending, connecting, priming, done or failed
+    """
+
+    def __init__(self, device_id: str, platform: str = None):
+        self.id = uuid.uuid4().hex[:12]
+        self.device_id = device_id
+        self.platform = platform
+        self.state = "pending"
+        self.error = None
+        self.steps = []
+        self.created = time.time()
+        self.finished = None
+        self.future = Future()
+
+    def step(self, name: str, fn):
+        """ run fn as a named step, errors are recorded and not raised """
+        step = {"name": name, "state": "running", "duration": None}
+        self.steps.append(step)
+        start = time.time()
+        try:
+            fn()
+            step["state"] = "done"
+        except Exception as e:
+            logger.warning("%s %s failed: %s", self.device_id, name, e)
+            step["state"] = "failed"
+            step["error"] = str(e)
+        step["duration"] = time.time() - start
+
+    def finish(self, error: Exception = None):
+        self.finished = time.time()
+        if error is None:
+            self.state = "done"
+            self.future.set_result(self.device_id)
+        else:
+            self.state = "failed"
+            self.error = str(error)
+            self.future.set_exception(error)
+
+    def to_json(self) -> dict:
+        return {
+            "connectId": self.id,
+            "deviceId": self.device_id,
+            "platform": self.platform,
+            "state": self.state,
+            "error": self.error,
+            "steps": list(self.steps),
+            "elapsed": (self.finished or time.time()) - self.created,
+        }
+
+
+class DevicePool(object):
+    """
+    Thread safe registry of device connections.
+
+    Args:
+        factory: (platform, url) -> connected device object
+        probe: device -> None, raises when the device does not answer
+        on_evict: called with the device_id of a dropped connection
+        in_use: device_id -> bool, true while the device is used without
+            requests, e.g. its screen is watched. Such a device is not idle.
+
+    Reads like a dict of the connected devices (get, in, iteration), so it
+    can stand in for the plain dict which was used before.
+    """
+
+    def __init__(self, factory, probe, on_evict=None, in_use=None):
+        self._factory = factory
+        self._probe = probe
+        self._on_evict = on_evict
+        self._in_use = in_use
+        self._pinned = set()  # never idle, see pin
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # least recently used first
+        self._probe_pool = ThreadPoolExecutor(max_workers=8,
+                                              thread_name_prefix="probe")
+        self._connect_pool = ThreadPoolExecutor(max_workers=4,
+                                                thread_name_prefix="reconnect")
+        self._monitor = None
+        self._stopped = threading.Event()
+
+    def connect(self, device_id: str, platform: str, url: str):
+        """
+        Connect, or join the connect in progress for this device. A device
+        which is connected already is returned as it is.
+
+        Raises:
+            the connect error
+        """
+        with self._lock:
+            entry = self._entries.get(device_id)
+            if entry is None:
+                entry = self._entries[device_id] = DeviceConnection(
+                    device_id, platform, url)
+            if entry.state == "connected":
+                self._touch(entry)
+                return entry.device
+            future = entry.connecting
+            owner = future is None
+            if owner:
+                future = entry.connecting = Future()
+                entry.state = "connecting" if entry.device is None else "reconnecting"
+        if owner:
+            self._do_connect(entry, future)
+        self._ensure_monitor()
+        self._evict_over_limit()
+        return future.result()
+
+    def _do_connect(self, entry: DeviceConnection, future: Future):
+        try:
+            device = self._factory(entry.platform, entry.url)
+        except Exception as e:
+            with self._lock:
+                entry.attempts += 1
+                entry.state = "failed"
+                entry.error = str(e)
+                delay = min(BACKOFF_MAX, BACKOFF_MIN * 2**(entry.attempts - 1))
+                entry.next_retry = time.time() + delay
+                entry.connecting = None
+            logger.warning("connect %s failed, retry in %.0fs: %s",
+                           entry.device_id, delay, e)
+            future.set_exception(e)
+            return
+        with self._lock:
+            entry.device = device
+            entry.state = "connected"
+            entry.error = None
+            entry.attempts = 0
+            entry.next_retry = None
+            entry.probe_failures = 0
+            # a probe of the old connection still hanging is not waited for
+            entry.probe_future = None
+            entry.connected_at = time.time()
+            entry.connecting = None
+            self._touch(entry)
+        future.set_result(device)
+
+    def get_device(self, device_id: str, platform: str = None, url: str = None):
+        """
+        Returns:
+            the connected device, connecting it first if platform is given
+            and the device was never seen
+
+        Raises:
+            DeviceUnavailableError when it is down, or still connecting after
+            CONNECT_TIMEOUT
+        """
+        with self._lock:
+            entry = self._entries.get(device_id)
+            if entry is not None and entry.state == "connected":
+                self._touch(entry)
+                return entry.device
+            future = entry.connecting if entry is not None else None
+            state = entry.state if entry is not None else None
+            error = entry.error if entry is not None else None
+        if entry is None:
+            if platform is None:
+                raise DeviceUnavailableError("device %s is not connected" %
+                                             device_id)
+            return self.connect(device_id, platform, url)
+        if future is None or state == "reconnecting":
+            # a device which was up and went down fails fast, instead of
+            # holding requests while it comes back
+            raise DeviceUnavailableError("device %s is %s: %s" %
+                                         (device_id, state, error))
+        try:
+            return future.result(timeout=CONNECT_TIMEOUT)
+        except FutureTimeoutError:
+            raise DeviceUnavailableError("device %s is still connecting" %
+                                         device_id)
+        except Exception as e:
+            raise DeviceUnavailableError("device %s connect failed: %s" %
+                                         (device_id, e))
+
+    def _touch(self, entry: DeviceConnection):
+        # called with the lock held
+        entry.last_used = time.time()
+        self._entries.move_to_end(entry.device_id)
+
+    def pin(self, device_id: str):
+        """ keep device_id connected however long it is idle """
+        with self._lock:
+            self._pinned.add(device_id)
+
+    def _idle(self, entry: DeviceConnection, now: float) -> bool:
+        if not IDLE_TIMEOUT or now - entry.last_used <= IDLE_TIMEOUT:
+            return False
+        with self._lock:
+            pinned = entry.device_id in self._pinned
+        if pinned or (self._in_use and self._in_use(entry.device_id)):
+            with self._lock:
+                self._touch(entry)
+            return False
+        return True
+
+    def disconnect(self, device_id: str) -> bool:
+        with self._lock:
+            entry = self._entries.pop(device_id, None)
+            self._pinned.discard(device_id)
+        if entry is None:
+            return False
+        logger.info("device %s disconnected", device_id)
+        if self._on_evict:
+            self._on_evict(device_id)
+        return True
+
+    def _evict_over_limit(self):
+        with self._lock:
+            extra = [
+                device_id for device_id, entry in self._entries.items()
+                if entry.connecting is None
+            ][:max(0, len(self._entries) - MAX_DEVICES)]
+        for device_id in extra:
+            logger.info("device %s evicted, more than %d devices", device_id,
+                        MAX_DEVICES)
+            self.disconnect(device_id)
+
+    def _ensure_monitor(self):
+        with self._lock:
+            if self._monitor is not None:
+                return
+            self._monitor = threading.Thread(target=self._monitor_loop,
+                                             name="device-monitor",
+                                             daemon=True)
+        self._monitor.start()
+
+    def _monitor_loop(self):
+        while not self._stopped.wait(MONITOR_INTERVAL):
+            try:
+                self.check()
+            except Exception:
+                logger.exception("device monitor error")
+
+    def check(self):
+        """
+        One round of eviction, liveness probes and reconnects. Never waits on
+        a device: probes run on the probe pool, each timed from when it
+        started, and a device is not probed again while a probe is in flight.
+        """
+        now = time.time()
+        with self._lock:
+            entries = list(self._entries.values())
+        for entry in entries:
+            if entry.connecting is not None:
+                continue
+            if self._idle(entry, now):
+                logger.info("device %s evicted, idle for %.0fs",
+                            entry.device_id, now - entry.last_used)
+                self.disconnect(entry.device_id)
+                continue
+            if entry.probe_future is not None:
+                self._check_probe_timeout(entry, now)
+            if entry.state == "connected":
+                last = max(entry.last_probe or 0, entry.connected_at or 0)
+                if entry.probe_future is None and now - last >= PROBE_INTERVAL:
+                    self._start_probe(entry)
+            elif entry.next_retry is None or now >= entry.next_retry:
+                self._connect_pool.submit(self._reconnect, entry)
+
+    def _start_probe(self, entry: DeviceConnection):
+        def run():
+            with self._lock:
+                entry.probe_started = time.time()
+            self._probe(device)
+
+        with self._lock:
+            device = entry.device
+            future = entry.probe_future = self._probe_pool.submit(run)
+            entry.probe_started = None
+            entry.probe_timeouts = 0
+        future.add_done_callback(lambda f: self._probe_finished(entry, f))
+
+    def _check_probe_timeout(self, entry: DeviceConnection, now: float):
+        # a probe which hangs counts as one more failure every PROBE_TIMEOUT
+        with self._lock:
+            started = entry.probe_started
+            if started is None or int(
+                (now - started) / PROBE_TIMEOUT) <= entry.probe_timeouts:
+                return
+            entry.probe_timeouts += 1
+        self._probe_done(entry, "no answer in %.0fs" % (now - started),
+                         now - started)
+
+    def _probe_finished(self, entry: DeviceConnection, future: Future):
+        with self._lock:
+            if entry.probe_future is not future:
+                return
+            entry.probe_future = None
+            started = entry.probe_started or time.time()
+            timed_out = entry.probe_timeouts > 0
+        error = future.exception()
+        if error is not None:
+            if timed_out:
+                return  # counted while it was running
+            error = str(error) or error.__class__.__name__
+        self._probe_done(entry, error, time.time() - started)
+
+    def _probe_done(self, entry: DeviceConnection, error: str, elapsed: float):
+        with self._lock:
+            entry.last_probe = time.time()
+            entry.probe_time = elapsed
+            if error is None:
+                entry.probe_failures = 0
+                return
+            if entry.state != "connected":
+                return  # reconnecting already
+            entry.probe_failures += 1
+            entry.error = error
+            if entry.probe_failures < PROBE_FAILURES:
+                return
+            entry.state = "unhealthy"
+        logger.warning("device %s unhealthy: %s", entry.device_id, error)
+        self._connect_pool.submit(self._reconnect, entry)
+
+    def _reconnect(self, entry: DeviceConnection):
+        with self._lock:
+            if entry.connecting is not None or self._entries.get(
+                    entry.device_id) is not entry:
+                return
+            future = entry.connecting = Future()
+            entry.state = "reconnecting"
+        self._do_connect(entry, future)
+
+    def is_connected(self, device_id: str) -> bool:
+        with self._lock:
+            entry = self._entries.get(device_id)
+            return entry is not None and entry.state == "connected"
+
+    def state(self, device_id: str) -> dict:
+        with self._lock:
+            entry = self._entries.get(device_id)
+            return entry.to_json() if entry else None
+
+    def stats(self) -> list:
+        with self._lock:
+            return [entry.to_json() for entry in self._entries.values()]
+
+    # read only dict interface over the connected devices
+
+    def get(self, device_id: str, default=None):
+        with self._lock:
+            entry = self._entries.get(device_id)
+            if entry is None or entry.device is None:
+                return default
+            return entry.device
+
+    def __contains__(self, device_id: str) -> bool:
+        return self.get(device_id) is not None
+
+    def __getitem__(self, device_id: str):
+        device = self.get(device_id)
+        if device is None:
+            raise KeyError(device_id)
+        return device
+
+    def items(self):
+        with self._lock:
+            return [(device_id, entry.device)
+                    for device_id, entry in self._entries.items()
+                    if entry.device is not None]
+
+    def __iter__(self):
+        return iter([device_id for device_id, _ in self.items()])
+
+    def __len__(self) -> int:
+        return len(self.items())
@@ -1,9 +1,11 @@
 # coding: utf-8
 #
 
+import asyncio
 import base64
 import io
 import json
+import math
 import os
 import traceback
 import time
@@ -12,10 +14,27 @@ import tornado
 from logzero import logger
 from PIL import Image
 from tornado.escape import json_decode
+from tornado.ioloop import IOLoop
 from urllib import parse
 
-from ..device import connect_device, get_device
+from .. import device
+from ..device import (cached_devices, capture_snapshot, connection_state,
+                      count_rpc, describe_device,
+                      disconnect_device, find_frame_history,
+                      device_stats, dump_hierarchy_cached, executor_stats,
+                      find_snapshot, get_connect_task, latest_frame,
+                      record_frame, screen_stream_url, start_connect,
+                      start_screen_stream, submit, submit_action,
+                      submit_device)
+from ..actions import changes_screen, parse_batch, parse_fanout, run_batch
+from ..compact import CONTENT_TYPE as COMPACT_CONTENT_TYPE, encode_hierarchy
+from ..hierarchydiff import HierarchySessions
+from .. import imageutils, tiles
+from ..imageutils import CONTENT_TYPES, convert_image, image_etag
+from ..snapshot import QUERY_KEYS
+from ..uidumplib import DEFAULT_PARSER, PARSERS, HierarchyPrune
 from ..version import __version__
+from ..xpath import XPathError
 
 pathjoin = os.path.join
 
@@ -37,6 +56,378 @@ class BaseHandler(tornado.web.RequestHandler):
         """ allow cors request """
         return True
 
+    @property
+    def rpc_calls(self) -> dict:
+        """ device round-trips made for this request, method -> count """
+        if not hasattr(self, "_rpc_calls"):
+            self._rpc_calls = {}
+        return self._rpc_calls
+
+    def write_error(self, status_code, **kwargs):
+        """ errors as json, like the handlers write them """
+        error = kwargs.get("exc_info", (None, None, None))[1]
+        if isinstance(error, tornado.web.HTTPError) and error.log_message:
+            description = error.log_message % error.args
+        else:
+            description = self._reason
+        self.finish({"success": False, "description": description})
+
+    def frame_history(self, device_id):
+        """
+        Returns:
+            FrameHistory of the device, None after writing 404 when the
+            device is unknown
+        """
+        history = find_frame_history(device_id)
+        if history is None:
+            self.set_status(404)
+            self.write({
+                "success": False,
+                "description": "device %s is not connected" % device_id,
+            })
+        return history
+
+    def number_argument(self, name, default=None, type=float,
+                        required=False):
+        """
+        Raises:
+            tornado.web.HTTPError 400 when the argument is not a finite
+            number, or missing and required
+        """
+        value = self.get_argument(name) if required else self.get_argument(
+            name, None)
+        if value is None:
+            return default
+        try:
+            ret = type(value)
+        except ValueError:
+            ret = None
+        if ret is None or not math.isfinite(ret):
+            raise tornado.web.HTTPError(400, "%s should be a number, not %r",
+                                        name, value)
+        return ret
+
+    def finish(self, chunk=None):
+        if self.rpc_calls and not self._headers_written:
+            self.set_header("X-RPC-Count", sum(self.rpc_calls.values()))
+            self.set_header(
+                "X-RPC-Calls",
+                ",".join("%s=%d" % kv for kv in sorted(self.rpc_calls.items())))
+            exposed = self._headers.get("Access-Control-Expose-Headers")
+            self.set_header(
+                "Access-Control-Expose-Headers",
+                (exposed + ", " if exposed else "") + "X-RPC-Count, X-RPC-Calls")
+        return super().finish(chunk)
+
+    async def run_job(self, device_id, fn, *args, **kwargs):
+        """ run fn(*args, **kwargs) on the worker thread of device_id """
+        return await asyncio.wrap_future(
+            submit(device_id, count_rpc(fn, self.rpc_calls), *args, **kwargs))
+
+    async def run_device(self, device_id, fn, *args, **kwargs):
+        """ run fn(d, *args, **kwargs) on the worker thread of device_id """
+        return await asyncio.wrap_future(
+            submit_device(device_id, count_rpc(fn, self.rpc_calls), *args,
+                          **kwargs))
+
+    async def run_action(self, device_id, fn, *args, **kwargs):
+        """ same as run_device, and drops the cached hierarchy of the device """
+        return await asyncio.wrap_future(
+            submit_action(device_id, count_rpc(fn, self.rpc_calls), *args,
+                          **kwargs))
+
+    def use_snapshot(self) -> bool:
+        """
+        Query:
+            snapshot: 1 answers element queries from the cached hierarchy
+            live: 1 forces a query on the device
+        """
+        if self.get_argument("live", "") in ("1", "true"):
+            return False
+        value = self.get_argument("snapshot", None)
+        if value is None:
+            return device.SNAPSHOT_QUERY
+        return value in ("1", "true")
+
+    async def query_element(self, device_id, origin, flag, index):
+        """
+        Returns:
+            (element info or None, snapshot age in seconds or None when live)
+
+        Raises:
+            tornado.web.HTTPError 400 for a bad index or xpath
+        """
+        try:
+            index = int(index)
+        except ValueError:
+            raise tornado.web.HTTPError(400, "index should be a number, not %r",
+                                        index)
+        if (origin in QUERY_KEYS or origin == 'xpath') and self.use_snapshot():
+            snapshot = await self.hierarchy_snapshot(device_id)
+            if origin == 'xpath':
+                index = 0  # d.xpath() has no instance, it is the first match
+            try:
+                ret = await IOLoop.current().run_in_executor(
+                    None, snapshot.find, origin, flag, index)
+            except XPathError as e:
+                raise tornado.web.HTTPError(400, "%s", e)
+            return ret, snapshot.age
+
+        return await self.run_device(
+            device_id, lambda d: d.resolve(origin, flag, index)), None
+
+    def write_element(self, ret: dict, age: float = None):
+        if age is not None:
+            ret["snapshotAge"] = age
+        self.write(ret)
+
+    def image_options(self) -> dict:
+        """
+        Query:
+            preset: preview, standard, high or lossless (imageutils.PRESETS)
+            format: jpeg, png or webp, default is the format the device sends
+            quality: 1-100 for jpeg and webp, forces a re-encode
+            scale: resize factor, e.g. 0.5
+            max_width: shrink to at most this width
+            region: x,y,w,h crop in screen pixels, applied before scaling
+
+        Returns:
+            keyword arguments of imageutils.process_image
+
+        Raises:
+            ValueError
+        """
+        preset = self.get_argument("preset", None)
+        if preset is not None and preset not in imageutils.PRESETS:
+            raise ValueError("preset should be one of %s" %
+                             ", ".join(imageutils.PRESETS))
+        options = dict(imageutils.PRESETS.get(preset, {}))
+        fmt = self.get_argument("format", None)
+        if fmt is not None:
+            fmt = "jpeg" if fmt == "jpg" else fmt
+            if fmt not in CONTENT_TYPES:
+                raise ValueError("format should be one of %s" %
+                                 ", ".join(CONTENT_TYPES))
+            options["format"] = fmt
+        for name, convert, valid, expected in (
+            ("quality", int, lambda v: 1 <= v <= 100, "1-100"),
+            ("scale", float, lambda v: 0 < v <= 1, "above 0 and at most 1"),
+            ("max_width", int, lambda v: v >= 1, "at least 1"),
+        ):
+            value = self.get_argument(name, None)
+            if value is None:
+                continue
+            try:
+                value = convert(value)
+            except ValueError:
+                raise ValueError("%s should be a number, not %r" %
+                                 (name, value))
+            if not valid(value):
+                raise ValueError("%s should be %s" % (name, expected))
+            options[name] = value
+        region = self.get_argument("region", None)
+        if region:
+            options["region"] = imageutils.parse_region(region)
+        options["fmt"] = options.pop("format", None)
+        return options
+
+    def write_image(self, data: bytes, fmt: str, etag: str = None):
+        """ image body with an ETag, 304 when If-None-Match matches it """
+        self.set_header("Content-Type", CONTENT_TYPES[fmt])
+        self.set_header("Cache-Control", "no-cache")
+        self.set_header(
+            "Access-Control-Expose-Headers",
+            "Etag, X-Screen-Size, X-Frame-Source, X-Frame-Age, X-Frame-Size, "
+            "X-Tiles, X-Tile-Size, X-Atlas-Columns")
+        self.set_header("Etag", etag or image_etag(data))
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        self.write(data)
+
+    async def screen_image(self, device_id) -> bytes:
+        """
+        Current screen as encoded image bytes, taken from the latest minicap
+        frame while the stream is up and from the device otherwise.
+        X-Frame-Source tells which one it was.
+
+        Query:
+            stream: 0 always asks the device
+        """
+        frame = None
+        if self.get_argument("stream", "") not in ("0", "false"):
+            frame = latest_frame(device_id)
+        if frame is not None:
+            self.set_header("X-Frame-Source", "stream")
+            self.set_header("X-Frame-Age", "%.3f" % frame.age)
+            record_frame(device_id, frame.data, "stream", frame.timestamp)
+            return frame.data
+        self.set_header("X-Frame-Source", "device")
+        # taken when the job runs, actions queued before it are on screen
+        timestamp, data = await self.run_device(
+            device_id, lambda d: (time.time(), d.screenshot_raw()))
+        record_frame(device_id, data, "device", timestamp)
+        return data
+
+    def screen_tolerance(self) -> float:
+        """
+        Query:
+            tolerance: fraction of the screen which may change and still count
+                as unchanged, e.g. 0.01 for a clock, default 0
+
+        Raises:
+            ValueError
+        """
+        tolerance = float(self.get_argument("tolerance", 0))
+        if not 0 <= tolerance <= 1:
+            raise ValueError("tolerance should be between 0 and 1")
+        return tolerance
+
+    async def screen_unchanged(self, data: bytes, tolerance: float = 0,
+                               options: dict = None):
+        """
+        Compare the screen with the last image the client got
+
+        Args:
+            options: how the image is made of the screen, the last image only
+                counts when it was made the same way
+
+        Query:
+            since: ETag of that image, If-None-Match works too
+
+        Returns:
+            (ETag of the client when the screen is unchanged else None,
+             imageutils.Fingerprint of data)
+        """
+        fp = await asyncio.wrap_future(
+            imageutils.submit(imageutils.fingerprint, data, tolerance > 0))
+        since = self.get_argument("since", None) or self.request.headers.get(
+            "If-None-Match", "")
+        for etag in since.split(","):
+            etag = etag.strip()
+            last = imageutils.fingerprints.get(etag, options) if etag else None
+            if last is not None and imageutils.same_screen(fp, last, tolerance):
+                return etag, fp
+        return None, fp
+
+    async def write_screen(self, device_id, region_required=False):
+        """
+        Current screen processed by image_options, see DeviceScreenshotRawHandler
+        """
+        try:
+            options = self.image_options()
+            tolerance = self.screen_tolerance()
+            if region_required and not options.get("region"):
+                raise ValueError("region is required")
+        except ValueError as e:
+            self.set_status(400)
+            self.write({"success": False, "description": str(e)})
+            return
+        if self.get_argument("delta", "") in ("1", "true"):
+            await self.write_screen_delta(device_id, options)
+            return
+        try:
+            data = await self.screen_image(device_id)
+            etag, fp = await self.screen_unchanged(data, tolerance, options)
+            if etag:
+                self.set_header("Etag", etag)
+                self.set_status(304)
+                return
+            image, fmt, size = await asyncio.wrap_future(
+                imageutils.submit(imageutils.process_image, data, **options))
+            etag = image_etag(image)
+            imageutils.fingerprints.put(etag, fp, options)
+            self.set_header("X-Screen-Size", "%d,%d" % size)
+            self.write_image(image, fmt, etag)
+        except ValueError as e:
+            # region outside of the screen
+            self.set_status(400)
+            self.write({"success": False, "description": str(e)})
+        except EnvironmentError as e:
+            traceback.print_exc()
+            self.set_status(500, "Environment Error")
+            self.write({"description": str(e)})
+        except RuntimeError as e:
+            self.set_status(500)
+            self.write({"description": traceback.format_exc()})
+
+    async def write_screen_delta(self, device_id, options: dict):
+        """
+        Only the tiles which changed since the frame of ?since=, packed into
+        one image. X-Tiles lists them as x,y,w,h;... in X-Frame-Size pixels,
+        tile i is at column i % X-Atlas-Columns, row i / X-Atlas-Columns of
+        the X-Tile-Size grid. Without X-Tiles the body is a full frame.
+        """
+        try:
+            data = await self.screen_image(device_id)
+            delta = await asyncio.wrap_future(
+                imageutils.submit(tiles.encode_delta, data,
+                                  self.get_argument("since", None),
+                                  frames=tiles.frame_store(device_id),
+                                  **options))
+            if delta.image is None:
+                self.set_header("Etag", delta.etag)
+                self.set_status(304)
+                return
+            self.set_header("X-Screen-Size", "%d,%d" % delta.size)
+            self.set_header("X-Frame-Size", "%d,%d" % delta.frame_size)
+            if delta.tiles is not None:
+                self.set_header(
+                    "X-Tiles",
+                    ";".join("%d,%d,%d,%d" % tile for tile in delta.tiles))
+                self.set_header("X-Tile-Size", tiles.TILE_SIZE)
+                self.set_header("X-Atlas-Columns", delta.columns)
+            self.write_image(delta.image, delta.fmt, delta.etag)
+        except ValueError as e:
+            self.set_status(400)
+            self.write({"success": False, "description": str(e)})
+        except EnvironmentError as e:
+            traceback.print_exc()
+            self.set_status(500, "Environment Error")
+            self.write({"description": str(e)})
+        except RuntimeError as e:
+            self.set_status(500)
+            self.write({"description": traceback.format_exc()})
+
+    def hierarchy_prune(self):
+        """
+        Query:
+            fields: comma separated json keys to keep, e.g. rect,text
+            max_depth: drop nodes deeper than this, the root is 0
+            visible: 1 drops empty and off-screen nodes
+            interactable: 1 keeps only clickable, checkable or scrollable nodes
+            collapse: 1 collapses single-child layout chains
+
+        Returns:
+            uidumplib.HierarchyPrune or None when nothing is pruned
+
+        Raises:
+            tornado.web.HTTPError 400 when max_depth is not a number
+        """
+        fields = self.get_argument("fields", None)
+        max_depth = self.number_argument("max_depth", type=int)
+        flags = {
+            name: self.get_argument(name, "") in ("1", "true")
+            for name in ("visible", "interactable", "collapse")
+        }
+        if fields is None and max_depth is None and not any(flags.values()):
+            return None
+        return HierarchyPrune(
+            fields=[f for f in fields.split(",") if f] if fields else None,
+            max_depth=max_depth,
+            visible_only=flags["visible"],
+            interactable_only=flags["interactable"],
+            collapse=flags["collapse"])
+
+    async def hierarchy_snapshot(self, device_id):
+        """
+        Query:
+            max_age: seconds a cached dump is acceptable, default SNAPSHOT_MAX_AGE
+        """
+        max_age = self.number_argument("max_age")
+        return await asyncio.wrap_future(
+            dump_hierarchy_cached(device_id, max_age))
+
 
 class VersionHandler(BaseHandler):
     def get(self):
@@ -53,12 +444,38 @@ class MainHandler(BaseHandler):
 
 
 class DeviceConnectHandler(BaseHandler):
-    def post(self):
+    async def post(self):
+        """
+        Connect in the background and answer at once with a connectId, which
+        /api/v1/connect/<connectId> reports the progress of
+
+        Query:
+            wait: 1 answers when connected, like before
+            prime: 0 skips loading device info and the first hierarchy
+        """
         platform = self.get_argument("platform").lower()
         device_url = self.get_argument("deviceUrl")
+        stream = platform == "android" and (
+            device.SCREEN_STREAM
+            or self.get_argument("screenStream", "") in ("1", "true"))
+        loop = IOLoop.current()
+
+        def on_done(task):
+            if stream and task.state == "done":
+                # the stream lives on the IOLoop
+                loop.add_callback(start_screen_stream, task.device_id,
+                                  persistent=True)
+
+        task = start_connect(platform, device_url,
+                             prime=self.get_argument("prime", "1")
+                             not in ("0", "false"),
+                             on_done=on_done)
+        if self.get_argument("wait", "") not in ("1", "true"):
+            self.write(connect_progress(task))
+            return
 
         try:
-            id = connect_device(platform, device_url)
+            await asyncio.wrap_future(task.future)
         except RuntimeError as e:
             self.set_status(500)
             self.write({
@@ -70,29 +487,418 @@ class DeviceConnectHandler(BaseHandler):
             self.set_status(500)
             self.write({
                 "success": False,
-                "description": traceback.format_exc(),
+                "description": "".join(
+                    traceback.format_exception(type(e), e, e.__traceback__)),
             })
         else:
-            ret = {
-                "deviceId": id,
-                'success': True,
-            }
-            if platform == "android":
-                ws_addr = get_device(id).device.address.replace("http://", "ws://") # yapf: disable
-                ret['screenWebSocketUrl'] = ws_addr + "/minicap"
-            self.write(ret)
+            self.write(connect_progress(task))
+
+
+class DeviceConnectProgressHandler(BaseHandler):
+    def get(self, connect_id):
+        task = get_connect_task(connect_id)
+        if task is None:
+            self.set_status(404)
+            self.write({
+                "success": False,
+                "description": "connect %s not found" % connect_id,
+            })
+            return
+        self.write(connect_progress(task))
+
+
+def connect_progress(task) -> dict:
+    ret = task.to_json()
+    ret["success"] = task.state != "failed"
+    # a usb device is plain "android", without a colon
+    if task.state == "done" and task.platform == "android":
+        ret['screenWebSocketUrl'] = screen_stream_url(task.device_id)
+    return ret
 
 
 class DeviceHierarchyHandler(BaseHandler):
-    def get(self, device_id):
-        d = get_device(device_id)
-        self.write(d.dump_hierarchy())
+    async def get(self, device_id):
+        self.write(await self.run_device(device_id, lambda d: d.dump_hierarchy()))
 
 
 class DeviceHierarchyHandlerV2(BaseHandler):
+    async def get(self, device_id):
+        # ?parser=minidom switches back to the DOM parser for comparison
+        parser = self.get_argument("parser", None)
+        prune = self.hierarchy_prune()
+        if parser is not None and parser not in PARSERS:
+            raise tornado.web.HTTPError(400, "unknown parser %r, one of %s",
+                                        parser, ", ".join(PARSERS))
+        if prune and parser not in (None, DEFAULT_PARSER):
+            raise tornado.web.HTTPError(
+                400, "pruning only works with the %s parser", DEFAULT_PARSER)
+        if parser or prune:
+            # a pruned tree is parsed from a fresh dump, the full tree is
+            # never built
+            data = await self.run_device(
+                device_id, lambda d: d.dump_hierarchy2(parser, prune=prune))
+            if prune and self.get_argument("xml", "") not in ("1", "true"):
+                data.pop("xmlHierarchy", None)
+            if self.want_compact():
+                await self.write_compact(data, lambda: encode_hierarchy(data))
+            else:
+                self.write(data)
+        else:
+            snapshot = await self.hierarchy_snapshot(device_id)
+            # lets the client pin this dump in /hierarchy/lazy
+            self.set_header("X-Hierarchy-Version", snapshot.version)
+            self.set_header("Access-Control-Expose-Headers",
+                            "X-Hierarchy-Version")
+            if self.want_compact():
+                with_xml = self.get_argument("xml", "1") not in ("0", "false")
+                await self.write_compact(snapshot.data,
+                                         lambda: snapshot.compact(with_xml))
+            else:
+                self.write(snapshot.data)
+
+    def want_compact(self) -> bool:
+        """
+        Query:
+            format: "compact" for the binary format of web/compact.py, "json"
+                (default). Without it an Accept header asking for
+                application/x-weditor-hierarchy selects the binary format.
+        """
+        fmt = self.get_argument("format", None)
+        if fmt is not None:
+            return fmt == "compact"
+        return COMPACT_CONTENT_TYPE in self.request.headers.get("Accept", "")
+
+    async def write_compact(self, data: dict, encode):
+        """
+        Query:
+            compare: set to 1 to also report the size and encode time of the
+                json response in X-Json-Size and X-Json-Encode-Time
+        """
+        loop = IOLoop.current()
+        start = time.time()
+        payload = await loop.run_in_executor(None, encode)
+        self.set_header("X-Encode-Time", "%.6f" % (time.time() - start))
+        if self.get_argument("compare", "") in ("1", "true"):
+            start = time.time()
+            size = len(await loop.run_in_executor(None, json.dumps, data))
+            self.set_header("X-Json-Encode-Time", "%.6f" % (time.time() - start))
+            self.set_header("X-Json-Size", str(size))
+        self.set_header("Content-Type", COMPACT_CONTENT_TYPE)
+        self.set_header("Vary", "Accept")
+        self.write(payload)
+
+
+class DeviceHierarchyHandlerV3(BaseHandler):
+    """
+    Incremental hierarchy for live mode
+
+    Query:
+        client: id of the caller, snapshots are kept per device and client
+        version: version token of the hierarchy the client already has
+        xml: set to 1 to include xmlHierarchy
+    """
+    sessions = HierarchySessions()
+
+    async def get(self, device_id):
+        client_id = self.get_argument("client", self.request.remote_ip)
+        version = self.get_argument("version", None)
+        with_xml = self.get_argument("xml", "") in ("1", "true")
+
+        snapshot = await self.hierarchy_snapshot(device_id)
+        data = snapshot.data
+        ret = await IOLoop.current().run_in_executor(
+            None, self.sessions.make_patch, (device_id, client_id), data, version)
+        if with_xml and ret["changed"]:
+            ret["xmlHierarchy"] = data.get("xmlHierarchy")
+        self.write(ret)
+
+
+class DeviceSnapshotHandler(BaseHandler):
+    async def get(self, device_id):
+        """
+        Screenshot, hierarchy, current app and window size of the same moment
+        in one response, see device.capture_snapshot. The hierarchy keys are
+        the ones of the v2 hierarchy api, timings are in seconds.
+
+        Query:
+            see image_options, applied to the screenshot
+        """
+        try:
+            options = self.image_options()
+        except ValueError as e:
+            self.set_status(400)
+            self.write({"success": False, "description": str(e)})
+            return
+        try:
+            ret = await asyncio.wrap_future(capture_snapshot(device_id))
+            record_frame(device_id, ret["screenshot"], ret["frameSource"],
+                         ret["snapshot"].timestamp)
+            start = time.time()
+            image, fmt, size = await asyncio.wrap_future(
+                imageutils.submit(imageutils.process_image, ret["screenshot"],
+                                  **options))
+            timings = ret["timings"]
+            timings["encode"] = time.time() - start
+            snapshot = ret["snapshot"]
+            data = dict(snapshot.data)
+            data.update({
+                "success": True,
+                "timestamp": snapshot.timestamp,
+                "hierarchyVersion": snapshot.version,
+                "screenshot": {
+                    "type": fmt,
+                    "encoding": "base64",
+                    "data": base64.b64encode(image).decode('utf-8'),
+                    "size": size,
+                },
+                "frameSource": ret["frameSource"],
+                "timings": timings,
+            })
+            self.write(data)
+        except ValueError as e:
+            # region outside of the screen
+            self.set_status(400)
+            self.write({"success": False, "description": str(e)})
+        except EnvironmentError as e:
+            traceback.print_exc()
+            self.set_status(500, "Environment Error")
+            self.write({"description": str(e)})
+        except RuntimeError as e:
+            self.set_status(500)
+            self.write({"description": traceback.format_exc()})
+
+
+class DeviceHistoryHandler(BaseHandler):
     def get(self, device_id):
-        d = get_device(device_id)
-        self.write(d.dump_hierarchy2())
+        """
+        Frames in the screenshot history of the device, oldest first
+
+        Query:
+            since: only frames with a larger id
+        """
+        history = self.frame_history(device_id)
+        if history is None:
+            return
+        since = self.number_argument("since", 0, type=int)
+        self.write({
+            "success": True,
+            "result": [frame.to_json() for frame in history.list(since)],
+            "stats": history.stats(),
+        })
+
+    def delete(self, device_id):
+        history = self.frame_history(device_id)
+        if history is None:
+            return
+        history.clear()
+        self.write({"success": True})
+
+
+class DeviceHistoryFrameHandler(BaseHandler):
+    def get(self, device_id, frame_id):
+        """ one frame of the history as an image """
+        history = self.frame_history(device_id)
+        if history is None:
+            return
+        frame = history.get(int(frame_id))
+        if frame is None:
+            self.set_status(404)
+            self.write({
+                "success": False,
+                "description": "frame %s is not in the history" % frame_id,
+            })
+            return
+        self.set_header("X-Frame-Time", frame.timestamp)
+        if frame.action:
+            self.set_header("X-Frame-Action", frame.action)
+        self.write_image(frame.data, frame.fmt)
+
+
+class DeviceHistoryExportHandler(BaseHandler):
+    async def get(self, device_id):
+        """
+        Zip of the history, frames plus an index.json with their metadata
+
+        Query:
+            since: only frames with a larger id
+        """
+        history = self.frame_history(device_id)
+        if history is None:
+            return
+        since = self.number_argument("since", 0, type=int)
+        data = await IOLoop.current().run_in_executor(
+            None, history.export, since)
+        filename = "%s-%s.zip" % (device_id.replace(":", "_").replace(
+            "/", "_"), time.strftime("%Y%m%d-%H%M%S"))
+        self.set_header("Content-Type", "application/zip")
+        self.set_header("Content-Disposition",
+                        'attachment; filename="%s"' % filename)
+        self.write(data)
+
+
+class DeviceHierarchyLazyHandler(BaseHandler):
+    async def get(self, device_id):
+        """
+        A few levels of the hierarchy, for trees which load branches on demand
+
+        Query:
+            version: hierarchy version to read from, the latest dump if omitted
+            node: node id to start at, the root if omitted
+            depth: levels below node to include, default 1. Nodes whose
+                children are cut only have childCount.
+        """
+        version = self.get_argument("version", None)
+        node_id = self.get_argument("node", None)
+        depth = self.number_argument("depth", 1, type=int)
+        if depth < 1:
+            raise tornado.web.HTTPError(400, "depth should be at least 1")
+        if version:
+            snapshot = find_snapshot(device_id, version)
+            if snapshot is None:
+                self.set_status(410)
+                self.write({
+                    "success": False,
+                    "description": "hierarchy %s expired, reload the tree" % version,
+                })
+                return
+        else:
+            snapshot = await self.hierarchy_snapshot(device_id)
+        node = await IOLoop.current().run_in_executor(
+            None, snapshot.subtree, node_id, depth)
+        if node is None:
+            self.set_status(404)
+            self.write({
+                "success": False,
+                "description": "node %s not found" % node_id,
+            })
+            return
+        self.write({
+            "success": True,
+            "version": snapshot.version,
+            "node": node,
+        })
+
+
+def _strip_children(node, depth):
+    ret = {k: v for k, v in node.items() if k != 'children'}
+    ret['depth'] = depth
+    return ret
+
+
+class NodesAtHandler(BaseHandler):
+    async def get(self, device_id):
+        """ nodes under point (x, y), topmost first """
+        x = self.number_argument("x", required=True)
+        y = self.number_argument("y", required=True)
+        snapshot = await self.hierarchy_snapshot(device_id)
+        nodes = await IOLoop.current().run_in_executor(
+            None, lambda: snapshot.spatial_index.at(x, y))
+        self.write({
+            "success": True,
+            "nodes": [_strip_children(node, depth) for node, depth in nodes],
+            "snapshotAge": snapshot.age,
+        })
+
+
+class NodesInHandler(BaseHandler):
+    async def get(self, device_id):
+        """
+        nodes intersecting rect (x, y, width, height), topmost first
+
+        Query:
+            contain: set to 1 to only return nodes fully inside the rect
+        """
+        rect = {
+            key: self.number_argument(key, required=True)
+            for key in ("x", "y", "width", "height")
+        }
+        contain = self.get_argument("contain", "") in ("1", "true")
+        snapshot = await self.hierarchy_snapshot(device_id)
+        nodes = await IOLoop.current().run_in_executor(
+            None, lambda: snapshot.spatial_index.within(rect, contain))
+        self.write({
+            "success": True,
+            "nodes": [_strip_children(node, depth) for node, depth in nodes],
+            "snapshotAge": snapshot.age,
+        })
+
+
+class NodesXPathHandler(BaseHandler):
+    async def get(self, device_id):
+        """
+        nodes matched by an xpath, evaluated on the cached hierarchy
+
+        Query:
+            xpath: expression, the uiautomator2 shortcuts (@id, %text%) work too
+            compare: set to 1 to run the same xpath on the device as well and
+                report both timings
+        """
+        expr = self.get_argument("xpath")
+        snapshot = await self.hierarchy_snapshot(device_id)
+        start = time.time()
+        try:
+            nodes = await IOLoop.current().run_in_executor(
+                None, snapshot.select, expr)
+        except XPathError as e:
+            self.set_status(400)
+            self.write({"success": False, "description": str(e)})
+            return
+        ret = {
+            "success": True,
+            "nodes": [_strip_children(node, depth) for node, depth in nodes],
+            "elapsed": time.time() - start,
+            "snapshotAge": snapshot.age,
+        }
+        if self.get_argument("compare", "") in ("1", "true"):
+
+            def device_xpath(d):
+                start = time.time()
+                count = len(d.weight('xpath', expr, 0).all())
+                return count, time.time() - start
+
+            count, elapsed = await self.run_device(device_id, device_xpath)
+            ret["device"] = {"count": count, "elapsed": elapsed}
+        self.write(ret)
+
+
+class DeviceExecutorHandler(BaseHandler):
+    def get(self, device_id=None):
+        """ queue depth, wait time and cache counters of the device workers """
+        if device_id is None:
+            self.write({"success": True, "result": executor_stats()})
+            return
+        stats = device_stats(device_id)
+        if stats:
+            self.write({"success": True, "result": stats})
+        else:
+            self.set_status(404)
+            self.write({
+                "success": False,
+                "description": "device %s has no worker" % device_id,
+            })
+
+
+class DevicePoolHandler(BaseHandler):
+    def get(self):
+        """ state of every device connection, see devicepool """
+        self.write({"success": True, "result": cached_devices.stats()})
+
+
+class DeviceConnectionHandler(BaseHandler):
+    def get(self, device_id):
+        state = connection_state(device_id)
+        if state is None:
+            self.set_status(404)
+            self.write({
+                "success": False,
+                "description": "device %s is not connected" % device_id,
+            })
+            return
+        self.write({"success": True, "result": state})
+
+    def delete(self, device_id):
+        """ drop the connection, the next connect starts a fresh one """
+        self.write({"success": disconnect_device(device_id)})
 
 
 class WidgetPreviewHandler(BaseHandler):
@@ -146,13 +952,18 @@ class DeviceWidgetListHandler(BaseHandler):
             "description": f"widget {widget_id} updated",
         })
 
-    def post(self):
+    async def post(self):
         data = json_decode(self.request.body)
+        if data.get('screenshot'):
+            image_data = base64.b64decode(data['screenshot'])
+        else:
+            # no screenshot from the browser, capture the screen now
+            image_data = await self.screen_image(data['deviceId'])
         widget_id = self.generate_id()
         target_dir = os.path.join(self.__store_dir, widget_id)
         os.makedirs(target_dir, exist_ok=True)
 
-        image_fd = io.BytesIO(base64.b64decode(data['screenshot']))
+        image_fd = io.BytesIO(image_data)
         im = Image.open(image_fd)
         im.save(pathjoin(target_dir, "screenshot.jpg"))
 
@@ -201,17 +1012,38 @@ class DeviceWidgetListHandler(BaseHandler):
 
 
 class DeviceScreenshotHandler(BaseHandler):
-    def get(self, serial):
+    async def get(self, serial):
+        """
+        Query:
+            since: etag of the last response, {"unchanged": true} is returned
+                when the screen is still the same
+            tolerance: see screen_tolerance
+        """
         logger.info("Serial: %s", serial)
         try:
-            d = get_device(serial)
-            buffer = io.BytesIO()
-            d.screenshot().convert("RGB").save(buffer, format='JPEG')
-            b64data = base64.b64encode(buffer.getvalue())
+            tolerance = self.screen_tolerance()
+        except ValueError as e:
+            self.set_status(400)
+            self.write({"success": False, "description": str(e)})
+            return
+        try:
+            data = await self.screen_image(serial)
+            options = {"fmt": "jpeg", "encoding": "base64"}
+            etag, fp = await self.screen_unchanged(data, tolerance, options)
+            if etag:
+                self.write({"unchanged": True, "etag": etag})
+                return
+            # jpeg from the device or the stream is passed through as it is
+            image, _ = await asyncio.wrap_future(
+                imageutils.submit(convert_image, data, "jpeg"))
+            etag = image_etag(image)
+            imageutils.fingerprints.put(etag, fp, options)
+            b64data = base64.b64encode(image)
             response = {
                 "type": "jpeg",
                 "encoding": "base64",
                 "data": b64data.decode('utf-8'),
+                "etag": etag,
             }
             self.write(response)
         except EnvironmentError as e:
@@ -221,17 +1053,46 @@ class DeviceScreenshotHandler(BaseHandler):
         except RuntimeError as e:
             self.set_status(500)  # Gone
             self.write({"description": traceback.format_exc()})
+
+
+class DeviceScreenshotRawHandler(BaseHandler):
+    async def get(self, device_id):
+        """
+        Screenshot as image bytes, with an ETag. X-Screen-Size has the size
+        of the full screenshot, before any crop or scale. 304 when the screen
+        did not change since the image of If-None-Match.
+
+        Query:
+            delta: 1 sends only changed tiles, see write_screen_delta
+            see image_options, screen_image and screen_unchanged
+        """
+        await self.write_screen(device_id)
+
+
+class CropHandler(BaseHandler):
+    async def get(self):
+        """
+        Crop of the current screen, used for widget templates
+
+        Query:
+            deviceId: connected device
+            region: x,y,w,h in screen pixels
+            see image_options for the rest
+        """
+        await self.write_screen(self.get_argument("deviceId"),
+                                region_required=True)
+
+
 class WindowSizeHandler(BaseHandler):
-    def get(self, serial):
+    async def get(self, serial):
         # logger.info("Serial: %s", serial)
         try:
-            d = get_device(serial)
-            size = d.device.window_size()
+            size = await self.run_device(serial, lambda d: d.device.window_size())
             response = {
                 "width": size[0],
                 "height": size[1]
             }
-            logger.info("device window size: %s", response) 
+            logger.info("device window size: %s", response)
             self.write(response)
         except EnvironmentError as e:
             traceback.print_exc()
@@ -271,36 +1132,27 @@ class WindowSizeHandler(BaseHandler):
 #             self.write({"description": traceback.print_exc()})
 
 class SelectedHandler(BaseHandler):
-    def get(self, serial):
+    async def get(self, serial):
         # logger.info("Serial: %s", serial)
         try:
-            d = get_device(serial)
             origin = parse.unquote(parse.unquote(self.get_argument("origin")))
             flag = parse.unquote(self.get_argument("flag"))
             index = self.get_argument("index", 0)
-            # if origin == 'text':
-            #     device = d.device(text=flag)
-            # elif origin == 'resource_id':
-            #     device = d.device(resourceId=flag, instance = index)
-            # elif origin == 'xpath':
-            #     device = d.device.xpath(flag)
-            # elif origin == 'description':
-            #     device = d.device(description=flag, instance = index)
-            device = d.weight(origin, flag, index)
-            if device.exists:
-                result = device.info['selected']
-                logger.info("element %s selected: %s", d.serial() , result)
-                self.write({
+            info, age = await self.query_element(serial, origin, flag, index)
+            if info:
+                result = info['selected']
+                logger.info("element %s selected: %s", serial, result)
+                self.write_element({
                     "success": True,
                     "selected": result
-                })
+                }, age)
             else:
-                logger.info("element %s is not exists", d.serial())
-                self.write({
+                logger.info("element %s is not exists", serial)
+                self.write_element({
                     "success": False,
                     "selected": False,
                     "msg": 'element is not exists'
-                })
+                }, age)
         except EnvironmentError as e:
             traceback.print_exc()
             self.set_status(430, "Environment Error")
@@ -312,37 +1164,28 @@ class SelectedHandler(BaseHandler):
             self.write({"description": traceback.print_exc()})
 
 class AssertSelectHandler(BaseHandler):
-    def get(self, serial):
+    async def get(self, serial):
         # logger.info("Serial: %s", serial)
         try:
-            d = get_device(serial)
             origin = parse.unquote(self.get_argument("origin"))
             flag = parse.unquote(self.get_argument("flag"))
             index = self.get_argument("index", 0)
             target = parse.unquote(self.get_argument("target"))
-            # if origin == 'text':
-            #     device = d.device(text=flag)
-            # elif origin == 'resource_id':
-            #     device = d.device(resourceId=flag, instance = index)
-            # elif origin == 'xpath':
-            #     device = d.device.xpath(flag)
-            # elif origin == 'description':
-            #     device = d.device(description=flag, instance = index)
-            device = d.weight(origin, flag, index)
-            if device.exists:
-                result = str(target).lower() == str(device.info['selected']).lower()
-                logger.info("element %s assert selected: %s", d.serial() , str(result))
-                self.write({
+            info, age = await self.query_element(serial, origin, flag, index)
+            if info:
+                result = str(target).lower() == str(info['selected']).lower()
+                logger.info("element %s assert selected: %s", serial, str(result))
+                self.write_element({
                     "success": True,
                     "result": result
-                })
+                }, age)
             else:
-                logger.info("element %s is not exists", d.serial())
-                self.write({
+                logger.info("element %s is not exists", serial)
+                self.write_element({
                     "success": False,
                     "result": False,
                     "msg": 'element is not exists'
-                })
+                }, age)
         except EnvironmentError as e:
             traceback.print_exc()
             logger.info("element assert selected: %s", e)
@@ -354,36 +1197,27 @@ class AssertSelectHandler(BaseHandler):
             self.write({"description": traceback.print_exc()})
 
 class EnabledHandler(BaseHandler):
-    def get(self, serial):
+    async def get(self, serial):
         # logger.info("Serial: %s", serial)
         try:
-            d = get_device(serial)
             origin = parse.unquote(self.get_argument("origin"))
             flag = parse.unquote(self.get_argument("flag"))
             index = self.get_argument("index", 0)
-            # if origin == 'text':
-            #     device = d.device(text=flag)
-            # elif origin == 'resource_id':
-            #     device = d.device(resourceId=flag, instance = index)
-            # elif origin == 'xpath':
-            #     device = d.device.xpath(flag)
-            # elif origin == 'description':
-            #     device = d.device(description=flag, instance = index)
-            device = d.weight(origin, flag, index)
-            if device.exists:
-                result = device.info['enabled']
-                logger.info("element %s enabled: %s", d.serial() , result)
-                self.write({
+            info, age = await self.query_element(serial, origin, flag, index)
+            if info:
+                result = info['enabled']
+                logger.info("element %s enabled: %s", serial, result)
+                self.write_element({
                     "success": True,
                     "enabled": result
-                })
+                }, age)
             else:
-                logger.info("element %s is not exists", d.serial())
-                self.write({
+                logger.info("element %s is not exists", serial)
+                self.write_element({
                     "success": False,
                     "enabled": False,
                     "msg": 'element is not exists'
-                })
+                }, age)
         except EnvironmentError as e:
             traceback.print_exc()
             self.set_status(430, "Environment Error")
@@ -396,37 +1230,28 @@ class EnabledHandler(BaseHandler):
 
 
 class AssertEnabledHandler(BaseHandler):
-    def get(self, serial):
+    async def get(self, serial):
         # logger.info("Serial: %s", serial)
         try:
-            d = get_device(serial)
             origin = parse.unquote(self.get_argument("origin"))
             flag = parse.unquote(self.get_argument("flag"))
             index = self.get_argument("index", 0)
             target = parse.unquote(self.get_argument("target"))
-            # if origin == 'text':
-            #     device = d.device(text=flag)
-            # elif origin == 'resource_id':
-            #     device = d.device(resourceId=flag, instance = index)
-            # elif origin == 'xpath':
-            #     device = d.device.xpath(flag)
-            # elif origin == 'description':
-            #     device = d.device(description=flag, instance = index)
-            device = d.weight(origin, flag, index)
-            if device.exists:
-                result = str(target).lower() == str(device.info['enabled']).lower()
-                logger.info("element %s enabled: %s", d.serial() , str(result))
-                self.write({
+            info, age = await self.query_element(serial, origin, flag, index)
+            if info:
+                result = str(target).lower() == str(info['enabled']).lower()
+                logger.info("element %s enabled: %s", serial, str(result))
+                self.write_element({
                     "success": True,
                     "result": result
-                })
+                }, age)
             else:
-                logger.info("element %s is not exists", d.serial())
-                self.write({
+                logger.info("element %s is not exists", serial)
+                self.write_element({
                     "success": False,
                     "result": False,
                     "msg": 'element is not exists'
-                })
+                }, age)
         except EnvironmentError as e:
             traceback.print_exc()
             self.set_status(430, "Environment Error")
@@ -438,37 +1263,39 @@ class AssertEnabledHandler(BaseHandler):
             self.write({"description": traceback.print_exc()})
 
 class ActivityHandler(BaseHandler):
-    def get(self, serial):
+    async def get(self, serial):
         # logger.info("Serial: %s", serial)
         try:
-            d = get_device(serial)
             package = self.get_argument("package", "")
             activity = self.get_argument("activity", "")
-            if not all([package, activity]):
-                d.device.app_start(package, activity)
-            elif not package:
-                d.device.app_start(package)
-            logger.info("device start app: %s %s", package, activity)   
+
+            def start_app(d):
+                if not all([package, activity]):
+                    d.device.app_start(package, activity)
+                elif not package:
+                    d.device.app_start(package)
+
+            await self.run_action(serial, start_app)
+            logger.info("device start app: %s %s", package, activity)
             self.write({
                 "success": True
             })
         except EnvironmentError as e:
             traceback.print_exc()
             self.set_status(430, "Environment Error")
-            logger.error("device start app: %s", e)   
+            logger.error("device start app: %s", e)
             self.write({"description": str(e)})
         except RuntimeError as e:
             self.set_status(410)  # Gone
-            logger.error("device start app: %s", e)   
+            logger.error("device start app: %s", e)
             self.write({"description": traceback.print_exc()})
 
 class PackageHandler(BaseHandler):
-    def get(self, serial):
+    async def get(self, serial):
         # logger.info("Serial: %s", serial)
         try:
-            d = get_device(serial)
-            current = d.device.app_current()
-            logger.info("device current app: %s", str(current))   
+            current = await self.run_device(serial, lambda d: d.device.app_current())
+            logger.info("device current app: %s", str(current))
             self.write({
                 "success": True,
                 "activity": current["activity"],
@@ -477,87 +1304,85 @@ class PackageHandler(BaseHandler):
         except EnvironmentError as e:
             traceback.print_exc()
             self.set_status(430, "Environment Error")
-            logger.error("device current app: %s", e)  
+            logger.error("device current app: %s", e)
             self.write({"description": str(e)})
         except RuntimeError as e:
             self.set_status(410)  # Gone
-            logger.error("device current app: %s", e)  
+            logger.error("device current app: %s", e)
             self.write({"description": traceback.print_exc()})
 
 
 
 class ClickHandler(BaseHandler):
-    def get(self, serial):
+    async def get(self, serial):
         # logger.info("Serial: %s", serial)
         try:
-            d = get_device(serial)
             origin = parse.unquote(self.get_argument("origin"))
             flag = parse.unquote(self.get_argument("flag"))
             index = self.get_argument("index", 0)
-            # if origin == 'text':
-            #     device = d.device(text=flag)
-            # elif origin == 'resource_id':
-            #     device = d.device(resourceId=flag, instance = index)
-            # elif origin == 'xpath':
-            #     device = d.device.xpath(flag)
-            # elif origin == 'description':
-            #     device = d.device(description=flag, instance = index)
-            device = d.weight(origin, flag, index)
-            if device.exists:
-                device.click()
-                logger.info("device click: %s", d.serial())  
-                self.write({
-                    "success": True
-                })
-            else:
+
+            def click(d):
+                if d.click_element(origin, flag, index):
+                    logger.info("device click: %s", d.serial())
+                    return {
+                        "success": True
+                    }
                 logger.info("element %s is not exists", d.serial())
-                self.write({
+                return {
                     "success": False,
                     "msg": 'element is not exists'
-                })
+                }
+
+            self.write(await self.run_action(serial, click))
         except EnvironmentError as e:
             traceback.print_exc()
             self.set_status(430, "Environment Error")
-            logger.error("device click: %s", e)  
+            logger.error("device click: %s", e)
             self.write({"description": str(e)})
             logger.error(e)
         except RuntimeError as e:
             self.set_status(410)  # Gone
-            logger.error("device click: %s", e)  
+            logger.error("device click: %s", e)
             self.write({"description": traceback.print_exc()})
 
 class TapHandler(BaseHandler):
-    def get(self, serial):
+    async def get(self, serial):
         # logger.info("Serial: %s", serial)
         try:
-            d = get_device(serial)
             x = self.get_argument("x", '0')
             y = self.get_argument("y", '0')
-            d.click(int(x), int(y))
-            logger.info("device tap: %s", d.serial())  
+
+            def tap(d):
+                d.click(int(x), int(y))
+                logger.info("device tap: %s", d.serial())
+
+            await self.run_action(serial, tap)
             self.write({
                 "success": True
             })
         except EnvironmentError as e:
             traceback.print_exc()
             self.set_status(430, "Environment Error")
-            logger.error("device tap: %s", e)  
+            logger.error("device tap: %s", e)
             self.write({"description": str(e)})
         except RuntimeError as e:
             self.set_status(410)  # Gone
-            logger.error("device tap: %s", e)  
+            logger.error("device tap: %s", e)
             self.write({"description": traceback.print_exc()})
 
 class LongTapHandler(BaseHandler):
-    def get(self, serial):
+    async def get(self, serial):
         # logger.info("Serial: %s", serial)
         try:
-            d = get_device(serial)
             x = self.get_argument("x", '0')
             y = self.get_argument("y", '0')
             duration = self.get_argument("duration", '0.5')
-            d.long_click(int(x), int(y), float(duration))
-            logger.info("device long tap: %s", d.serial())  
+
+            def long_tap(d):
+                d.long_click(int(x), int(y), float(duration))
+                logger.info("device long tap: %s", d.serial())
+
+            await self.run_action(serial, long_tap)
             self.write({
                 "success": True
             })
@@ -572,17 +1397,20 @@ class LongTapHandler(BaseHandler):
             self.write({"description": traceback.print_exc()})
 
 class SwipeHandler(BaseHandler):
-    def get(self, serial):
+    async def get(self, serial):
         # logger.info("Serial: %s", serial)
         try:
-            d = get_device(serial)
             x1 = self.get_argument("x1", '0')
             y1 = self.get_argument("y1", '0')
             x2 = self.get_argument("x2", '0')
             y2 = self.get_argument("y2", '0')
             duration = self.get_argument("duration", '0.5')
-            d.swipe(x1, y1, x2, y2, duration)
-            logger.info("device swipe: %s", d.serial())
+
+            def swipe(d):
+                d.swipe(x1, y1, x2, y2, duration)
+                logger.info("device swipe: %s", d.serial())
+
+            await self.run_action(serial, swipe)
             self.write({
                 "success": True
             })
@@ -597,13 +1425,16 @@ class SwipeHandler(BaseHandler):
             self.write({"description": traceback.print_exc()})
 
 class PressHandler(BaseHandler):
-    def get(self, serial):
+    async def get(self, serial):
         # logger.info("Serial: %s", serial)
         try:
-            d = get_device(serial)
             key = self.get_argument("key", "back")
-            d.press(key)
-            logger.info("device press: %s key %s", d.serial(), key)
+
+            def press(d):
+                d.press(key)
+                logger.info("device press: %s key %s", d.serial(), key)
+
+            await self.run_action(serial, press)
             self.write({
                 "success": True
             })
@@ -618,14 +1449,17 @@ class PressHandler(BaseHandler):
             self.write({"description": traceback.print_exc()})
 
 class SwipeExtHandler(BaseHandler):
-    def get(self, serial):
+    async def get(self, serial):
         # logger.info("Serial: %s", serial)
         try:
-            d = get_device(serial)
             direction = self.get_argument("direction", 'up')
             scaleNum = self.get_argument("scale", '0.8')
-            d.swipe_ext(direction, scaleNum)
-            logger.info("device swipe ext: %s direction %s", d, direction)
+
+            def swipe_ext(d):
+                d.swipe_ext(direction, scaleNum)
+                logger.info("device swipe ext: %s direction %s", d, direction)
+
+            await self.run_action(serial, swipe_ext)
             self.write({
                 "success": True
             })
@@ -641,34 +1475,25 @@ class SwipeExtHandler(BaseHandler):
 
 
 class TextHandler(BaseHandler):
-    def get(self, serial):
+    async def get(self, serial):
         # logger.info("Serial: %s", serial)
         try:
-            d = get_device(serial)
             origin = parse.unquote(self.get_argument("origin"))
             flag = parse.unquote(self.get_argument("flag"))
             index = self.get_argument("index", 0)
-            device = d.weight(origin, flag, index)
-            # if origin == 'text':
-            #     device = d.device(text=flag)
-            # elif origin == 'resource_id':
-            #     device = d.device(resourceId=flag, instance = index)
-            # elif origin == 'xpath':
-            #     device = d.device.xpath(flag)
-            # elif origin == 'description':
-            #     device = d.device(description=flag, instance = index)
-            if device.exists:
-                text = device.get_text()
-                logger.info("element: %s get text: %s", device, text)
-                self.write({
+            info, age = await self.query_element(serial, origin, flag, index)
+            if info:
+                text = info['text']
+                logger.info("element: %s get text: %s", serial, text)
+                self.write_element({
                     "text": text
-                })
+                }, age)
             else:
-                logger.info("element %s is not exists", d.serial())
-                self.write({
+                logger.info("element %s is not exists", serial)
+                self.write_element({
                     "text": "",
                     "msg": 'element is not exists'
-                })
+                }, age)
         except EnvironmentError as e:
             traceback.print_exc()
             self.set_status(430, "Environment Error")
@@ -680,37 +1505,28 @@ class TextHandler(BaseHandler):
             self.write({"description": traceback.print_exc()})
 
 class AssertTextHandler(BaseHandler):
-    def get(self, serial):
+    async def get(self, serial):
         # logger.info("Serial: %s", serial)
         try:
-            d = get_device(serial)
             origin = parse.unquote(self.get_argument("origin"))
             flag = parse.unquote(self.get_argument("flag"))
             index = self.get_argument("index", 0)
             target = parse.unquote(self.get_argument("target"))
-            device = d.weight(origin, flag, index)
-            # if origin == 'text':
-            #     device = d.device(text=flag)
-            # elif origin == 'resource_id':
-            #     device = d.device(resourceId=flag, instance = index)
-            # elif origin == 'xpath':
-            #     device = d.device.xpath(flag)
-            # elif origin == 'description':
-            #     device = d.device(description=flag, instance = index)
-            if device.exists:
-                text = device.get_text()
+            info, age = await self.query_element(serial, origin, flag, index)
+            if info:
+                text = info['text']
                 result = text == target
-                logger.info("element: %s get text: %s, assert text result: %s", device, text, str(result))
-                self.write({
+                logger.info("element: %s get text: %s, assert text result: %s", serial, text, str(result))
+                self.write_element({
                     "success": True,
                     "result": result
-                })
+                }, age)
             else:
-                logger.info("element %s is not exists", d.serial())
-                self.write({
+                logger.info("element %s is not exists", serial)
+                self.write_element({
                     "result": False,
                     "msg": 'element is not exists'
-                })
+                }, age)
         except EnvironmentError as e:
             traceback.print_exc()
             self.set_status(430, "Environment Error")
@@ -720,38 +1536,29 @@ class AssertTextHandler(BaseHandler):
             self.set_status(410)  # Gone
             logger.error("element assert text: %s", e)
             self.write({"description": traceback.print_exc()})
-            
+
 class InputHandler(BaseHandler):
-    def get(self, serial):
+    async def get(self, serial):
         # logger.info("Serial: %s", serial)
         try:
-            d = get_device(serial)
             origin = parse.unquote(self.get_argument("origin"))
             flag = parse.unquote(self.get_argument("flag"))
             index = self.get_argument("index", 0)
             inputText = self.get_argument("input", "")
-            device = d.weight(origin, flag, index)
-            # if origin == 'text':
-            #     device = d.device(text=flag, instance = index)
-            # elif origin == 'resource_id':
-            #     device = d.device(resourceId=flag, instance = index)
-            # elif origin == 'xpath':
-            #     device = d.device.xpath(flag)
-            # elif origin == 'description':
-            #     device = d.device(description=flag, instance = index)
-            
-            if device.exists:
-                device.set_text(inputText)
-                logger.info("element: %s set text: %s", device, inputText)
-                self.write({
-                    "success": True
-                })
-            else:
+
+            def set_text(d):
+                if d.set_element_text(origin, flag, index, inputText):
+                    logger.info("element: %s set text: %s", flag, inputText)
+                    return {
+                        "success": True
+                    }
                 logger.info("element %s is not exists", d.serial())
-                self.write({
+                return {
                     "result": False,
                     "msg": 'element is not exists'
-                })
+                }
+
+            self.write(await self.run_action(serial, set_text))
         except EnvironmentError as e:
             traceback.print_exc()
             self.set_status(430, "Environment Error")
@@ -764,28 +1571,19 @@ class InputHandler(BaseHandler):
 
 
 class ExistsHandler(BaseHandler):
-    def get(self, serial):
+    async def get(self, serial):
         logger.info("Serial: %s", serial)
         try:
-            d = get_device(serial)
             origin = parse.unquote(self.get_argument("origin"))
             flag = parse.unquote(self.get_argument("flag"))
             index = self.get_argument("index", 0)
-            # if origin == 'text':
-            #     device = d.device(text=flag, instance = index)
-            # elif origin == 'resource_id':
-            #     device = d.device(resourceId=flag, instance = index)
-            # elif origin == 'xpath':
-            #     device = d.device.xpath(flag)
-            # elif origin == 'description':
-            #     device = d.device(description=flag, instance = index)
-            device = d.weight(origin, flag, index)
-            result = device.exists
-            logger.info("element %s is exists result: %s", d.serial(), result)
-            self.write({
+            info, age = await self.query_element(serial, origin, flag, index)
+            result = info is not None
+            logger.info("element %s is exists result: %s", serial, result)
+            self.write_element({
                     "success": True,
                     "exists": result
-                })
+                }, age)
         except EnvironmentError as e:
             traceback.print_exc()
             self.set_status(430, "Environment Error")
@@ -798,31 +1596,21 @@ class ExistsHandler(BaseHandler):
 
 
 class AssertExistsHandler(BaseHandler):
-    def get(self, serial):
+    async def get(self, serial):
         # logger.info("Serial: %s", serial)
         try:
-            d = get_device(serial)
             origin = parse.unquote(self.get_argument("origin"))
             flag = parse.unquote(self.get_argument("flag"))
             index = self.get_argument("index", 0)
             target = parse.unquote(self.get_argument("target"))
-            device = d.weight(origin, flag, index)
-            # if origin == 'text':
-            #     device = d.device(text=flag)
-            # elif origin == 'resource_id':
-            #     device = d.device(resourceId=flag, instance = index)
-            # elif origin == 'xpath':
-            #     device = d.device.xpath(flag)
-            # elif origin == 'description':
-            #     device = d.device(description=flag, instance = index)
-            exists = device.exists
-            print(str(exists).lower() == target)
+            info, age = await self.query_element(serial, origin, flag, index)
+            exists = info is not None
             result = str(exists).lower() == str(target).lower()
-            logger.info("element: %s  is exists: %s, assert exists result: %s", device, str(exists), str(result))
-            self.write({
+            logger.info("element: %s  is exists: %s, assert exists result: %s", serial, str(exists), str(result))
+            self.write_element({
                 "success": True,
                 "exists": result
-            })
+            }, age)
         except EnvironmentError as e:
             traceback.print_exc()
             self.set_status(430, "Environment Error")
@@ -834,18 +1622,22 @@ class AssertExistsHandler(BaseHandler):
             self.write({"description": traceback.print_exc()})
 
 class InstallHandler(BaseHandler):
-    def get(self, serial):
+    async def get(self, serial):
         # logger.info("Serial: %s", serial)
         try:
-            if serial.find(":")!=-1:
-                platform, uri = serial.split(":", maxsplit=1)
-            else:
-                uri = get_device(serial).device.device_info["serial"]
             installUrl = self.get_argument("installUrl")
-            cmd = "adb -s " + uri + " install " + installUrl
-            logger.info("install apk:" + cmd)
-            pi= subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-            result = pi.stdout.read().decode()
+
+            def install(d):
+                if serial.find(":")!=-1:
+                    platform, uri = serial.split(":", maxsplit=1)
+                else:
+                    uri = d.device.device_info["serial"]
+                cmd = "adb -s " + uri + " install " + installUrl
+                logger.info("install apk:" + cmd)
+                pi= subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
+                return pi.stdout.read().decode()
+
+            result = await self.run_action(serial, install)
             logger.info("install apk result:" + result)
             self.write({
                 "success": result.find("Success") != -1,
@@ -861,19 +1653,22 @@ class InstallHandler(BaseHandler):
             self.write({"description": traceback.print_exc()})
 
 class UnInstallHandler(BaseHandler):
-    def get(self, serial):
+    async def get(self, serial):
         # logger.info("Serial: %s", serial)
         try:
-            if serial.find(":")!=-1:
-                platform, uri = serial.split(":", maxsplit=1)
-            else:
-                uri = get_device(serial).device.device_info["serial"]
             package = self.get_argument("package")
-            cmd = "adb -s " + uri + " uninstall " + package
-            logger.info("uninstall apk:" + cmd)
-            pi= subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-            result = pi.stdout.read().decode()
-            print(result)
+
+            def uninstall(d):
+                if serial.find(":")!=-1:
+                    platform, uri = serial.split(":", maxsplit=1)
+                else:
+                    uri = d.device.device_info["serial"]
+                cmd = "adb -s " + uri + " uninstall " + package
+                logger.info("uninstall apk:" + cmd)
+                pi= subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
+                return pi.stdout.read().decode()
+
+            result = await self.run_action(serial, uninstall)
             logger.info("uninstall apk result:" + result)
             self.write({
                 "success": result.find("Success") != -1,
@@ -889,33 +1684,164 @@ class UnInstallHandler(BaseHandler):
             self.write({"description": traceback.print_exc()})
 
 
-class DevicesHandler(BaseHandler):
-    def get(self):
+class DeviceBatchHandler(BaseHandler):
+    async def post(self, device_id):
+        """
+        Run many actions in one request, back to back on the device worker.
+        Steps take the query arguments of the single action handlers.
+
+        Body:
+            {"steps": [{"action": "tap", "x": 10, "y": 20, "delay": 0.5},
+                       {"action": "assert_text", "origin": "text",
+                        "flag": "OK", "target": "OK"}],
+             "stopOnFailure": true, "delay": 0}
+        """
         try:
-            devices = get_devices()
-            self.write({
-                "success": True,
-                "result": devices
-            })
+            steps, stop_on_failure = parse_batch(json_decode(self.request.body))
+        except ValueError as e:
+            self.set_status(400)
+            self.write({"success": False, "description": str(e)})
+            return
+
+        def batch(d):
+            return run_batch(d, steps, stop_on_failure)
+
+        run = self.run_action if changes_screen(steps) else self.run_device
+        try:
+            ret = await run(device_id, batch)
+            logger.info("device batch: %s %d/%d steps done in %.2fs", device_id,
+                        ret["completed"], len(steps), ret["duration"])
+            self.write(ret)
         except EnvironmentError as e:
-            traceback.print_exc()
             self.set_status(430, "Environment Error")
-            logger.error("devices list failed: %s", e)
-            self.write({"description": str(e)})
+            logger.error("device batch: %s", e)
+            self.write({"success": False, "description": str(e)})
         except RuntimeError as e:
             self.set_status(410)  # Gone
-            logger.error("devices list failed: %s", e)
-            self.write({"description": traceback.print_exc()})
-    
+            logger.error("device batch: %s", e)
+            self.write({"success": False, "description": str(e)})
+
+
+class FanOutHandler(BaseHandler):
+    async def post(self):
+        """
+        Run one action or batch on many devices at the same time
+
+        Body:
+            {"devices": ["android:10.0.0.2", ...] or "all",
+             "steps": [...] or "action": {"action": "tap", "x": 10, "y": 20},
+             "stopOnFailure": true, "parallel": 8, "timeout": 60}
+
+        A device still busy after timeout seconds is reported as timed out,
+        the steps it started still finish on its worker and keep its slot
+        of parallel. A device waiting as long for a slot times out as well.
+        """
+        connected = [
+            id for id in list(cached_devices) if cached_devices.is_connected(id)
+        ]
+        try:
+            device_ids, (steps, stop_on_failure), parallel, timeout = \
+                parse_fanout(json_decode(self.request.body), connected)
+        except ValueError as e:
+            self.set_status(400)
+            self.write({"success": False, "description": str(e)})
+            return
+
+        def batch(d):
+            return run_batch(d, steps, stop_on_failure)
+
+        submit_to = submit_action if changes_screen(steps) else submit_device
+        semaphore = asyncio.Semaphore(parallel)
+        loop = asyncio.get_event_loop()
+        start = time.time()
+
+        async def run_on(device_id):
+            ret = {"deviceId": device_id}
+            try:
+                await asyncio.wait_for(semaphore.acquire(), timeout)
+            except asyncio.TimeoutError:
+                ret.update(queued=time.time() - start, success=False,
+                           timeout=True,
+                           error="no free slot after %gs" % timeout)
+                return ret
+            device_start = time.time()
+            ret["queued"] = device_start - start
+            # a counter of its own, a job still running after the timeout
+            # would go on counting into the response headers
+            counter = {}
+            try:
+                future = submit_to(device_id, count_rpc(batch, counter))
+            except Exception as e:
+                semaphore.release()
+                ret.update(success=False, error=str(e), latency=0)
+                return ret
+            # the slot is free once the device is, not when we stop waiting
+            future.add_done_callback(
+                lambda f: loop.call_soon_threadsafe(semaphore.release))
+            try:
+                # on timeout a job still queued on the worker is dropped,
+                # one already running finishes there
+                ret.update(await asyncio.wait_for(asyncio.wrap_future(future),
+                                                  timeout))
+            except asyncio.TimeoutError:
+                ret.update(success=False, timeout=True,
+                           error="no result after %gs" % timeout)
+            except Exception as e:
+                ret.update(success=False, error=str(e))
+            if future.done() and not future.cancelled():
+                for name, calls in counter.items():
+                    self.rpc_calls[name] = self.rpc_calls.get(name, 0) + calls
+            ret["latency"] = time.time() - device_start
+            return ret
+
+        results = await asyncio.gather(*[run_on(id) for id in device_ids])
+        failed = [r["deviceId"] for r in results if not r["success"]]
+        if failed:
+            logger.warning("fan-out failed on %s", ", ".join(failed))
+        self.write({
+            "success": not failed,
+            "duration": time.time() - start,
+            "devices": results,
+        })
+
+
+class DevicesHandler(BaseHandler):
+    async def get(self):
+        """
+        Info of the connected devices. A device which is down, or goes down
+        while it answers, is left out instead of failing the whole list.
+        """
+        device_ids = [
+            id for id in list(cached_devices) if cached_devices.is_connected(id)
+        ]
+        # every device answers on its own worker, so they run in parallel
+        results = await asyncio.gather(*[
+            self.run_device(id, describe_device, id) for id in device_ids
+        ], return_exceptions=True)
+        devices = []
+        for id, ret in zip(device_ids, results):
+            if isinstance(ret, Exception):
+                logger.warning("devices list: %s failed: %s", id, ret)
+            else:
+                devices.append(ret)
+        self.write({
+            "success": True,
+            "result": devices
+        })
+
 
 class TellHandler(BaseHandler):
-    def get(self, serial):
+    async def get(self, serial):
         try:
-            d = get_device(serial)
             phone = self.get_argument("phone", "")
-            cmd = "adb -s " + d.serial() + " shell am start -a android.intent.action.CALL tel:" + phone
-            process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE).stdout.read()
-            logger.info("devices send call command: %s ,result: success", cmd)
+
+            def call(d):
+                cmd = "adb -s " + d.serial() + " shell am start -a android.intent.action.CALL tel:" + phone
+                process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE).stdout.read()
+                logger.info("devices send call command: %s ,result: success", cmd)
+                return process
+
+            process = await self.run_action(serial, call)
             self.write({
                 "success": True,
                 "result": parse.quote(process)
@@ -929,14 +1855,17 @@ class TellHandler(BaseHandler):
             self.set_status(410)  # Gone
             logger.error("devices send call failed: %s", e)
             self.write({"description": traceback.print_exc()})
-            
+
 class EndTellHandler(BaseHandler):
-    def get(self, serial):
+    async def get(self, serial):
         try:
-            d = get_device(serial)
-            cmd = "adb -s " + d.serial() + " shell input  keyevent  KEYCODE_ENDCALL"
-            process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE).stdout.read()
-            logger.info("devices end call command: %s ,result: success", cmd)
+            def end_call(d):
+                cmd = "adb -s " + d.serial() + " shell input  keyevent  KEYCODE_ENDCALL"
+                process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE).stdout.read()
+                logger.info("devices end call command: %s ,result: success", cmd)
+                return process
+
+            process = await self.run_action(serial, end_call)
             self.write({
                 "success": True,
                 "result": parse.quote(process)
@@ -0,0 +1,100 @@
+# coding: utf-8
+#
+# Live screen of a device shared by many viewers
+#
+# One minicap connection per device (see screenstream.ScreenStream) is fanned
+# out to every viewer, as MJPEG or as binary websocket messages.
+
+import tornado.iostream
+import tornado.websocket
+from logzero import logger
+from tornado.ioloop import IOLoop
+
+from ..device import leave_screen_stream, start_screen_stream
+from .page import BaseHandler
+
+BOUNDARY = "weditorframe"
+
+
+class ScreenMJPEGHandler(BaseHandler):
+    _viewer = None
+
+    async def get(self, device_id):
+        """
+        multipart/x-mixed-replace stream of jpeg frames, works in an <img>
+        """
+        stream = start_screen_stream(device_id)
+        if stream is None:
+            self.set_status(404)
+            self.write({
+                "success": False,
+                "description": "device %s has no screen stream" % device_id,
+            })
+            return
+        viewer = self._viewer = stream.subscribe("mjpeg:" +
+                                                 self.request.remote_ip)
+        self.set_header("Content-Type",
+                        "multipart/x-mixed-replace; boundary=" + BOUNDARY)
+        self.set_header("Cache-Control", "no-cache")
+        try:
+            while True:
+                frame = await viewer.get()
+                if frame is None:
+                    break
+                self.write(b"--%s\r\nContent-Type: image/jpeg\r\n"
+                           b"Content-Length: %d\r\n\r\n" %
+                           (BOUNDARY.encode(), len(frame.data)))
+                self.write(frame.data)
+                self.write(b"\r\n")
+                await self.flush()
+                viewer.sent(frame)
+        except tornado.iostream.StreamClosedError:
+            pass
+        finally:
+            leave_screen_stream(device_id, stream, viewer)
+
+    def on_connection_close(self):
+        if self._viewer is not None:
+            self._viewer.close()
+
+
+class ScreenWebSocketHandler(tornado.websocket.WebSocketHandler):
+    """ every jpeg frame is sent as one binary message, like minicap does """
+    _device_id = None
+    _stream = None
+    _viewer = None
+
+    def check_origin(self, origin):
+        return True
+
+    def open(self, device_id):
+        self._device_id = device_id
+        self._stream = start_screen_stream(device_id)
+        if self._stream is None:
+            self.close(4004, "device %s has no screen stream" % device_id)
+            return
+        self._viewer = self._stream.subscribe("ws:" + self.request.remote_ip)
+        IOLoop.current().spawn_callback(self._send_frames)
+
+    async def _send_frames(self):
+        viewer = self._viewer
+        try:
+            while True:
+                frame = await viewer.get()
+                if frame is None:
+                    break
+                await self.write_message(frame.data, binary=True)
+                viewer.sent(frame)
+        except tornado.websocket.WebSocketClosedError:
+            pass
+        except Exception:
+            logger.exception("screen websocket error")
+        finally:
+            leave_screen_stream(self._device_id, self._stream, viewer)
+
+    def on_message(self, message):
+        pass
+
+    def on_close(self):
+        if self._viewer is not None:
+            self._viewer.close()
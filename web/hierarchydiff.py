@@ -0,0 +1,135 @@
+# coding: utf-8
+#
+# Structural diff between two hierarchy dumps, used by the v3 hierarchy api
+#
+# A hierarchy is flattened into {_id: record}, where record holds the node
+# attributes and "children" is the ordered list of child ids. Node ids are
+# derived from the tree path (see uidumplib.make_node_id), so the same node
+# has the same id in both dumps.
+
+import collections
+import hashlib
+import json
+import threading
+
+_MISSING = object()
+
+
+def hierarchy_version(data: dict) -> str:
+    """ cheap content token of a dump_hierarchy2 result """
+    h = hashlib.blake2b(digest_size=8)
+    if data.get("xmlHierarchy"):
+        h.update(data["xmlHierarchy"].encode('utf-8'))
+    else:
+        h.update(json.dumps(data["jsonHierarchy"]).encode('utf-8'))
+    for key in ("activity", "packageName", "windowSize"):
+        h.update(repr(data.get(key)).encode('utf-8'))
+    return h.hexdigest()
+
+
+def flatten_hierarchy(root: dict) -> dict:
+    nodes = {}
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        record = {k: v for k, v in node.items() if k != 'children'}
+        children = node.get('children')
+        if children is not None:
+            record['children'] = [child['_id'] for child in children]
+            stack.extend(children)
+        nodes[node['_id']] = record
+    return nodes
+
+
+def diff_hierarchy(old: dict, new: dict) -> dict:
+    """
+    Args:
+        old, new: flattened hierarchies
+
+    Returns:
+        {"added": {_id: record}, "removed": [_id], "changed": {_id: {key: value}},
+        "removedKeys": {_id: [key]}}, a value may be None itself so removed
+        attributes are listed apart
+    """
+    added = {}
+    changed = {}
+    removed_keys = {}
+    for node_id, record in new.items():
+        prev = old.get(node_id)
+        if prev is None:
+            added[node_id] = record
+        elif prev != record:
+            attrs = {}
+            for key, value in record.items():
+                if prev.get(key, _MISSING) != value:
+                    attrs[key] = value
+            if attrs:
+                changed[node_id] = attrs
+            gone = [key for key in prev if key not in record]
+            if gone:
+                removed_keys[node_id] = gone
+    removed = [node_id for node_id in old if node_id not in new]
+    return {"added": added, "removed": removed, "changed": changed,
+            "removedKeys": removed_keys}
+
+
+class HierarchySessions(object):
+    """ last flattened snapshot sent to each (device, client), LRU bounded """
+
+    def __init__(self, max_sessions=64):
+        self._max_sessions = max_sessions
+        self._sessions = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is not None:
+                self._sessions.move_to_end(key)
+            return session
+
+    def put(self, key, version, nodes):
+        with self._lock:
+            self._sessions[key] = (version, nodes)
+            self._sessions.move_to_end(key)
+            while len(self._sessions) > self._max_sessions:
+                self._sessions.popitem(last=False)
+
+    def make_patch(self, key, data: dict, client_version: str = None) -> dict:
+        """
+        Compare a new dump with the snapshot last sent to this client
+
+        Returns:
+            {"changed": False, "version"} when the client is up to date,
+            a patch against client_version when the server still has it,
+            otherwise the full jsonHierarchy
+        """
+        version = hierarchy_version(data)
+        meta = {
+            "version": version,
+            "activity": data.get("activity"),
+            "packageName": data.get("packageName"),
+            "windowSize": data.get("windowSize"),
+        }
+        if version == client_version:
+            return {"changed": False, "version": version}
+
+        root = data["jsonHierarchy"]
+        nodes = flatten_hierarchy(root)
+        session = self.get(key)
+        self.put(key, version, nodes)
+        if session is not None and session[0] == client_version:
+            meta.update({
+                "changed": True,
+                "full": False,
+                "base": client_version,
+                "root": root["_id"],
+                "patch": diff_hierarchy(session[1], nodes),
+            })
+        else:
+            meta.update({
+                "changed": True,
+                "full": True,
+                "jsonHierarchy": root,
+            })
+        return meta
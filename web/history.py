@@ -0,0 +1,144 @@
+# coding: utf-8
+#
+# Recent screenshots of a device, kept for replay
+#
+# Frames are stored encoded (jpeg) together with the time they were taken
+# and the action that ran on the device before. The buffer is capped in
+# bytes: the oldest frames are dropped to make room for new ones.
+
+import collections
+import io
+import json
+import threading
+import time
+import zipfile
+
+from .imageutils import convert_image, image_etag, sniff_format
+
+# bytes of frames kept per device, 0 disables the history
+MAX_BYTES = 32 * 1024 * 1024
+
+# quality of frames which are stored as jpeg after converting them
+STORE_QUALITY = 70
+
+
+class HistoryFrame(object):
+    __slots__ = ('id', 'timestamp', 'data', 'fmt', 'digest', 'source',
+                 'action', 'action_time')
+
+    def __init__(self, id: int, timestamp: float, data: bytes, fmt: str,
+                 digest: str, source: str = None, action: str = None,
+                 action_time: float = None):
+        self.id = id
+        self.timestamp = timestamp
+        self.data = data
+        self.fmt = fmt
+        self.digest = digest
+        self.source = source
+        self.action = action
+        self.action_time = action_time
+
+    def to_json(self) -> dict:
+        return {
+            "id": self.id,
+            "timestamp": self.timestamp,
+            "format": self.fmt,
+            "byteSize": len(self.data),
+            "source": self.source,
+            "action": self.action,
+            "actionTime": self.action_time,
+        }
+
+
+class FrameHistory(object):
+    """
+    Ring buffer of the recent frames of one device, bounded by max_bytes
+    instead of a frame count, since frame sizes vary a lot between screens.
+    """
+
+    def __init__(self, max_bytes: int = None):
+        self._max_bytes = MAX_BYTES if max_bytes is None else max_bytes
+        self._lock = threading.Lock()
+        self._frames = collections.deque()
+        self._bytes = 0
+        self._next_id = 1
+        self._dropped = 0
+
+    def add(self, data: bytes, timestamp: float = None, source: str = None,
+            action: str = None, action_time: float = None) -> HistoryFrame:
+        """
+        Store a frame, converted to jpeg unless it is one already. A frame
+        equal to the latest one is not stored again.
+
+        Returns:
+            the new HistoryFrame, None when it was not stored
+        """
+        if self._max_bytes <= 0:
+            return None
+        digest = image_etag(data)
+        with self._lock:
+            if self._frames and self._frames[-1].digest == digest:
+                return None
+        fmt = sniff_format(data)
+        if fmt != "jpeg":
+            data, fmt = convert_image(data, "jpeg", STORE_QUALITY)
+        if len(data) > self._max_bytes:
+            return None
+        with self._lock:
+            frame = HistoryFrame(self._next_id, timestamp or time.time(), data,
+                                 fmt, digest, source, action, action_time)
+            self._next_id += 1
+            self._frames.append(frame)
+            self._bytes += len(data)
+            while self._bytes > self._max_bytes:
+                self._bytes -= len(self._frames.popleft().data)
+                self._dropped += 1
+            return frame
+
+    def list(self, since: int = 0) -> list:
+        """
+        Returns:
+            HistoryFrame with an id above since, oldest first
+        """
+        with self._lock:
+            return [f for f in self._frames if f.id > since]
+
+    def get(self, frame_id: int) -> HistoryFrame:
+        with self._lock:
+            for frame in self._frames:
+                if frame.id == frame_id:
+                    return frame
+        return None
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self._bytes = 0
+
+    def export(self, since: int = 0) -> bytes:
+        """
+        Returns:
+            zip with frames/<id>.jpg and index.json listing them in order
+        """
+        frames = self.list(since)
+        buffer = io.BytesIO()
+        # frames are jpeg, deflating them again only costs time
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as zf:
+            index = []
+            for frame in frames:
+                name = "frames/%06d.%s" % (frame.id, frame.fmt.replace(
+                    "jpeg", "jpg"))
+                zf.writestr(name, frame.data)
+                index.append(dict(frame.to_json(), file=name))
+            zf.writestr("index.json", json.dumps(index, indent=2))
+        return buffer.getvalue()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "frames": len(self._frames),
+                "bytes": self._bytes,
+                "maxBytes": self._max_bytes,
+                "dropped": self._dropped,
+                "oldest": self._frames[0].timestamp if self._frames else None,
+            }
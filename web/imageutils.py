@@ -0,0 +1,283 @@
+# coding: utf-8
+#
+# Screenshot encoding helpers
+
+import collections
+import hashlib
+import io
+import math
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from PIL import Image
+
+try:
+    import numpy as np
+except ImportError:  # the thumbnails are small, plain python compares them too
+    np = None
+
+# format name -> Content-Type
+CONTENT_TYPES = {
+    "jpeg": "image/jpeg",
+    "png": "image/png",
+    "webp": "image/webp",
+}
+
+DEFAULT_QUALITY = {
+    "jpeg": 80,
+    "webp": 80,
+}
+
+# named sets of process_image arguments, explicit arguments win
+PRESETS = {
+    "preview": {"quality": 60, "max_width": 1280},
+    "standard": {"quality": 80},
+    "high": {"quality": 95},
+    "lossless": {"format": "png"},
+}
+
+# grayscale thumbnail compared by change detection, and the difference of a
+# thumbnail pixel (0-255) which counts as a change
+THUMBNAIL_SIZE = (32, 32)
+PIXEL_THRESHOLD = 24
+
+# image work is CPU bound, it runs here instead of on the event loop or on
+# the device workers
+_pool = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1),
+                           thread_name_prefix="image")
+
+
+def submit(fn, *args, **kwargs) -> Future:
+    """ run fn on the shared image pool """
+    return _pool.submit(fn, *args, **kwargs)
+
+
+def sniff_format(data: bytes):
+    """
+    Returns:
+        "jpeg", "png", "webp" or None
+    """
+    if data[:3] == b"\xff\xd8\xff":
+        return "jpeg"
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+def encode_image(im: Image.Image, fmt: str, quality: int = None) -> bytes:
+    """
+    Raises:
+        ValueError when the format is unknown
+    """
+    if fmt not in CONTENT_TYPES:
+        raise ValueError("Unknown image format", fmt)
+    if fmt == "jpeg" and im.mode != "RGB":
+        im = im.convert("RGB")
+    buffer = io.BytesIO()
+    if fmt == "png":
+        # screenshots are large, a fast compress level matters more than size
+        im.save(buffer, format="PNG", compress_level=1)
+    else:
+        im.save(buffer,
+                format=fmt.upper(),
+                quality=quality or DEFAULT_QUALITY[fmt])
+    return buffer.getvalue()
+
+
+def parse_region(text: str):
+    """ "x,y,w,h" -> (x, y, w, h) """
+    try:
+        region = tuple(int(float(v)) for v in text.split(","))
+    except ValueError:
+        region = ()
+    if len(region) != 4 or region[2] <= 0 or region[3] <= 0:
+        raise ValueError("region should be x,y,w,h, not %r" % text)
+    return region
+
+
+def _geometry(size, region=None, scale=None, max_width=None):
+    """
+    Returns:
+        (crop box in source pixels, resize ratio, target (width, height))
+    """
+    box = (0, 0) + size
+    if region:
+        x, y, w, h = region
+        box = (max(0, x), max(0, y), min(size[0], x + w), min(size[1], y + h))
+        if box[2] <= box[0] or box[3] <= box[1]:
+            raise ValueError("region %s is outside of the %dx%d image" %
+                             (",".join(map(str, region)), size[0], size[1]))
+    width, height = box[2] - box[0], box[3] - box[1]
+    ratio = min(1.0, scale or 1.0)
+    if max_width and width * ratio > max_width:
+        ratio = max_width / width
+    target = (max(1, round(width * ratio)), max(1, round(height * ratio)))
+    return box, ratio, target
+
+
+def _shrink(im: Image.Image, source: str, box, ratio, target) -> Image.Image:
+    size = im.size
+    if ratio < 1.0 and source == "jpeg":
+        # let the jpeg decoder downscale by 1/2, 1/4 or 1/8 while decoding
+        im.draft("RGB", (math.ceil(size[0] * ratio), math.ceil(size[1] * ratio)))
+        if im.size != size:
+            fx, fy = im.size[0] / size[0], im.size[1] / size[1]
+            box = (int(box[0] * fx), int(box[1] * fy), math.ceil(box[2] * fx),
+                   math.ceil(box[3] * fy))
+    if box != (0, 0) + im.size:
+        im = im.crop(box)
+    if im.size != target:
+        im = im.resize(target, Image.BILINEAR)
+    return im
+
+
+def prepare_image(data: bytes, scale: float = None, max_width: int = None,
+                  region=None):
+    """
+    Decode, crop and shrink an image like process_image, without encoding
+
+    Returns:
+        (RGB Image, (width, height) of the source image)
+    """
+    im = Image.open(io.BytesIO(data))
+    size = im.size
+    box, ratio, target = _geometry(size, region, scale, max_width)
+    im = _shrink(im, sniff_format(data), box, ratio, target)
+    return im.convert("RGB"), size
+
+
+def process_image(data: bytes, fmt: str = None, quality: int = None,
+                  scale: float = None, max_width: int = None, region=None):
+    """
+    Crop, shrink and encode an image. Bytes which need none of it are
+    returned as they are, without decoding.
+
+    Args:
+        data: encoded image, as returned by the device
+        fmt: "jpeg", "png", "webp", or None to keep the format of data
+        quality: 1-100 for jpeg and webp
+        scale: resize factor, images are never enlarged
+        max_width: shrink to at most this width
+        region: (x, y, w, h) crop in source pixels, before scaling
+
+    Returns:
+        (bytes, format, (width, height) of the source image)
+    """
+    im = Image.open(io.BytesIO(data))  # reads the header only
+    size = im.size
+    source = sniff_format(data)
+    fmt = fmt or source or "jpeg"
+
+    box, ratio, target = _geometry(size, region, scale, max_width)
+    if box == (0, 0) + size and ratio == 1.0 and fmt == source and quality is None:
+        return data, fmt, size
+
+    im = _shrink(im, source, box, ratio, target)
+    return encode_image(im, fmt, quality), fmt, size
+
+
+def convert_image(data: bytes, fmt: str = None, quality: int = None):
+    """
+    Returns:
+        (bytes, format), see process_image
+    """
+    return process_image(data, fmt, quality)[:2]
+
+
+def image_etag(data: bytes) -> str:
+    return '"%s"' % hashlib.blake2b(data, digest_size=12).hexdigest()
+
+
+class Fingerprint(object):
+    """
+    Identity of a screen image: digest of the encoded bytes, and optionally
+    a thumbnail for comparisons which tolerate small changes
+    """
+    __slots__ = ('digest', 'thumbnail')
+
+    def __init__(self, digest: str, thumbnail: bytes = None):
+        self.digest = digest
+        self.thumbnail = thumbnail
+
+
+def thumbnail(data: bytes) -> bytes:
+    """ THUMBNAIL_SIZE grayscale pixels of an encoded image """
+    im = Image.open(io.BytesIO(data))
+    im.draft("L", (THUMBNAIL_SIZE[0] * 8, THUMBNAIL_SIZE[1] * 8))
+    return im.convert("L").resize(THUMBNAIL_SIZE, Image.BILINEAR).tobytes()
+
+
+def fingerprint(data: bytes, with_thumbnail: bool = False) -> Fingerprint:
+    return Fingerprint(image_etag(data),
+                       thumbnail(data) if with_thumbnail else None)
+
+
+def changed_ratio(a: bytes, b: bytes, threshold: int = PIXEL_THRESHOLD) -> float:
+    """
+    Returns:
+        fraction of thumbnail pixels which differ by more than threshold
+    """
+    if len(a) != len(b) or not a:
+        return 1.0
+    if np is not None:
+        diff = np.abs(
+            np.frombuffer(a, np.uint8).astype(np.int16) -
+            np.frombuffer(b, np.uint8))
+        return np.count_nonzero(diff > threshold) / diff.size
+    return sum(1 for x, y in zip(a, b) if abs(x - y) > threshold) / len(a)
+
+
+def same_screen(a: Fingerprint, b: Fingerprint, tolerance: float = 0) -> bool:
+    """
+    Args:
+        tolerance: fraction of the screen allowed to change, e.g. 0.01 to
+            ignore a clock or a blinking cursor
+    """
+    if a.digest == b.digest:
+        return True
+    if tolerance <= 0 or a.thumbnail is None or b.thumbnail is None:
+        return False
+    return changed_ratio(a.thumbnail, b.thumbnail) <= tolerance
+
+
+class FingerprintCache(object):
+    """
+    ETag of a sent image -> Fingerprint of the screen it was made of, and the
+    options (region, scale, format ...) it was made with. An image made with
+    other options is another image even when the screen is the same.
+    """
+
+    def __init__(self, size: int = 256):
+        self._size = size
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, etag: str, options: dict = None) -> Fingerprint:
+        """
+        Returns:
+            Fingerprint, None when unknown or made with other options
+        """
+        with self._lock:
+            item = self._items.get(etag)
+            if item is None or item[1] != _options_key(options):
+                return None
+            self._items.move_to_end(etag)
+            return item[0]
+
+    def put(self, etag: str, fp: Fingerprint, options: dict = None):
+        with self._lock:
+            self._items[etag] = (fp, _options_key(options))
+            self._items.move_to_end(etag)
+            while len(self._items) > self._size:
+                self._items.popitem(last=False)
+
+
+def _options_key(options: dict) -> tuple:
+    return tuple(sorted((k, v) for k, v in (options or {}).items()
+                        if v is not None))
+
+
+fingerprints = FingerprintCache()
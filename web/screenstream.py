@@ -0,0 +1,229 @@
+# coding: utf-8
+#
+# Background consumer of the minicap websocket of a device
+#
+# minicap (through atx-agent) pushes a JPEG frame every time the screen
+# changes, so while the connection is up the last frame is the current
+# screen, however old it is.
+
+import threading
+import time
+
+import tornado.websocket
+from logzero import logger
+from tornado import gen, locks
+from tornado.ioloop import IOLoop
+
+
+class Frame(object):
+    __slots__ = ('data', 'timestamp', 'seq')
+
+    def __init__(self, data: bytes, timestamp: float, seq: int):
+        self.data = data
+        self.timestamp = timestamp
+        self.seq = seq
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.timestamp
+
+
+class Viewer(object):
+    """
+    Mailbox of size one between the stream and a client. A frame which is
+    not sent yet is replaced by the next one, so a slow client skips frames
+    instead of falling behind.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._event = locks.Event()
+        self._frame = None
+        self._closed = False
+        self._created = time.time()
+        self._sent = 0
+        self._dropped = 0
+        self._lag_last = 0.0
+        self._lag_total = 0.0
+        self._lag_max = 0.0
+
+    def put(self, frame: Frame):
+        if self._frame is not None:
+            self._dropped += 1
+        self._frame = frame
+        self._event.set()
+
+    def close(self):
+        self._closed = True
+        self._event.set()
+
+    async def get(self) -> Frame:
+        """
+        Returns:
+            next frame, None once the viewer is closed
+        """
+        await self._event.wait()
+        self._event.clear()
+        if self._closed:
+            return None
+        frame, self._frame = self._frame, None
+        return frame
+
+    def sent(self, frame: Frame):
+        """ record a frame as delivered, lag is counted from its arrival """
+        lag = frame.age
+        self._sent += 1
+        self._lag_last = lag
+        self._lag_total += lag
+        self._lag_max = max(self._lag_max, lag)
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "duration": time.time() - self._created,
+            "sent": self._sent,
+            "dropped": self._dropped,
+            "lastLag": self._lag_last,
+            "avgLag": self._lag_total / self._sent if self._sent else 0.0,
+            "maxLag": self._lag_max,
+        }
+
+
+class ScreenStream(object):
+    """
+    Keeps the latest frame of one device, reconnects with backoff when the
+    websocket drops. Runs on the IOLoop it is started from.
+
+    Args:
+        url: ws://.../minicap
+    """
+
+    def __init__(self, url: str, max_backoff: float = 30.0):
+        self.url = url
+        # keeps running without viewers, see idle
+        self.persistent = False
+        self._max_backoff = max_backoff
+        self._lock = threading.Lock()
+        self._frame = None
+        self._connected = False
+        self._stopped = False
+        self._conn = None
+        self._loop = None
+        self._listeners = []
+        self._viewers = []
+        self._seq = 0
+        self._connects = 0
+        self._errors = 0
+
+    def start(self):
+        self._loop = IOLoop.current()
+        self._loop.spawn_callback(self._run)
+
+    def stop(self):
+        """ safe to call from any thread """
+        self._stopped = True
+        if self._loop is not None:
+            self._loop.add_callback(self._close)
+
+    def _close(self):
+        for viewer in list(self._viewers):
+            self.unsubscribe(viewer)
+        if self._conn is not None:
+            self._conn.close()
+
+    @property
+    def connected(self) -> bool:
+        return self._connected
+
+    @property
+    def idle(self) -> bool:
+        """ nobody watches and nobody asked to keep it running """
+        return not self._viewers and not self.persistent
+
+    def latest(self) -> Frame:
+        """
+        Returns:
+            latest Frame, None when the stream is down or has no frame yet
+        """
+        with self._lock:
+            if not self._connected:
+                return None
+            return self._frame
+
+    def add_listener(self, fn):
+        """ fn(frame) is called on the IOLoop for every new frame """
+        self._listeners.append(fn)
+
+    def remove_listener(self, fn):
+        if fn in self._listeners:
+            self._listeners.remove(fn)
+
+    def subscribe(self, name: str) -> Viewer:
+        """
+        Returns:
+            Viewer fed with every new frame, starting with the latest one
+        """
+        viewer = Viewer(name)
+        self._viewers.append(viewer)
+        self.add_listener(viewer.put)
+        frame = self.latest()
+        if frame is not None:
+            viewer.put(frame)
+        return viewer
+
+    def unsubscribe(self, viewer: Viewer):
+        viewer.close()
+        self.remove_listener(viewer.put)
+        if viewer in self._viewers:
+            self._viewers.remove(viewer)
+
+    def stats(self) -> dict:
+        frame = self._frame
+        return {
+            "url": self.url,
+            "connected": self._connected,
+            "persistent": self.persistent,
+            "frames": self._seq,
+            "connects": self._connects,
+            "errors": self._errors,
+            "frameAge": frame.age if frame else None,
+            "viewers": [v.stats() for v in self._viewers],
+        }
+
+    async def _run(self):
+        backoff = 1.0
+        while not self._stopped:
+            try:
+                self._conn = await tornado.websocket.websocket_connect(
+                    self.url, max_message_size=32 << 20)
+                self._connects += 1
+                backoff = 1.0
+                logger.info("screen stream connected: %s", self.url)
+                while True:
+                    message = await self._conn.read_message()
+                    if message is None:
+                        break
+                    if isinstance(message, bytes):
+                        self._on_frame(message)
+            except Exception as e:
+                self._errors += 1
+                logger.warning("screen stream %s error: %s", self.url, e)
+            finally:
+                with self._lock:
+                    self._connected = False
+                self._conn = None
+            if not self._stopped:
+                await gen.sleep(backoff)
+                backoff = min(backoff * 2, self._max_backoff)
+
+    def _on_frame(self, data: bytes):
+        self._seq += 1
+        frame = Frame(data, time.time(), self._seq)
+        with self._lock:
+            self._frame = frame
+            self._connected = True
+        for fn in list(self._listeners):
+            try:
+                fn(frame)
+            except Exception:
+                logger.exception("screen stream listener error")
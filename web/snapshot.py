@@ -0,0 +1,305 @@
+# coding: utf-8
+#
+
+import collections
+import threading
+import time
+from concurrent.futures import CancelledError, Future
+
+from . import compact, xpath
+from .hierarchydiff import hierarchy_version
+from .spatial import GridIndex
+from .uidumplib import safe_xmlstr
+
+# classify of _AndroidDevice.weight -> key in the json hierarchy
+QUERY_KEYS = {
+    "text": "text",
+    "resource_id": "resourceId",
+    "description": "description",
+    "className": "_type",
+}
+
+
+class HierarchySnapshot(object):
+    """
+    One dump_hierarchy2 result of a device, plus lookup structures which are
+    built from it on first use.
+
+    Args:
+        data: dump_hierarchy2 result
+        nodes: (json_node, depth) in document order, collected while parsing
+        timestamp: time the dump started
+    """
+
+    def __init__(self, data: dict, nodes: list = None, timestamp: float = None):
+        self.data = data
+        self.timestamp = timestamp or time.time()
+        self._nodes = nodes
+        self._lock = threading.Lock()
+        self._spatial_index = None
+        self._query_index = None
+        self._xpath_tree = None
+        self._compact = {}
+        self._version = None
+        self._node_index = None
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.timestamp
+
+    @property
+    def nodes(self) -> list:
+        if self._nodes is None:
+            nodes = []
+            stack = [(self.data["jsonHierarchy"], 0)]
+            while stack:
+                node, depth = stack.pop()
+                nodes.append((node, depth))
+                for child in reversed(node.get('children', [])):
+                    stack.append((child, depth + 1))
+            self._nodes = nodes
+        return self._nodes
+
+    @property
+    def version(self) -> str:
+        """ content token, same as the version of the v3 hierarchy api """
+        if self._version is None:
+            self._version = hierarchy_version(self.data)
+        return self._version
+
+    @property
+    def node_index(self) -> dict:
+        """ {_id: (json_node, depth)} """
+        with self._lock:
+            if self._node_index is None:
+                self._node_index = {
+                    node['_id']: (node, depth)
+                    for node, depth in self.nodes
+                }
+            return self._node_index
+
+    def subtree(self, node_id: str = None, depth: int = 1) -> dict:
+        """
+        Copy of the subtree at node_id (the root when None), cut depth levels
+        below it. Every node gets childCount, a node whose children are cut
+        has no children key.
+
+        Returns:
+            json node or None when node_id is unknown
+        """
+        if node_id is None:
+            node = self.data["jsonHierarchy"]
+        else:
+            node = self.node_index.get(node_id, (None, 0))[0]
+            if node is None:
+                return None
+
+        def copy(node, level):
+            children = node.get('children') or []
+            ret = {k: v for k, v in node.items() if k != 'children'}
+            ret['childCount'] = len(children)
+            if level < depth:
+                ret['children'] = [copy(child, level + 1) for child in children]
+            return ret
+
+        return copy(node, 0)
+
+    @property
+    def spatial_index(self) -> GridIndex:
+        with self._lock:
+            if self._spatial_index is None:
+                self._spatial_index = GridIndex(self.nodes)
+            return self._spatial_index
+
+    @property
+    def query_index(self) -> dict:
+        """ {json key: {value: [json_node, ...]}}, nodes in document order """
+        with self._lock:
+            if self._query_index is None:
+                index = {key: {} for key in QUERY_KEYS.values()}
+                for node, _ in self.nodes:
+                    for key, values in index.items():
+                        value = node.get(key)
+                        if value is not None:
+                            values.setdefault(value, []).append(node)
+                self._query_index = index
+            return self._query_index
+
+    @property
+    def xpath_tree(self) -> xpath.XNode:
+        with self._lock:
+            if self._xpath_tree is None:
+                if self.data.get("xmlHierarchy"):
+                    self._xpath_tree = xpath.build_android_tree(
+                        self.data["xmlHierarchy"], self.nodes)
+                else:
+                    self._xpath_tree = xpath.build_json_tree(
+                        self.data["jsonHierarchy"])
+            return self._xpath_tree
+
+    def compact(self, with_xml: bool = True) -> bytes:
+        """ data in the compact binary format, see web/compact.py """
+        payload = self._compact.get(with_xml)
+        if payload is None:
+            data = self.data
+            if not with_xml:
+                data = {k: v for k, v in data.items() if k != "xmlHierarchy"}
+            payload = self._compact[with_xml] = compact.encode_hierarchy(data)
+        return payload
+
+    def select(self, expr: str) -> list:
+        """
+        Returns:
+            list of (json_node, depth) matched by the xpath, in document order
+
+        Raises:
+            xpath.XPathError
+        """
+        ret = []
+        for n in xpath.select(self.xpath_tree, expr):
+            depth = -1  # the document node is not part of jsonHierarchy
+            p = n.parent
+            while p is not None:
+                depth += 1
+                p = p.parent
+            ret.append((n.json, depth))
+        return ret
+
+    def find(self, classify: str, value: str, instance: int = 0):
+        """
+        Same matching as d(text=value, instance=instance) and friends
+
+        Returns:
+            json node or None
+        """
+        if classify == 'xpath':
+            matched = [node for node, _ in self.select(value)]
+        else:
+            if classify == 'className':
+                # _type went through safe_xmlstr, Outer$Inner is Outer-Inner
+                value = safe_xmlstr(value)
+            matched = self.query_index[QUERY_KEYS[classify]].get(value, ())
+        if 0 <= instance < len(matched):
+            return matched[instance]
+        return None
+
+
+class SnapshotCache(object):
+    """
+    Short-lived cache of the latest snapshot of one device.
+
+    Concurrent callers share a single in-flight dump (single-flight), and a
+    finished dump is served to everyone for max_age seconds. invalidate()
+    is called after every action, so a dump never outlives a tap or swipe.
+    """
+
+    def __init__(self, history: int = 8):
+        self._lock = threading.Lock()
+        # recent snapshots, still reachable by version after they expire
+        self._history = collections.deque(maxlen=history)
+        self._snapshot = None
+        self._inflight = None
+        self._generation = 0
+        self._hits = 0
+        self._misses = 0
+        self._coalesced = 0
+        self._invalidations = 0
+
+    def get(self, loader, max_age: float) -> Future:
+        """
+        Args:
+            loader: callable returning a Future of HierarchySnapshot
+            max_age: seconds a cached snapshot is still considered fresh
+
+        Returns:
+            Future of HierarchySnapshot
+        """
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is not None and snapshot.age <= max_age:
+                self._hits += 1
+                future = Future()
+                future.set_result(snapshot)
+                return future
+            if self._inflight is not None:
+                self._coalesced += 1
+                return self._inflight
+            self._misses += 1
+            generation = self._generation
+            inflight = self._inflight = Future()
+            # shared by every caller, one of them giving up must not cancel
+            # it for the others
+            inflight.set_running_or_notify_cancel()
+
+        def on_done(f):
+            if f.cancelled():
+                error = CancelledError()
+            else:
+                error = f.exception()
+            snapshot = None if error else f.result()
+            with self._lock:
+                if self._inflight is inflight:
+                    self._inflight = None
+                if snapshot is not None:
+                    self._history.append(snapshot)
+                    if generation == self._generation:
+                        self._snapshot = snapshot
+            if error is not None:
+                inflight.set_exception(error)
+            else:
+                inflight.set_result(snapshot)
+
+        try:
+            loader().add_done_callback(on_done)
+        except Exception as e:
+            with self._lock:
+                self._inflight = None
+            inflight.set_exception(e)
+        return inflight
+
+    @property
+    def generation(self) -> int:
+        """ changes on every invalidate, see add """
+        return self._generation
+
+    def add(self, snapshot, generation: int = None):
+        """
+        Store a snapshot loaded outside of get. It is served as the latest
+        one only if nothing invalidated the cache since generation was read.
+        """
+        with self._lock:
+            self._history.append(snapshot)
+            if generation is None or generation == self._generation:
+                self._snapshot = snapshot
+
+    def find(self, version: str):
+        """
+        Returns:
+            a recent HierarchySnapshot with this version or None
+        """
+        with self._lock:
+            history = list(self._history)
+        for snapshot in reversed(history):
+            if snapshot.version == version:
+                return snapshot
+        return None
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._invalidations += 1
+            self._snapshot = None
+            # callers arriving after an action must not join a dump that
+            # started before it
+            self._inflight = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            snapshot = self._snapshot
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "coalesced": self._coalesced,
+                "invalidations": self._invalidations,
+                "age": snapshot.age if snapshot else None,
+            }
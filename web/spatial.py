@@ -0,0 +1,117 @@
+# coding: utf-8
+#
+# Uniform grid over node rects, for "which node is under this point" queries
+
+import math
+
+
+def _rect_box(rect):
+    """ (left, top, right, bottom) or None when the rect is empty """
+    if not rect:
+        return None
+    x, y = rect.get('x', 0), rect.get('y', 0)
+    w, h = rect.get('width', 0), rect.get('height', 0)
+    if w <= 0 or h <= 0:
+        return None
+    return (x, y, x + w, y + h)
+
+
+class GridIndex(object):
+    """
+    Args:
+        nodes: list of (json_node, depth) in document order, as collected by
+            uidumplib while parsing. A later node is drawn above an earlier
+            one, so document order is also the z-order.
+        cell_size: grid cell size in pixels, chosen from the node count when
+            not given
+    """
+
+    def __init__(self, nodes, cell_size: int = None):
+        self._nodes = []
+        self._boxes = []
+        for node, depth in nodes:
+            box = _rect_box(node.get('rect'))
+            if box is not None:
+                self._nodes.append((node, depth))
+                self._boxes.append(box)
+
+        if self._boxes:
+            right = max(box[2] for box in self._boxes)
+            bottom = max(box[3] for box in self._boxes)
+            self._extent = (min(box[0] for box in self._boxes),
+                            min(box[1] for box in self._boxes), right, bottom)
+        else:
+            right = bottom = 1
+            self._extent = None
+        if cell_size is None:
+            # about sqrt(n) cells on each axis
+            per_axis = max(1, int(math.sqrt(len(self._boxes))))
+            cell_size = max(32, int(max(right, bottom) / per_axis))
+        self._cell = cell_size
+
+        self._cells = {}
+        for i, box in enumerate(self._boxes):
+            for key in self._cover(box):
+                self._cells.setdefault(key, []).append(i)
+
+    def __len__(self):
+        return len(self._boxes)
+
+    def _cover(self, box):
+        c = self._cell
+        left, top, right, bottom = box
+        for cx in range(int(left // c), int((right - 1) // c) + 1):
+            for cy in range(int(top // c), int((bottom - 1) // c) + 1):
+                yield (cx, cy)
+
+    def _result(self, indexes):
+        """ topmost node first """
+        return [self._nodes[i] for i in sorted(indexes, reverse=True)]
+
+    def at(self, x, y):
+        """
+        Returns:
+            list of (json_node, depth) whose rect contains (x, y), topmost first
+        """
+        c = self._cell
+        candidates = self._cells.get((int(x // c), int(y // c)), ())
+        boxes = self._boxes
+        return self._result([
+            i for i in candidates
+            if boxes[i][0] <= x < boxes[i][2] and boxes[i][1] <= y < boxes[i][3]
+        ])
+
+    def within(self, rect: dict, contain=False):
+        """
+        Args:
+            rect: dict(x, y, width, height)
+            contain: only return nodes fully inside rect, instead of every
+                node intersecting it
+
+        Returns:
+            list of (json_node, depth), topmost first
+        """
+        query = _rect_box(rect)
+        if query is None:
+            return []
+        left, top, right, bottom = query
+        if self._extent is None:
+            return []
+        # only the cells of the indexed area, however large the query is
+        cover = (max(left, self._extent[0]), max(top, self._extent[1]),
+                 min(right, self._extent[2]), min(bottom, self._extent[3]))
+        if cover[0] >= cover[2] or cover[1] >= cover[3]:
+            return []
+        candidates = set()
+        for key in self._cover(cover):
+            candidates.update(self._cells.get(key, ()))
+        matched = []
+        for i in candidates:
+            l, t, r, b = self._boxes[i]
+            if contain:
+                ok = l >= left and t >= top and r <= right and b <= bottom
+            else:
+                ok = l < right and r > left and t < bottom and b > top
+            if ok:
+                matched.append(i)
+        return self._result(matched)
@@ -0,0 +1,206 @@
+# coding: utf-8
+#
+# Dirty tile delta encoding of screenshots
+#
+# The frame a client drew last is kept decoded under the ETag it got. The
+# next frame is compared with it tile by tile and only changed tiles are
+# sent, packed into one image (an atlas) so the browser decodes only once.
+
+import collections
+import math
+import threading
+import time
+
+from PIL import Image, ImageChops
+
+from .imageutils import encode_image, image_etag, np, prepare_image, sniff_format
+
+TILE_SIZE = 64  # multiple of 16, jpeg blocks never cross tiles in the atlas
+PIXEL_THRESHOLD = 16
+MAX_DIRTY_RATIO = 0.5  # above it a full frame is cheaper than the tiles
+ATLAS_WIDTH = 2048
+
+# a frame not used for this many seconds has no client drawing on it any more
+FRAME_TTL = 10.0
+# decoded frames kept per device at most, a few MB each
+MAX_FRAMES = 16
+
+
+class TileDelta(object):
+    """
+    Attributes:
+        etag: identifies the frame the client has after drawing this
+        image: encoded full frame or atlas, None when nothing changed
+        fmt: format of image
+        size: (width, height) of the source screenshot
+        frame_size: (width, height) of the frame the tiles are part of
+        tiles: [(x, y, w, h), ...] in atlas order, None for a full frame
+        columns: tiles per atlas row
+    """
+
+    def __init__(self, etag, image=None, fmt=None, size=None, frame_size=None,
+                 tiles=None, columns=0):
+        self.etag = etag
+        self.image = image
+        self.fmt = fmt
+        self.size = size
+        self.frame_size = frame_size
+        self.tiles = tiles
+        self.columns = columns
+
+
+class FrameStore(object):
+    """
+    ETag -> (digest of the source bytes, decoded frame) of the frames sent
+    for one device. Every client polling the device keeps the frame it drew
+    last in use, so the store grows with the number of clients: frames are
+    dropped once unused for ttl seconds, or the least recently used first
+    above size.
+    """
+
+    def __init__(self, size: int = MAX_FRAMES, ttl: float = FRAME_TTL):
+        self._size = size
+        self._ttl = ttl
+        self._items = collections.OrderedDict()  # etag -> (digest, im, used)
+        self._lock = threading.Lock()
+
+    def get(self, etag: str):
+        with self._lock:
+            self._expire()
+            item = self._items.get(etag)
+            if item is None:
+                return None
+            self._items[etag] = item[:2] + (time.time(), )
+            self._items.move_to_end(etag)
+            return item[:2]
+
+    def put(self, etag: str, digest: str, im: Image.Image):
+        with self._lock:
+            self._items[etag] = (digest, im, time.time())
+            self._items.move_to_end(etag)
+            self._expire()
+            while len(self._items) > self._size:
+                self._items.popitem(last=False)
+
+    def _expire(self):
+        # called with the lock held, least recently used first
+        deadline = time.time() - self._ttl
+        while self._items and next(iter(self._items.values()))[2] < deadline:
+            self._items.popitem(last=False)
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._expire()
+            return len(self._items)
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def frame_store(device_id: str) -> FrameStore:
+    with _stores_lock:
+        store = _stores.get(device_id)
+        if store is None:
+            store = _stores[device_id] = FrameStore()
+        return store
+
+
+def drop_frames(device_id: str):
+    with _stores_lock:
+        _stores.pop(device_id, None)
+
+
+def dirty_tiles(a: Image.Image, b: Image.Image, tile_size: int = TILE_SIZE,
+                threshold: int = PIXEL_THRESHOLD):
+    """
+    Args:
+        a, b: RGB images of the same size
+
+    Returns:
+        [(x, y, w, h), ...] of the tiles where a pixel channel differs by
+        more than threshold, row by row
+    """
+    width, height = a.size
+    rows, cols = math.ceil(height / tile_size), math.ceil(width / tile_size)
+    if np is not None:
+        diff = np.abs(
+            np.asarray(a, dtype=np.int16) - np.asarray(b, dtype=np.int16)).max(
+                axis=2)
+        diff = np.pad(diff, ((0, rows * tile_size - height),
+                             (0, cols * tile_size - width)))
+        changed = diff.reshape(rows, tile_size, cols,
+                               tile_size).max(axis=(1, 3)) > threshold
+        cells = [tuple(cell) for cell in np.argwhere(changed)]
+    else:
+        diff = ImageChops.difference(a, b).convert("L").point(
+            lambda v: 255 if v > threshold else 0)
+        cells = [(row, col) for row in range(rows) for col in range(cols)
+                 if diff.crop((col * tile_size, row * tile_size,
+                               (col + 1) * tile_size,
+                               (row + 1) * tile_size)).getbbox()]
+    tiles = []
+    for row, col in cells:
+        x, y = int(col) * tile_size, int(row) * tile_size
+        tiles.append((x, y, min(tile_size, width - x), min(tile_size,
+                                                            height - y)))
+    return tiles
+
+
+def encode_delta(data: bytes, base_etag: str = None, fmt: str = None,
+                 quality: int = None, tile_size: int = TILE_SIZE,
+                 threshold: int = PIXEL_THRESHOLD, frames: FrameStore = None,
+                 **options) -> TileDelta:
+    """
+    Args:
+        data: encoded screenshot
+        base_etag: ETag of the frame the client has
+        frames: FrameStore of the device, see frame_store
+        options: scale, max_width and region, see imageutils.process_image
+
+    Returns:
+        TileDelta, a full frame when the base frame is unknown, has another
+        size or most of it changed
+    """
+    if frames is None:
+        frames = FrameStore()
+    digest = image_etag(data)
+    base = frames.get(base_etag) if base_etag else None
+    if base is not None and base[0] == digest:
+        return TileDelta(base_etag)
+
+    im, size = prepare_image(data, **options)
+    fmt = fmt or sniff_format(data) or "jpeg"
+    tiles = None
+    if base is not None and base[1].size == im.size:
+        tiles = dirty_tiles(base[1], im, tile_size, threshold)
+        total = math.ceil(im.size[0] / tile_size) * math.ceil(
+            im.size[1] / tile_size)
+        if not tiles:
+            return TileDelta(base_etag)
+        if len(tiles) > total * MAX_DIRTY_RATIO:
+            tiles = None
+
+    if tiles is None:
+        if im.size == size and fmt == sniff_format(data) and quality is None:
+            image = data  # nothing to crop, shrink or convert
+        else:
+            image = encode_image(im, fmt, quality)
+        etag = image_etag(image)
+        frames.put(etag, digest, im)
+        return TileDelta(etag, image, fmt, size, im.size)
+
+    columns = min(len(tiles), max(1, ATLAS_WIDTH // tile_size))
+    atlas = Image.new("RGB", (columns * tile_size,
+                              math.ceil(len(tiles) / columns) * tile_size))
+    # the stored frame is what the client shows after patching, so changes
+    # below the threshold can not add up unseen
+    patched = base[1].copy()
+    for i, (x, y, w, h) in enumerate(tiles):
+        tile = im.crop((x, y, x + w, y + h))
+        atlas.paste(tile, ((i % columns) * tile_size, (i // columns) * tile_size))
+        patched.paste(tile, (x, y))
+    image = encode_image(atlas, fmt, quality)
+    etag = image_etag(base_etag.encode() + image)
+    frames.put(etag, digest, patched)
+    return TileDelta(etag, image, fmt, size, im.size, tiles, columns)
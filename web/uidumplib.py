@@ -1,8 +1,9 @@
 # coding: utf-8
 
+import hashlib
 import re
 import xml.dom.minidom
-import uuid
+import xml.parsers.expat
 
 sample_android_page_xml = '''<?xml version="1.0" ?>
 <hierarchy rotation="0">
@@ -27,8 +28,11 @@ sample_android_page_xml = '''<?xml version="1.0" ?>
 '''
 
 
+_BOUNDS_RE = re.compile(r'\[(\d+),(\d+)\]\[(\d+),(\d+)\]')
+
+
 def parse_bounds(text):
-    m = re.match(r'\[(\d+),(\d+)\]\[(\d+),(\d+)\]', text)
+    m = _BOUNDS_RE.match(text)
     if m is None:
         return None
     (lx, ly, rx, ry) = map(int, m.groups())
@@ -103,29 +107,135 @@ def _parse_uiautomator_node(node):
     return ks
 
 
-def get_android_hierarchy(d):
+# xml attribute name -> (json key, parser), None when the attribute is dropped
+__decoders = {}
+
+
+def _attr_decoder(name):
+    try:
+        return __decoders[name]
+    except KeyError:
+        key = __alias.get(name, name)
+        f = __parsers.get(key)
+        decoder = __decoders[name] = (key, f) if f else None
+        return decoder
+
+
+for _name in list(__alias) + list(__parsers):
+    _attr_decoder(_name)
+
+
+def make_node_id(parent_id, position, type_name, name):
+    """
+    Stable node id derived from the index path (parent id + position among
+    siblings), the node class and its resource-id (or name on iOS), so an
+    unchanged node keeps its id across dumps.
+    """
+    key = "%s/%d:%s:%s" % (parent_id, position, type_name, name)
+    return hashlib.blake2b(key.encode('utf-8'), digest_size=8).hexdigest()
+
+
+def get_android_hierarchy(d, parser=None):
     page_xml = d.dump_hierarchy(compressed=False, pretty=False).encode('utf-8')
-    return android_hierarchy_to_json(page_xml)
+    return android_hierarchy_to_json(page_xml, parser)
 
 
-def android_hierarchy_to_json(page_xml: bytes):
+def android_hierarchy_to_json(page_xml: bytes, parser=None, nodes=None,
+                              prune=None):
     """
+    Args:
+        parser: "expat" (streaming, default) or "minidom"
+        nodes: optional list, (json_node, depth) of every node is appended
+            to it in document order while parsing
+        prune: HierarchyPrune, applied while parsing (expat only)
+
     Returns:
         JSON object
     """
+    if prune is not None:
+        if parser not in (None, "expat") or nodes is not None:
+            raise ValueError("prune only works with the expat parser, "
+                             "without nodes")
+        return _android_hierarchy_to_json_pruned(page_xml, prune)
+    try:
+        to_json = __hierarchy_parsers[parser or DEFAULT_PARSER]
+    except KeyError:
+        raise ValueError("Unknown hierarchy parser", parser)
+    return to_json(page_xml, nodes)
+
+
+def _android_hierarchy_to_json_expat(page_xml: bytes, nodes=None):
+    """
+    Build the JSON tree in a single pass over expat events, without a DOM.
+    Output is the same as _android_hierarchy_to_json_minidom.
+    """
+    decoders = __decoders
+    decoder_of = _attr_decoder
+    node_id = make_node_id
+    stack = []
+    result = []
+
+    def start_element(name, attrs):
+        json_node = {}
+        for key, value in attrs.items():
+            decoder = decoders.get(key) or decoder_of(key)
+            if decoder:
+                json_node[decoder[0]] = decoder[1](value)
+        if stack:
+            parent = stack[-1]
+            siblings = parent.get('children')
+            if siblings is None:
+                siblings = parent['children'] = []
+            json_node['_id'] = node_id(parent['_id'], len(siblings),
+                                       json_node.get('_type'),
+                                       json_node.get('resourceId'))
+            siblings.append(json_node)
+        else:
+            json_node['_id'] = node_id("", 0, json_node.get('_type'),
+                                       json_node.get('resourceId'))
+            result.append(json_node)
+        if nodes is not None:
+            nodes.append((json_node, len(stack)))
+        stack.append(json_node)
+
+    def end_element(name):
+        stack.pop()
+
+    def other_child(*args):
+        # minidom keeps text, comments and PIs as child nodes, so an element
+        # with any of them still gets an (empty) "children" list
+        if stack and 'children' not in stack[-1]:
+            stack[-1]['children'] = []
+
+    p = xml.parsers.expat.ParserCreate()
+    p.buffer_text = True
+    p.StartElementHandler = start_element
+    p.EndElementHandler = end_element
+    p.CharacterDataHandler = other_child
+    p.CommentHandler = other_child
+    p.ProcessingInstructionHandler = other_child
+    p.Parse(page_xml, True)
+    return result[0]
+
+
+def _android_hierarchy_to_json_minidom(page_xml: bytes, nodes=None):
     dom = xml.dom.minidom.parseString(page_xml)
     root = dom.documentElement
 
-    def travel(node):
+    def travel(node, parent_id="", position=0, depth=0):
         """ return current node info """
         if node.attributes is None:
             return
         json_node = _parse_uiautomator_node(node)
-        json_node['_id'] = str(uuid.uuid4())
+        json_node['_id'] = make_node_id(parent_id, position,
+                                        json_node.get('_type'),
+                                        json_node.get('resourceId'))
+        if nodes is not None:
+            nodes.append((json_node, depth))
         if node.childNodes:
             children = []
             for n in node.childNodes:
-                child = travel(n)
+                child = travel(n, json_node['_id'], len(children), depth + 1)
                 if child:
                     # child["_parent"] = json_node["_id"]
                     children.append(child)
@@ -135,11 +245,192 @@ def android_hierarchy_to_json(page_xml: bytes):
     return travel(root)
 
 
-def get_ios_hierarchy(d, scale):
-    sourcejson = d.source(format='json')
+# json values which make a node worth interacting with
+INTERACTABLE_KEYS = ('clickable', 'longClickable', 'checkable', 'scrollable')
+IOS_INTERACTABLE_TYPES = {
+    'Button', 'Cell', 'CheckBox', 'Key', 'Link', 'MenuItem', 'PickerWheel',
+    'RadioButton', 'SearchField', 'SecureTextField', 'SegmentedControl',
+    'Slider', 'Stepper', 'Switch', 'Tab', 'TextField', 'TextView', 'Toggle'
+}
+CONTENT_KEYS = ('text', 'description', 'resourceId', 'name', 'label', 'value')
 
-    def travel(node):
-        node['_id'] = str(uuid.uuid4())
+
+class HierarchyPrune(object):
+    """
+    Projection and pruning applied while a hierarchy is built. Node ids are
+    still derived from the positions in the full tree, so they match the ids
+    of an unpruned dump.
+
+    Args:
+        fields: json keys to keep, _id and children are always kept
+        max_depth: drop nodes deeper than max_depth, the root is depth 0
+        visible_only: drop nodes whose rect is empty or outside the screen,
+            together with their subtree
+        interactable_only: drop nodes which can not be clicked, checked or
+            scrolled, their children move up to the parent
+        collapse: replace a plain layout node (not interactable, no text,
+            description or id) which has a single child by that child
+        screen: (width, height), used by visible_only
+    """
+
+    def __init__(self, fields=None, max_depth=None, visible_only=False,
+                 interactable_only=False, collapse=False, screen=None):
+        self.fields = fields
+        self.max_depth = max_depth
+        self.visible_only = visible_only
+        self.interactable_only = interactable_only
+        self.collapse = collapse
+        self.screen = screen
+
+    def is_visible(self, node) -> bool:
+        rect = node.get('rect')
+        if rect is None:
+            return True  # the android root has no bounds
+        if rect['width'] <= 0 or rect['height'] <= 0:
+            return False
+        if self.screen:
+            width, height = self.screen
+            return rect['x'] < width and rect['y'] < height and \
+                rect['x'] + rect['width'] > 0 and rect['y'] + rect['height'] > 0
+        return True
+
+    def is_interactable(self, node) -> bool:
+        if any(node.get(key) for key in INTERACTABLE_KEYS):
+            return True
+        type_name = node.get('_type') or ''
+        return type_name.replace('XCUIElementType', '') in IOS_INTERACTABLE_TYPES
+
+    def is_layout(self, node) -> bool:
+        return not self.is_interactable(node) and not any(
+            node.get(key) for key in CONTENT_KEYS)
+
+
+class _PrunedTreeBuilder(object):
+    """
+    Builds a pruned json tree from start / end events in document order
+
+    Args:
+        name_key: json key mixed into the node id, see make_node_id
+    """
+
+    def __init__(self, prune: HierarchyPrune, name_key: str):
+        self.prune = prune
+        self.name_key = name_key
+        self.root = None
+        # [json_node, next child position, kept children, interactable, layout]
+        self._stack = []
+
+    def start(self, node: dict) -> bool:
+        """
+        Args:
+            node: decoded attributes, without children
+
+        Returns:
+            False when the node is dropped with its subtree, then the caller
+            skips its children and does not call end()
+        """
+        prune = self.prune
+        stack = self._stack
+        if stack:
+            parent = stack[-1]
+            parent_id, position = parent[0]['_id'], parent[1]
+            parent[1] += 1
+        else:
+            parent_id, position = "", 0
+        if prune.max_depth is not None and len(stack) > prune.max_depth:
+            return False
+        if prune.visible_only and not prune.is_visible(node):
+            return False
+
+        if prune.fields is None:
+            json_node = node
+        else:
+            json_node = {k: node[k] for k in prune.fields if k in node}
+        json_node['_id'] = make_node_id(parent_id, position, node.get('_type'),
+                                        node.get(self.name_key))
+        stack.append([json_node, 0, [],
+                      prune.is_interactable(node),
+                      prune.collapse and prune.is_layout(node)])
+        return True
+
+    def end(self):
+        json_node, _, children, interactable, layout = self._stack.pop()
+        if children:
+            json_node['children'] = children
+        if not self._stack:
+            self.root = json_node
+            return
+        if self.prune.interactable_only and not interactable:
+            kept = children
+        elif layout and len(children) == 1:
+            kept = children
+        else:
+            kept = [json_node]
+        self._stack[-1][2].extend(kept)
+
+
+def _android_hierarchy_to_json_pruned(page_xml: bytes, prune: HierarchyPrune):
+    """ expat parser which drops nodes before their json is built """
+    decoders = __decoders
+    decoder_of = _attr_decoder
+    builder = _PrunedTreeBuilder(prune, 'resourceId')
+    skipped = [0]  # depth inside a dropped subtree
+
+    def start_element(name, attrs):
+        if skipped[0]:
+            skipped[0] += 1
+            return
+        json_node = {}
+        for key, value in attrs.items():
+            decoder = decoders.get(key) or decoder_of(key)
+            if decoder:
+                json_node[decoder[0]] = decoder[1](value)
+        if not builder.start(json_node):
+            skipped[0] = 1
+
+    def end_element(name):
+        if skipped[0]:
+            skipped[0] -= 1
+        else:
+            builder.end()
+
+    p = xml.parsers.expat.ParserCreate()
+    p.StartElementHandler = start_element
+    p.EndElementHandler = end_element
+    p.Parse(page_xml, True)
+    return builder.root
+
+
+DEFAULT_PARSER = "expat"
+
+__hierarchy_parsers = {
+    "expat": _android_hierarchy_to_json_expat,
+    "minidom": _android_hierarchy_to_json_minidom,
+}
+# names accepted as parser by android_hierarchy_to_json
+PARSERS = tuple(__hierarchy_parsers)
+
+
+def get_ios_hierarchy(d, scale, nodes=None, prune=None):
+    """
+    Args:
+        prune: HierarchyPrune, applied while converting the WDA source
+    """
+    return ios_source_to_json(d.source(format='json'), scale, nodes, prune)
+
+
+def ios_source_to_json(sourcejson: dict, scale, nodes=None, prune=None):
+    """
+    Args:
+        sourcejson: WDA source(format='json'), converted in place
+        see get_ios_hierarchy for the rest
+    """
+    if prune is not None:
+        return _ios_hierarchy_pruned(sourcejson, scale, prune)
+
+    def travel(node, parent_id="", position=0, depth=0):
+        node['_id'] = make_node_id(parent_id, position,
+                                   node.get('type', "null"), node.get('name'))
         node['_type'] = node.pop('type', "null")
         if node.get('rect'):
             rect = node['rect']
@@ -147,13 +438,35 @@ def get_ios_hierarchy(d, scale):
             for k, v in rect.items():
                 nrect[k] = v * scale
             node['rect'] = nrect
+        if nodes is not None:
+            nodes.append((node, depth))
 
-        for child in node.get('children', []):
-            travel(child)
+        for position, child in enumerate(node.get('children', [])):
+            travel(child, node['_id'], position, depth + 1)
         return node
 
     return travel(sourcejson)
 
 
+def _ios_hierarchy_pruned(sourcejson, scale, prune: HierarchyPrune):
+    builder = _PrunedTreeBuilder(prune, 'name')
+
+    def travel(node):
+        json_node = {
+            k: v
+            for k, v in node.items() if k not in ('children', 'type')
+        }
+        json_node['_type'] = node.get('type', "null")
+        if node.get('rect'):
+            json_node['rect'] = {k: v * scale for k, v in node['rect'].items()}
+        if builder.start(json_node):
+            for child in node.get('children', []):
+                travel(child)
+            builder.end()
+
+    travel(sourcejson)
+    return builder.root
+
+
 def get_webview_hierarchy(d):
     pass
\ No newline at end of file
@@ -0,0 +1,784 @@
+# coding: utf-8
+#
+# XPath evaluated on the server, against a hierarchy which is already dumped
+#
+# Covers the XPath 1.0 subset used by uiautomator2 and by the code the editor
+# generates: location paths with all the common axes, name / * / node() tests,
+# predicates (positional and boolean), and / or, comparisons, + -, and the
+# functions listed in _FUNCTIONS. Like uiautomator2, an android node is an
+# element named after its class, e.g. //android.widget.TextView[@text="OK"].
+#
+# Usage:
+#   tree = build_android_tree(page_xml, json_nodes)
+#   nodes = select(tree, '//*[@resource-id="com.example:id/title"]')
+
+import functools
+import inspect
+import math
+import re
+import xml.parsers.expat
+
+from .uidumplib import safe_xmlstr
+
+# ----------------------------------------------------------------------------
+# tree
+
+
+class XNode(object):
+    """ element of an xpath tree, json is the node in jsonHierarchy """
+    __slots__ = ('tag', 'attrs', 'parent', 'children', 'order', 'json')
+
+    def __init__(self, tag, attrs, parent=None, order=0, json=None):
+        self.tag = tag
+        self.attrs = attrs
+        self.parent = parent
+        self.children = []
+        self.order = order
+        self.json = json
+
+
+class XAttr(object):
+    __slots__ = ('owner', 'name', 'value', 'order')
+
+    def __init__(self, owner, name, value):
+        self.owner = owner
+        self.name = name
+        self.value = value
+        self.order = owner.order
+
+
+def build_android_tree(page_xml: bytes, json_nodes: list = None) -> XNode:
+    """
+    Args:
+        page_xml: uiautomator dump
+        json_nodes: (json_node, depth) in document order for the same dump,
+            used to link every element to its json node
+
+    Returns:
+        document node
+    """
+    document = XNode(None, {})
+    stack = [document]
+    count = [0]
+
+    def start_element(name, attrs):
+        order = count[0] = count[0] + 1
+        if name == 'node':
+            name = safe_xmlstr(attrs.get('class', '')) or 'node'
+        json_node = json_nodes[order - 1][0] if json_nodes else None
+        node = XNode(name, attrs, stack[-1], order, json_node)
+        stack[-1].children.append(node)
+        stack.append(node)
+
+    def end_element(name):
+        stack.pop()
+
+    p = xml.parsers.expat.ParserCreate()
+    p.StartElementHandler = start_element
+    p.EndElementHandler = end_element
+    p.Parse(page_xml, True)
+    return document
+
+
+def build_json_tree(root: dict) -> XNode:
+    """
+    Tree from a json hierarchy (used for iOS which has no xml source).
+    Element names come from _type, attributes from the scalar json values.
+    """
+    document = XNode(None, {})
+    order = 0
+    stack = [(root, document)]
+    while stack:
+        json_node, parent = stack.pop()
+        order += 1
+        attrs = {}
+        for key, value in json_node.items():
+            if key in ('children', 'rect', '_type'):
+                continue
+            if isinstance(value, bool):
+                value = 'true' if value else 'false'
+            attrs[key] = str(value)
+        node = XNode(json_node.get('_type') or 'node', attrs, parent, order,
+                     json_node)
+        parent.children.append(node)
+        for child in reversed(json_node.get('children', [])):
+            stack.append((child, node))
+    return document
+
+
+# ----------------------------------------------------------------------------
+# tokenizer and parser
+
+
+class XPathError(ValueError):
+    pass
+
+
+_TOKEN_RE = re.compile(r'''
+    \s*(?:
+      (?P<number>\d+(?:\.\d*)?|\.\d+)
+    | (?P<string>"[^"]*"|'[^']*')
+    | (?P<op>//|::|\.\.|!=|<=|>=|[/.@\[\](),|=<>*+-])
+    | (?P<name>[A-Za-z_][\w.\-]*(?::(?!:)[A-Za-z_][\w.\-]*)?)
+    )''', re.X)
+
+_AXES = {
+    'child', 'descendant', 'descendant-or-self', 'parent', 'ancestor',
+    'ancestor-or-self', 'following-sibling', 'preceding-sibling', 'self',
+    'attribute', 'following', 'preceding'
+}
+_REVERSE_AXES = {'parent', 'ancestor', 'ancestor-or-self',
+                 'preceding-sibling', 'preceding'}
+
+
+def _tokenize(expr):
+    tokens = []
+    pos = 0
+    expr = expr.strip()
+    while pos < len(expr):
+        m = _TOKEN_RE.match(expr, pos)
+        if m is None or m.end() == pos:
+            raise XPathError("Invalid xpath at %d: %r" % (pos, expr))
+        pos = m.end()
+        kind = m.lastgroup
+        value = m.group(kind)
+        if kind == 'number':
+            value = float(value)
+        elif kind == 'string':
+            value = value[1:-1]
+        tokens.append((kind, value))
+    tokens.append(('end', None))
+    return tokens
+
+
+class _Parser(object):
+    """ recursive descent parser, produces a tuple based AST """
+
+    def __init__(self, expr):
+        self.expr = expr
+        self.tokens = _tokenize(expr)
+        self.pos = 0
+
+    def peek(self, offset=0):
+        return self.tokens[self.pos + offset]
+
+    def next(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def accept(self, kind, value=None):
+        token = self.peek()
+        if token[0] == kind and (value is None or token[1] == value):
+            self.pos += 1
+            return token
+        return None
+
+    def expect(self, kind, value=None):
+        token = self.accept(kind, value)
+        if token is None:
+            raise XPathError("Expect %s in xpath %r, got %r" %
+                             (value or kind, self.expr, self.peek()[1]))
+        return token
+
+    def parse(self):
+        ast = self.parse_or()
+        if self.peek()[0] != 'end':
+            raise XPathError("Unexpected %r in xpath %r" %
+                             (self.peek()[1], self.expr))
+        return ast
+
+    def parse_or(self):
+        left = self.parse_and()
+        while self.accept('name', 'or'):
+            left = ('or', left, self.parse_and())
+        return left
+
+    def parse_and(self):
+        left = self.parse_equality()
+        while self.accept('name', 'and'):
+            left = ('and', left, self.parse_equality())
+        return left
+
+    def parse_equality(self):
+        left = self.parse_relational()
+        while True:
+            token = self.accept('op', '=') or self.accept('op', '!=')
+            if not token:
+                return left
+            left = ('cmp', token[1], left, self.parse_relational())
+
+    def parse_relational(self):
+        left = self.parse_additive()
+        while True:
+            token = (self.accept('op', '<') or self.accept('op', '<=') or
+                     self.accept('op', '>') or self.accept('op', '>='))
+            if not token:
+                return left
+            left = ('cmp', token[1], left, self.parse_additive())
+
+    def parse_additive(self):
+        left = self.parse_unary()
+        while True:
+            token = self.accept('op', '+') or self.accept('op', '-')
+            if not token:
+                return left
+            left = ('arith', token[1], left, self.parse_unary())
+
+    def parse_unary(self):
+        if self.accept('op', '-'):
+            return ('neg', self.parse_unary())
+        return self.parse_union()
+
+    def parse_union(self):
+        left = self.parse_path()
+        while self.accept('op', '|'):
+            left = ('union', left, self.parse_path())
+        return left
+
+    def _starts_filter(self):
+        kind, value = self.peek()
+        if kind in ('number', 'string'):
+            return True
+        if kind == 'op' and value == '(':
+            return True
+        if kind == 'name' and self.peek(1) == ('op', '('):
+            return value not in ('node', 'text')
+        return False
+
+    def parse_path(self):
+        if self._starts_filter():
+            primary = self.parse_primary()
+            predicates = self.parse_predicates()
+            if predicates:
+                primary = ('filter', primary, predicates)
+            if self.peek() in (('op', '/'), ('op', '//')):
+                return ('path', primary, self.parse_relative())
+            return primary
+        if self.accept('op', '/'):
+            if self._starts_step():
+                return ('path', ('root', ), self.parse_relative())
+            return ('root', )
+        if self.peek() == ('op', '//'):
+            return ('path', ('root', ), self.parse_relative())
+        return ('path', None, self.parse_relative())
+
+    def _starts_step(self):
+        kind, value = self.peek()
+        return kind == 'name' or (kind == 'op' and value in ('.', '..', '@', '*'))
+
+    def parse_relative(self):
+        """ list of steps, a leading '//' becomes descendant-or-self::node() """
+        steps = []
+        if self.accept('op', '//'):
+            steps.append(('descendant-or-self', 'node()', []))
+        steps.append(self.parse_step())
+        while True:
+            if self.accept('op', '/'):
+                steps.append(self.parse_step())
+            elif self.accept('op', '//'):
+                steps.append(('descendant-or-self', 'node()', []))
+                steps.append(self.parse_step())
+            else:
+                return steps
+
+    def parse_step(self):
+        if self.accept('op', '.'):
+            return ('self', 'node()', [])
+        if self.accept('op', '..'):
+            return ('parent', 'node()', [])
+        axis = 'child'
+        if self.accept('op', '@'):
+            axis = 'attribute'
+        elif self.peek()[0] == 'name' and self.peek(1) == ('op', '::'):
+            axis = self.next()[1]
+            self.next()
+            if axis not in _AXES:
+                raise XPathError("Unsupported axis %r" % axis)
+        if self.accept('op', '*'):
+            test = '*'
+        else:
+            name = self.expect('name')[1]
+            if name in ('node', 'text') and self.accept('op', '('):
+                self.expect('op', ')')
+                test = name + '()'
+            else:
+                test = name
+        return (axis, test, self.parse_predicates())
+
+    def parse_predicates(self):
+        predicates = []
+        while self.accept('op', '['):
+            predicates.append(self.parse_or())
+            self.expect('op', ']')
+        return predicates
+
+    def parse_primary(self):
+        kind, value = self.next()
+        if kind == 'number':
+            return ('number', value)
+        if kind == 'string':
+            return ('string', value)
+        if kind == 'op' and value == '(':
+            ast = self.parse_or()
+            self.expect('op', ')')
+            return ast
+        if kind == 'name':
+            self.expect('op', '(')
+            args = []
+            if not self.accept('op', ')'):
+                args.append(self.parse_or())
+                while self.accept('op', ','):
+                    args.append(self.parse_or())
+                self.expect('op', ')')
+            if value not in _FUNCTIONS:
+                raise XPathError("Unsupported function %s()" % value)
+            try:
+                _SIGNATURES[value].bind(None, *args)
+            except TypeError:
+                raise XPathError("Wrong number of arguments to %s()" % value)
+            return ('call', value, args)
+        raise XPathError("Unexpected %r in xpath %r" % (value, self.expr))
+
+
+# ----------------------------------------------------------------------------
+# values
+
+
+def _is_nodeset(v):
+    return isinstance(v, list)
+
+
+def _node_string(node):
+    if isinstance(node, XAttr):
+        return node.value
+    return ''  # hierarchy elements carry no text content
+
+
+def _to_string(v):
+    if _is_nodeset(v):
+        return _node_string(v[0]) if v else ''
+    if isinstance(v, bool):
+        return 'true' if v else 'false'
+    if isinstance(v, float):
+        if math.isnan(v):
+            return 'NaN'
+        if v == int(v):
+            return str(int(v))
+        return str(v)
+    return v
+
+
+def _to_number(v):
+    if isinstance(v, bool):
+        return 1.0 if v else 0.0
+    if isinstance(v, float):
+        return v
+    try:
+        return float(_to_string(v).strip())
+    except ValueError:
+        return float('nan')
+
+
+def _to_bool(v):
+    if _is_nodeset(v):
+        return len(v) > 0
+    if isinstance(v, bool):
+        return v
+    if isinstance(v, float):
+        return v != 0 and not math.isnan(v)
+    return len(v) > 0
+
+
+_CMP = {
+    '=': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+}
+
+
+def _compare(op, a, b):
+    f = _CMP[op]
+    if _is_nodeset(a) or _is_nodeset(b):
+        if _is_nodeset(a) and _is_nodeset(b):
+            bs = [_node_string(n) for n in b]
+            return any(
+                _compare(op, _node_string(x), y) for x in
+                (_node_string(n) for n in a) for y in bs)
+        if _is_nodeset(b):
+            # keep the node-set on the left, flip the operator
+            op = {'<': '>', '<=': '>=', '>': '<', '>=': '<='}.get(op, op)
+            a, b = b, a
+            f = _CMP[op]
+        if isinstance(b, bool):
+            return f(_to_bool(a), b)
+        if isinstance(b, float):
+            return any(f(_to_number(_node_string(n)), b) for n in a)
+        if op in ('=', '!='):
+            return any(f(_node_string(n), b) for n in a)
+        return any(
+            f(_to_number(_node_string(n)), _to_number(b)) for n in a)
+    if op in ('=', '!='):
+        if isinstance(a, bool) or isinstance(b, bool):
+            return f(_to_bool(a), _to_bool(b))
+        if isinstance(a, float) or isinstance(b, float):
+            return f(_to_number(a), _to_number(b))
+        return f(_to_string(a), _to_string(b))
+    return f(_to_number(a), _to_number(b))
+
+
+def _substring(s, start, length=None):
+    s = _to_string(s)
+    start = _to_number(start)
+    if math.isnan(start):
+        return ''
+    first = round(start)
+    if length is None:
+        return s[max(first, 1) - 1:]
+    length = _to_number(length)
+    if math.isnan(length):
+        return ''
+    last = first + round(length)
+    return s[max(first, 1) - 1:max(last, 1) - 1]
+
+
+def _re_match(s, pattern, flags=None):
+    f = re.I if flags is not None and 'i' in _to_string(flags) else 0
+    try:
+        regex = re.compile(_to_string(pattern), f)
+    except re.error as e:
+        raise XPathError("Invalid pattern %r: %s" % (_to_string(pattern), e))
+    return regex.search(_to_string(s)) is not None
+
+
+# name -> (function(ctx, *args), uses the context node when called without args)
+_FUNCTIONS = {
+    'last': lambda ctx: float(ctx[2]),
+    'position': lambda ctx: float(ctx[1]),
+    'count': lambda ctx, ns: float(len(ns)),
+    'not': lambda ctx, v: not _to_bool(v),
+    'true': lambda ctx: True,
+    'false': lambda ctx: False,
+    'boolean': lambda ctx, v: _to_bool(v),
+    'number': lambda ctx, v=None: _to_number(v if v is not None else [ctx[0]]),
+    'string': lambda ctx, v=None: _to_string(v if v is not None else [ctx[0]]),
+    'concat': lambda ctx, *args: ''.join(_to_string(a) for a in args),
+    'contains': lambda ctx, a, b: _to_string(b) in _to_string(a),
+    'starts-with': lambda ctx, a, b: _to_string(a).startswith(_to_string(b)),
+    'ends-with': lambda ctx, a, b: _to_string(a).endswith(_to_string(b)),
+    'string-length': lambda ctx, v=None: float(len(
+        _to_string(v if v is not None else [ctx[0]]))),
+    'normalize-space': lambda ctx, v=None: ' '.join(
+        _to_string(v if v is not None else [ctx[0]]).split()),
+    'substring': lambda ctx, s, start, length=None: _substring(
+        s, start, length),
+    're:match': lambda ctx, s, pattern, flags=None: _re_match(s, pattern, flags),
+    're:test': lambda ctx, s, pattern, flags=None: _re_match(s, pattern, flags),
+    'matches': lambda ctx, s, pattern, flags=None: _re_match(s, pattern, flags),
+}
+# checked while parsing, so a wrong number of arguments is an XPathError
+_SIGNATURES = {name: inspect.signature(f) for name, f in _FUNCTIONS.items()}
+
+
+# ----------------------------------------------------------------------------
+# evaluation
+
+
+def _iter_descendants(node):
+    stack = list(reversed(node.children))
+    while stack:
+        n = stack.pop()
+        yield n
+        stack.extend(reversed(n.children))
+
+
+def _axis(node, axis):
+    """ nodes of axis, in proximity order """
+    if isinstance(node, XAttr):
+        if axis == 'parent':
+            return [node.owner]
+        if axis in ('self', 'ancestor-or-self'):
+            return [node] + (_axis(node.owner, 'ancestor-or-self')
+                             if axis == 'ancestor-or-self' else [])
+        if axis == 'ancestor':
+            return _axis(node.owner, 'ancestor-or-self')
+        return []
+    if axis == 'child':
+        return node.children
+    if axis == 'descendant':
+        return list(_iter_descendants(node))
+    if axis == 'descendant-or-self':
+        return [node] + list(_iter_descendants(node))
+    if axis == 'self':
+        return [node]
+    if axis == 'parent':
+        return [node.parent] if node.parent is not None else []
+    if axis in ('ancestor', 'ancestor-or-self'):
+        ret = [node] if axis == 'ancestor-or-self' else []
+        p = node.parent
+        while p is not None:
+            ret.append(p)
+            p = p.parent
+        return ret
+    if axis == 'attribute':
+        return [XAttr(node, k, v) for k, v in node.attrs.items()]
+    if axis in ('following-sibling', 'preceding-sibling'):
+        if node.parent is None:
+            return []
+        siblings = node.parent.children
+        i = siblings.index(node)
+        if axis == 'following-sibling':
+            return siblings[i + 1:]
+        return siblings[:i][::-1]
+    if axis in ('following', 'preceding'):
+        root = node
+        while root.parent is not None:
+            root = root.parent
+        ancestors = set(id(n) for n in _axis(node, 'ancestor'))
+        inside = set(id(n) for n in _iter_descendants(node))
+        if axis == 'following':
+            return [
+                n for n in _iter_descendants(root)
+                if n.order > node.order and id(n) not in inside
+            ]
+        return [
+            n for n in _iter_descendants(root)
+            if n.order < node.order and id(n) not in ancestors
+        ][::-1]
+    raise XPathError("Unsupported axis %r" % axis)
+
+
+def _node_test(axis, test):
+    if test == 'node()':
+        return lambda n: True
+    if test == 'text()':
+        return lambda n: False  # no text nodes in a hierarchy dump
+    if axis == 'attribute':
+        if test == '*':
+            return lambda n: True
+        return lambda n: n.name == test
+    if test == '*':
+        return lambda n: isinstance(n, XNode) and n.tag is not None
+    return lambda n: isinstance(n, XNode) and n.tag == test
+
+
+def _step_nodes(axis, test):
+    """ function(node) -> nodes of axis passing the node test """
+    if axis == 'attribute' and test not in ('*', 'node()', 'text()'):
+        # @name is the most common step, read it without building every XAttr
+        def attribute(node):
+            if isinstance(node, XNode) and test in node.attrs:
+                return [XAttr(node, test, node.attrs[test])]
+            return []
+        return attribute
+    match = _node_test(axis, test)
+    return lambda node: [n for n in _axis(node, axis) if match(n)]
+
+
+def _doc_order(nodes):
+    seen = set()
+    unique = []
+    for n in nodes:
+        key = id(n) if isinstance(n, XNode) else (id(n.owner), n.name)
+        if key not in seen:
+            seen.add(key)
+            unique.append(n)
+    unique.sort(key=lambda n: (n.order, 0 if isinstance(n, XNode) else 1))
+    return unique
+
+
+def _uses_position(ast):
+    """ True when a predicate may depend on position() or last() """
+    if not isinstance(ast, tuple):
+        return False
+    if ast[0] == 'number':
+        return True
+    if ast[0] == 'call' and ast[1] in ('position', 'last'):
+        return True
+    if ast[0] == 'path':
+        return False  # predicates of a nested path have their own context
+    return any(
+        _uses_position(a) for a in ast[1:]
+        if isinstance(a, tuple)) or any(
+            _uses_position(a) for a in ast[1:] if isinstance(a, list)
+            for a in a)
+
+
+def _compile_predicates(predicates):
+    compiled = [(_compile(p), p[0] == 'number') for p in predicates]
+
+    def apply(nodes):
+        for f, is_number in compiled:
+            size = len(nodes)
+            kept = []
+            for i, n in enumerate(nodes, 1):
+                v = f((n, i, size))
+                if is_number or isinstance(v, float):
+                    if _to_number(v) == i:
+                        kept.append(n)
+                elif _to_bool(v):
+                    kept.append(n)
+            nodes = kept
+        return nodes
+
+    return apply
+
+
+def _compile_steps(steps):
+    # "//" followed by a step without positional predicates is the same as
+    # the descendant axis, which avoids one pass per context node
+    merged = []
+    i = 0
+    while i < len(steps):
+        axis, test, predicates = steps[i]
+        if (axis, test) == ('descendant-or-self', 'node()') and \
+                not predicates and i + 1 < len(steps):
+            next_axis, next_test, next_predicates = steps[i + 1]
+            if next_axis == 'child' and not any(
+                    _uses_position(p) for p in next_predicates):
+                merged.append(('descendant', next_test, next_predicates))
+                i += 2
+                continue
+        merged.append(steps[i])
+        i += 1
+
+    compiled = []
+    for axis, test, predicates in merged:
+        compiled.append((axis, _step_nodes(axis, test),
+                         _compile_predicates(predicates), bool(predicates)))
+
+    def run(nodes):
+        for axis, step_nodes, apply, has_predicates in compiled:
+            selected = []
+            for node in nodes:
+                matched = step_nodes(node)
+                if has_predicates:
+                    matched = apply(matched)
+                selected.extend(matched)
+            nodes = _doc_order(selected) if len(nodes) > 1 or \
+                axis in _REVERSE_AXES else selected
+        return nodes
+
+    return run
+
+
+def _compile(ast):
+    kind = ast[0]
+    if kind == 'number':
+        value = ast[1]
+        return lambda ctx: value
+    if kind == 'string':
+        value = ast[1]
+        return lambda ctx: value
+    if kind == 'root':
+        def root(ctx):
+            n = ctx[0] if isinstance(ctx[0], XNode) else ctx[0].owner
+            while n.parent is not None:
+                n = n.parent
+            return [n]
+        return root
+    if kind == 'path':
+        start = _compile(ast[1]) if ast[1] else (lambda ctx: [ctx[0]])
+        run = _compile_steps(ast[2])
+
+        def path(ctx):
+            nodes = start(ctx)
+            if not _is_nodeset(nodes):
+                raise XPathError("Path step on a non node-set value")
+            return run(nodes)
+        return path
+    if kind == 'filter':
+        primary = _compile(ast[1])
+        apply = _compile_predicates(ast[2])
+        return lambda ctx: apply(primary(ctx))
+    if kind == 'union':
+        left, right = _compile(ast[1]), _compile(ast[2])
+        return lambda ctx: _doc_order(left(ctx) + right(ctx))
+    if kind == 'or':
+        left, right = _compile(ast[1]), _compile(ast[2])
+        return lambda ctx: _to_bool(left(ctx)) or _to_bool(right(ctx))
+    if kind == 'and':
+        left, right = _compile(ast[1]), _compile(ast[2])
+        return lambda ctx: _to_bool(left(ctx)) and _to_bool(right(ctx))
+    if kind == 'cmp':
+        op, left, right = ast[1], _compile(ast[2]), _compile(ast[3])
+        return lambda ctx: _compare(op, left(ctx), right(ctx))
+    if kind == 'arith':
+        op, left, right = ast[1], _compile(ast[2]), _compile(ast[3])
+        if op == '+':
+            return lambda ctx: _to_number(left(ctx)) + _to_number(right(ctx))
+        return lambda ctx: _to_number(left(ctx)) - _to_number(right(ctx))
+    if kind == 'neg':
+        operand = _compile(ast[1])
+        return lambda ctx: -_to_number(operand(ctx))
+    if kind == 'call':
+        f = _FUNCTIONS[ast[1]]
+        args = [_compile(a) for a in ast[2]]
+        return lambda ctx: f(ctx, *[a(ctx) for a in args])
+    raise XPathError("Unknown expression %r" % (kind, ))
+
+
+# ----------------------------------------------------------------------------
+# public api
+
+
+def _quote(s):
+    if '"' not in s:
+        return '"%s"' % s
+    if "'" not in s:
+        return "'%s'" % s
+    return 'concat(%s)' % ', \'"\', '.join('"%s"' % p for p in s.split('"'))
+
+
+def strict_xpath(xpath: str) -> str:
+    """ expand the uiautomator2 shortcuts (@id, %text%, ^regex, plain text) """
+    if xpath.startswith('/') or xpath.startswith('('):
+        return xpath
+    if xpath.startswith('@'):
+        return '//*[@resource-id=%s]' % _quote(xpath[1:])
+    if xpath.startswith('^'):
+        q = _quote(xpath)
+        return ('//*[re:match(@text, {0}) or re:match(@content-desc, {0}) '
+                'or re:match(@resource-id, {0})]').format(q)
+    if xpath.startswith('%') and xpath.endswith('%'):
+        q = _quote(xpath[1:-1])
+        return '//*[contains(@text, {0}) or contains(@content-desc, {0})]'.format(q)
+    if xpath.startswith('%'):
+        q = _quote(xpath[1:])
+        return '//*[ends-with(@text, {0}) or ends-with(@content-desc, {0})]'.format(q)
+    if xpath.endswith('%'):
+        q = _quote(xpath[:-1])
+        return '//*[starts-with(@text, {0}) or starts-with(@content-desc, {0})]'.format(q)
+    q = _quote(xpath)
+    return '//*[@text={0} or @content-desc={0} or @resource-id={0}]'.format(q)
+
+
+@functools.lru_cache(maxsize=256)
+def compile_xpath(xpath: str):
+    """
+    Returns:
+        function(tree) -> list of XNode, compiled expressions are cached
+
+    Raises:
+        XPathError
+    """
+    f = _compile(_Parser(strict_xpath(xpath)).parse())
+
+    def evaluate(tree: XNode):
+        ret = f((tree, 1, 1))
+        if not _is_nodeset(ret):
+            raise XPathError("xpath %r is not a node-set" % xpath)
+        return [n for n in ret if isinstance(n, XNode) and n.tag is not None]
+
+    return evaluate
+
+
+def select(tree: XNode, xpath: str) -> list:
+    """
+    Returns:
+        list of XNode in document order
+    """
+    return compile_xpath(xpath)(tree)